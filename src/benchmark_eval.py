@@ -0,0 +1,174 @@
+"""
+End-to-end CPU benchmark of the evaluation fine-tuning and inference on the
+synthetic sequences of generate_synthetic_davis.py. The results are stored as
+JSON baselines and compared against the baseline of a previous commit.
+
+python src/generate_synthetic_davis.py
+python src/benchmark_eval.py --save_baseline benchmarks/eval.json
+python src/benchmark_eval.py --baseline benchmarks/eval.json
+"""
+import argparse
+import copy
+import json
+import os
+import resource
+import subprocess
+import sys
+
+import numpy as np
+import torch
+
+from util.evaluate import evaluate_seq, init_eval_loaders, init_eval_model
+from util.fine_tune_budget import saved_epochs
+from util.metrics import GroundTruthCache
+from util.roi_crop import RoiCrop
+from util.segment_video import load_config
+from util.stage_timer import merge_summaries, save_json
+
+# metric and whether higher values are better
+COMPARED_METRICS = [('frames_per_second', True),
+                    ('fine_tune_time_per_object', False),
+                    ('peak_rss_mb', False)]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(_config, dataset_key, meta_optim_model_file=None):
+    device = torch.device('cpu')
+
+    model, meta_optim = init_eval_model(dataset_key, None, _config, device)
+    if meta_optim_model_file is not None:
+        meta_optim.load_state_dict(torch.load(
+            meta_optim_model_file, map_location=lambda storage, loc: storage)['meta_optim_state_dict'])
+    meta_optim_state_dict = copy.deepcopy(meta_optim.state_dict())
+
+    loaders = init_eval_loaders(dataset_key, _config)
+    random_transformation_transforms = loaders[0].dataset.transform
+    gt_cache = GroundTruthCache()
+
+    seqs = {}
+    for seq_name in loaders[0].dataset.seqs_names:
+        seq_result = evaluate_seq(seq_name, model, meta_optim, meta_optim_state_dict, loaders,
+                                  random_transformation_transforms, _config, gt_cache)
+
+        stages = seq_result['stage_timings']
+        fine_tune_time = sum([stages[s]['time'] for s in ['fine_tune_forward', 'fine_tune_step']
+                              if s in stages])
+        seqs[seq_name] = {'num_frames': seq_result['num_frames'],
+                          'num_fine_tunings': len(seq_result['train_loss']),
+                          'eval_time': seq_result['eval_time'],
+                          'fine_tune_time': fine_tune_time,
+                          'fine_tune_epochs': seq_result['fine_tune_epochs'],
+                          'online_adapt': seq_result['online_adapt'],
+                          'num_propagated_frames': seq_result['keyframes']['num_propagated'],
+                          'roi_crop': seq_result['roi_crop'],
+                          'J_mean': float(np.mean(seq_result['evaluation']['J']['mean'])),
+                          'F_mean': float(np.mean(seq_result['evaluation']['F']['mean'])),
+                          'stages': stages}
+        print(f"{seq_name}: {seq_result['num_frames'] / seq_result['eval_time']:.2f} frames/s")
+
+    num_frames = sum([s['num_frames'] for s in seqs.values()])
+    num_fine_tunings = sum([s['num_fine_tunings'] for s in seqs.values()])
+    fine_tune_epochs = [r for s in seqs.values() for r in s['fine_tune_epochs']]
+    J_mean = float(np.mean([s['J_mean'] for s in seqs.values()]))
+    F_mean = float(np.mean([s['F_mean'] for s in seqs.values()]))
+    return {'commit': git_commit(),
+            'num_threads': torch.get_num_threads(),
+            'num_epochs': _config['num_epochs']['eval'],
+            'frames_per_second': num_frames / sum([s['eval_time'] for s in seqs.values()]),
+            'fine_tune_time_per_object': sum([s['fine_tune_time'] for s in seqs.values()]) / num_fine_tunings,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'fine_tune_epochs': float(np.mean([r['epochs'] for r in fine_tune_epochs])),
+            'propagated_frames': sum([s['num_propagated_frames'] for s in seqs.values()]) / num_frames,
+            'mean_crop_area': RoiCrop.merge_summaries([s['roi_crop'] for s in seqs.values()]),
+            'fine_tune_epochs_saved': saved_epochs(fine_tune_epochs),
+            'J_mean': J_mean,
+            'F_mean': F_mean,
+            'JF_mean': (J_mean + F_mean) / 2.0,
+            'stages': merge_summaries([s['stages'] for s in seqs.values()]),
+            'seqs': seqs}
+
+
+def compare(result, baseline, tolerance):
+    """Prints the relative change of every metric and returns the regressed metrics."""
+    regressions = []
+    print(f"baseline {baseline['commit']} -> {result['commit']}")
+    for metric, higher_is_better in COMPARED_METRICS:
+        change = result[metric] / baseline[metric] - 1.0
+        regressed = -change > tolerance if higher_is_better else change > tolerance
+        if regressed:
+            regressions.append(metric)
+
+        print(f"  {metric}: {baseline[metric]:.3f} -> {result[metric]:.3f} "
+              f"({change:+.1%}){' REGRESSION' if regressed else ''}")
+
+    # accuracy cost of, e.g., an adaptive fine-tuning budget
+    if 'JF_mean' in baseline:
+        print(f"  J&F mean: {baseline['JF_mean']:.1%} -> {result['JF_mean']:.1%} "
+              f"({result['JF_mean'] - baseline['JF_mean']:+.1%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_files', type=str, nargs='+',
+                        default=['cfgs/meta.yaml', 'cfgs/meta_synthetic-davis-2017.yaml'])
+    parser.add_argument('--dataset_key', type=str, default='val')
+    parser.add_argument('--meta_optim_model_file', type=str, default=None)
+    parser.add_argument('--num_epochs', type=int, default=None)
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--adaptive_fine_tune_budget', action='store_true')
+    parser.add_argument('--keyframe_mode', type=str, default=None, choices=['INTERVAL', 'DIFFERENCE'])
+    parser.add_argument('--keyframe_interval', type=int, default=5)
+    parser.add_argument('--roi_crop', action='store_true')
+    parser.add_argument('--seq_time_budget', type=float, default=None)
+    parser.add_argument('--baseline', type=str, default=None)
+    parser.add_argument('--save_baseline', type=str, default=None)
+    # relative change of a metric which counts as regression
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    updates = {}
+    if args.num_epochs is not None:
+        updates['num_epochs'] = {'eval': args.num_epochs}
+    if args.adaptive_fine_tune_budget:
+        updates['eval_fine_tune_budget'] = {'adaptive': True,
+                                            'seq_time_budget': args.seq_time_budget}
+    if args.keyframe_mode is not None:
+        updates['eval_keyframes'] = {'mode': args.keyframe_mode,
+                                     'interval': args.keyframe_interval}
+    if args.roi_crop:
+        updates['eval_roi_crop'] = {'enabled': True}
+    _config = load_config(args.config_files, updates)
+
+    result = benchmark(_config, args.dataset_key, args.meta_optim_model_file)
+
+    print(f"frames/s: {result['frames_per_second']:.2f}, "
+          f"fine-tuning per object: {result['fine_tune_time_per_object']:.2f}s, "
+          f"peak RSS: {result['peak_rss_mb']:.0f} MB, J mean: {result['J_mean']:.1%}, "
+          f"fine-tuning epochs: {result['fine_tune_epochs']:.1f}, "
+          f"propagated frames: {result['propagated_frames']:.1%}")
+
+    if args.save_baseline is not None:
+        if os.path.dirname(args.save_baseline):
+            os.makedirs(os.path.dirname(args.save_baseline), exist_ok=True)
+        save_json(result, args.save_baseline)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(result, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""
+CPU benchmark of the meta training loop on the synthetic sequences of
+generate_synthetic_davis.py. Runs meta_run processes without evaluation or
+Visdom and reports the seconds per meta iteration, tasks per second and
+stage times for an increasing number of meta processes.
+
+python src/generate_synthetic_davis.py
+python src/benchmark_meta.py --num_processes 1 2 4 --output benchmarks/meta.json
+"""
+import argparse
+import os
+import time
+import timeit
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from meta_optim.meta_optim import MetaOptimizer
+from meta_optim.meta_task_pool import prepare_task
+from meta_optim.meta_task_scheduler import MetaTaskScheduler
+from util.helper_func import (cpu_cores, init_parent_model,
+                              set_random_seeds)
+from util.meta_run import (init_meta_optim_optim, init_meta_task_set,
+                           meta_run, meta_task_keys)
+from util.segment_video import load_config
+from util.stage_timer import StageTimer, format_summary, merge_summaries, save_json
+
+
+def benchmark_task_construction(_config, num_tasks):
+    meta_task_set = init_meta_task_set(_config)
+
+    timer = StageTimer()
+    for i in range(num_tasks):
+        set_random_seeds(_config['seed'] + i)
+        with timer.stage('task_construction'):
+            prepare_task(meta_task_set, i % len(meta_task_set))
+    return timer.summary()
+
+
+def benchmark_meta_iters(_config, num_processes, num_iters, num_warmup_iters):
+    set_random_seeds(_config['seed'])
+
+    model, parent_states = init_parent_model(**_config['parent_model'])
+    if 'train' in parent_states and parent_states['train']['states']:
+        model.load_state_dict(parent_states['train']['states'][0])
+
+    meta_optim = MetaOptimizer(model, **_config['meta_optim_cfg'])
+    meta_optim.init_zero_grad()
+    meta_optim_optim = init_meta_optim_optim(meta_optim, _config['meta_optim_optim_cfg'])
+    meta_optim.share_memory()
+
+    process_manager = mp.Manager()
+    shared_variables = process_manager.dict({'meta_iter': 0, 'meta_epoch': 0})
+    shared_meta_optim_grads = {name: torch.zeros_like(param).cpu()
+                               for name, param in meta_optim.named_parameters()}
+    for grad in shared_meta_optim_grads.values():
+        grad.share_memory_()
+
+    # the plans of consecutive epochs are truncated to num_iters meta iterations
+    meta_batch_size = _config['meta_batch_size']
+    scheduler = MetaTaskScheduler(meta_task_keys(init_meta_task_set(_config)),
+                                  meta_batch_size, num_processes, _config['seed'])
+    plans = [[] for _ in range(num_processes)]
+    meta_epoch = 0
+    while len(plans[0]) < num_iters:
+        for plan, epoch_plan in zip(plans, scheduler.plan_epoch(meta_epoch)):
+            plan.extend(epoch_plan)
+        meta_epoch += 1
+
+    processes = []
+    for rank in range(num_processes):
+        shared_dict = process_manager.dict()
+        shared_dict['sub_iter_done'] = False
+        shared_dict['meta_epoch_done'] = False
+        shared_dict['epoch_plan'] = plans[rank][:num_iters]
+
+        process_args = [rank, model.state_dict(), meta_optim.state_dict(),
+                        torch.get_rng_state(), _config, _config['datasets']['train'],
+                        shared_dict, shared_variables, shared_meta_optim_grads,
+                        None, num_processes]
+        process = mp.Process(target=meta_run, args=process_args)
+        process.start()
+        processes.append({'process': process, 'shared_dict': shared_dict})
+
+    timer = StageTimer()
+    iter_times = []
+    stage_timings = []
+    start_iter = timeit.default_timer()
+    for meta_iter in range(1, num_iters + 1):
+        while not all([p['shared_dict']['sub_iter_done'] for p in processes]):
+            if not all([p['process'].is_alive() for p in processes]):
+                raise RuntimeError('Meta process died.')
+            time.sleep(0.01)
+
+        # same update as train_meta.py
+        with timer.stage('meta_optim_optim_step'):
+            for name, param in meta_optim.named_parameters():
+                param.grad = shared_meta_optim_grads[name] / meta_batch_size
+
+                grad_clip = _config['meta_optim_optim_cfg']['grad_clip']
+                if grad_clip is not None:
+                    param.grad.clamp_(-1.0 * grad_clip, grad_clip)
+
+            meta_optim_optim.step()
+            meta_optim_optim.zero_grad()
+            meta_optim.clamp_init_lr()
+
+            for grad in shared_meta_optim_grads.values():
+                grad.zero_()
+
+        end_iter = timeit.default_timer()
+        if meta_iter > num_warmup_iters:
+            iter_times.append(end_iter - start_iter)
+            stage_timings.extend([p['shared_dict']['stage_timings'] for p in processes])
+            stage_timings.append(timer.summary())
+        timer.reset()
+        start_iter = end_iter
+
+        shared_variables['meta_iter'] = meta_iter
+        for p in processes:
+            p['shared_dict']['sub_iter_done'] = False
+
+    for p in processes:
+        p['shared_dict']['stop'] = True
+    for p in processes:
+        p['process'].join(timeout=60.0)
+        if p['process'].is_alive():
+            p['process'].terminate()
+    process_manager.shutdown()
+
+    # the last meta batch of an epoch might be smaller
+    num_tasks = sum([len(plan[i]) for plan in plans for i in range(num_warmup_iters, num_iters)])
+    return {'num_processes': num_processes,
+            'num_threads_per_process': _config['num_cpu_threads_per_process'],
+            'sec_per_meta_iter': float(np.mean(iter_times)),
+            'sec_per_meta_iter_std': float(np.std(iter_times)),
+            'tasks_per_second': num_tasks / sum(iter_times),
+            'stages': merge_summaries(stage_timings)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_files', type=str, nargs='+',
+                        default=['cfgs/meta.yaml', 'cfgs/meta_synthetic-davis-2017.yaml'])
+    parser.add_argument('--num_processes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--meta_batch_size', type=int, default=4)
+    parser.add_argument('--num_producers', type=int, default=0)
+    parser.add_argument('--num_iters', type=int, default=5)
+    # the first meta iterations include the process and model initialization
+    parser.add_argument('--num_warmup_iters', type=int, default=1)
+    parser.add_argument('--num_construction_tasks', type=int, default=8)
+    parser.add_argument('--output', type=str, default=None)
+    args = parser.parse_args()
+
+    mp.set_start_method('spawn')
+    mp.set_sharing_strategy('file_system')
+
+    updates = {'meta_batch_size': args.meta_batch_size,
+               'eval_datasets': False,
+               'num_meta_processes_per_gpu': 1,
+               'meta_task_pool': {'num_producers': args.num_producers}}
+    _config = load_config(args.config_files, updates)
+
+    task_construction = benchmark_task_construction(_config, args.num_construction_tasks)
+    print(f"task construction: {task_construction['task_construction']['mean_time']:.3f}s/task")
+
+    results = []
+    for num_processes in args.num_processes:
+        if args.meta_batch_size % num_processes:
+            print(f"{num_processes} processes: skipped, meta_batch_size is not a multiple.")
+            continue
+
+        # every meta process gets its own slice of the cores
+        _config['num_cpu_threads_per_process'] = max(1, len(cpu_cores()) // num_processes)
+
+        result = benchmark_meta_iters(_config, num_processes, args.num_iters,
+                                      args.num_warmup_iters)
+        results.append(result)
+
+        print(f"{num_processes} processes: {result['sec_per_meta_iter']:.2f}s/meta iter, "
+              f"{result['tasks_per_second']:.2f} tasks/s")
+        print(f"  {format_summary(result['stages'])}")
+
+    if args.output is not None:
+        if os.path.dirname(args.output):
+            os.makedirs(os.path.dirname(args.output), exist_ok=True)
+        save_json({'meta_batch_size': args.meta_batch_size,
+                   'num_iters': args.num_iters - args.num_warmup_iters,
+                   'task_construction': task_construction,
+                   'results': results},
+                  args.output)
+
+
+if __name__ == '__main__':
+    main()
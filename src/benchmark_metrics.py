@@ -0,0 +1,126 @@
+"""
+Microbenchmark of the per frame and batched contour accuracy F on synthetic
+multi-object sequences at 480p and full resolution. Noisy predictions with a
+share of randomly relabeled pixels have fragmented boundaries.
+
+python src/benchmark_metrics.py --num_frames 50 --num_objects 3 --noise 0.0 0.01 0.05
+"""
+import argparse
+import timeit
+from itertools import product
+
+import cv2
+import numpy as np
+import torch
+
+from util.metrics import SequenceGroundTruth, db_eval_boundary, eval_label_maps
+
+try:
+    from davis.measures import db_eval_boundary as davis_db_eval_boundary
+except ImportError:
+    davis_db_eval_boundary = None
+
+
+RESOLUTIONS = {'480p': (480, 854), 'Full-Resolution': (1080, 1920)}
+
+
+def synthetic_sequence(num_frames, num_objects, height, width, seed, noise=0.0):
+    """
+    Label maps of moving ellipses and slightly displaced predictions. A noise
+    share of the prediction pixels is set to random labels.
+    """
+    rng = np.random.RandomState(seed)
+
+    gt = np.zeros((num_frames, height, width), dtype=np.uint8)
+    pred = np.zeros_like(gt)
+
+    centers = rng.uniform(0.2, 0.8, (num_objects, 2)) * (width, height)
+    velocities = rng.uniform(-0.005, 0.005, (num_objects, 2)) * (width, height)
+    axes = rng.uniform(0.05, 0.2, (num_objects, 2)) * min(height, width)
+
+    for t in range(num_frames):
+        for obj_id in range(num_objects):
+            center = centers[obj_id] + t * velocities[obj_id]
+            offset = rng.normal(0.0, 0.01 * min(height, width), 2)
+
+            cv2.ellipse(gt[t], (tuple(center.astype(int).tolist()), tuple(axes[obj_id].astype(int).tolist()), 0.0),
+                        obj_id + 1, -1)
+            cv2.ellipse(pred[t], (tuple((center + offset).astype(int).tolist()), tuple(axes[obj_id].astype(int).tolist()), 0.0),
+                        obj_id + 1, -1)
+
+    if noise:
+        noisy = rng.uniform(size=pred.shape) < noise
+        pred[noisy] = rng.randint(0, num_objects + 1, size=noisy.sum())
+    return gt, pred
+
+
+def per_frame_f(eval_func, gt, pred, num_objects):
+    return np.array([[eval_func(gt[t] == obj_id, pred[t] == obj_id)
+                      for obj_id in range(1, num_objects + 1)]
+                     for t in range(gt.shape[0])])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_frames', type=int, default=50)
+    parser.add_argument('--num_objects', type=int, default=3)
+    parser.add_argument('--chunk_size', type=int, default=8)
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--noise', type=float, nargs='+', default=[0.0, 0.01, 0.05])
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    for (res_name, (height, width)), noise in product(RESOLUTIONS.items(), args.noise):
+        gt, pred = synthetic_sequence(args.num_frames, args.num_objects, height, width, seed=0, noise=noise)
+        num_evals = args.num_frames * args.num_objects
+
+        start = timeit.default_timer()
+        f_per_frame = per_frame_f(db_eval_boundary, gt, pred, args.num_objects)
+        per_frame_time = timeit.default_timer() - start
+
+        start = timeit.default_timer()
+        f_batched = np.concatenate([
+            eval_label_maps(torch.from_numpy(gt[t:t + args.chunk_size]).to(args.device),
+                            torch.from_numpy(pred[t:t + args.chunk_size]).to(args.device),
+                            args.num_objects, measures=('F',))['F']
+            for t in range(0, args.num_frames, args.chunk_size)])
+        batched_time = timeit.default_timer() - start
+
+        # repeated evaluations only compute the prediction side
+        ground_truth = SequenceGroundTruth(range(args.num_frames), torch.from_numpy(gt).to(args.device),
+                                           True, args.num_objects)
+        start = timeit.default_timer()
+        f_cached = np.concatenate([
+            ground_truth.eval_frames(list(range(t, min(t + args.chunk_size, args.num_frames))),
+                                     torch.from_numpy(pred[t:t + args.chunk_size]).to(args.device),
+                                     measures=('F',))['F']
+            for t in range(0, args.num_frames, args.chunk_size)])
+        cached_time = timeit.default_timer() - start
+
+        assert np.allclose(f_per_frame, f_batched, atol=1e-6), \
+            f"max abs diff {np.abs(f_per_frame - f_batched).max()}"
+        assert np.allclose(f_per_frame, f_cached, atol=1e-6), \
+            f"max abs diff {np.abs(f_per_frame - f_cached).max()}"
+
+        print(f"{res_name} ({height}x{width}), {noise:.0%} noise, {num_evals} masks:")
+        print(f"  per frame: {1000 * per_frame_time / num_evals:.2f} ms/mask")
+        print(f"  batched:   {1000 * batched_time / num_evals:.2f} ms/mask "
+              f"({per_frame_time / batched_time:.1f}x)")
+        print(f"  cached gt: {1000 * cached_time / num_evals:.2f} ms/mask "
+              f"({per_frame_time / cached_time:.1f}x)")
+
+        if davis_db_eval_boundary is not None:
+            start = timeit.default_timer()
+            f_davis = per_frame_f(davis_db_eval_boundary, gt, pred, args.num_objects)
+            davis_time = timeit.default_timer() - start
+
+            assert np.allclose(f_davis, f_batched, atol=1e-6), \
+                f"max abs diff to davis {np.abs(f_davis - f_batched).max()}"
+            print(f"  davis:     {1000 * davis_time / num_evals:.2f} ms/mask")
+
+
+if __name__ == '__main__':
+    main()
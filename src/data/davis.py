@@ -5,8 +5,6 @@ import cv2
 import re
 from collections import OrderedDict
 
-from davis import cfg as eval_cfg
-
 from .helpers import listdir_nohidden
 from .vos_dataset import VOSDataset
 
@@ -76,27 +74,6 @@ class DAVIS(VOSDataset):
         else:
             self.set_seq(self.seqs_key)
 
-        self.setup_davis_eval()
-
-    def setup_davis_eval(self):
-        eval_cfg.MULTIOBJECT = bool(self.multi_object)
-        if self.year == 2016:
-            eval_cfg.MULTIOBJECT = False
-        if self._full_resolution:
-            if self.year == 2016:
-                eval_cfg.RESOLUTION = '1080p'
-            else:
-                eval_cfg.RESOLUTION = 'Full-Resolution'
-        if self.test_mode:
-            eval_cfg.PHASE = 'test-dev'
-        eval_cfg.YEAR = self.year
-        eval_cfg.PATH.ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
-        eval_cfg.PATH.DATA = os.path.abspath(os.path.join(eval_cfg.PATH.ROOT, self.root_dir))
-        eval_cfg.PATH.SEQUENCES = os.path.join(eval_cfg.PATH.DATA, "JPEGImages", eval_cfg.RESOLUTION)
-        eval_cfg.PATH.ANNOTATIONS = os.path.join(eval_cfg.PATH.DATA, "Annotations", eval_cfg.RESOLUTION)
-        eval_cfg.PATH.PALETTE = os.path.abspath(os.path.join(eval_cfg.PATH.ROOT, 'data/palette.txt'))
-
-    def resetup_davis_eval(self):
-        self.setup_davis_eval()
-        eval_cfg.SEQUENCES = {n: {'name': n, 'attributes': [], 'set': 'train', 'eval_t': False, 'year': 2017, 'num_frames': len(set(v['labels']))}
-                              for n, v in self.seqs.items()}
+    @property
+    def eval_multi_object(self):
+        return bool(self.multi_object) and self.year != 2016
@@ -1,3 +1,4 @@
+import contextlib
 import os
 import random
 import numpy as np
@@ -43,6 +44,8 @@ class VOSDataset(Dataset):
         self.sub_group_ids = None
         self.all_frames = False
         self.propagate_frame_gt = None
+        # optional util.stage_timer.StageTimer of the decode and augmentation
+        self.stage_timer = None
 
     @property
     def num_seqs(self):
@@ -69,6 +72,16 @@ class VOSDataset(Dataset):
 
         return self._num_objects
 
+    @property
+    def eval_multi_object(self):
+        """Whether J and F are evaluated per object or on the binary foreground."""
+        return bool(self.multi_object)
+
+    @property
+    def eval_num_objects(self):
+        """Number of evaluated objects. If None derived from the first ground truth frame."""
+        return None
+
     @property
     def num_object_groups(self):
         if self.multi_object == 'all':
@@ -192,7 +205,8 @@ class VOSDataset(Dataset):
             else:
                 idx = self.frame_id
 
-        img, label = self.make_img_label_pair(idx)
+        with self._stage('decode'):
+            img, label = self.make_img_label_pair(idx)
 
         if self.flip_label:
             label = np.logical_not(label).astype(np.float32)
@@ -208,10 +222,16 @@ class VOSDataset(Dataset):
                   'file_name': os.path.splitext(os.path.basename(self.imgs[idx]))[0]}
 
         if self.transform is not None:
-            sample = self.transform(sample)
+            with self._stage('augmentation'):
+                sample = self.transform(sample)
 
         return sample
 
+    def _stage(self, name):
+        if self.stage_timer is None:
+            return contextlib.nullcontext()
+        return self.stage_timer.stage(name)
+
     def get_img_size(self):
         img = cv2.imread(os.path.join(self.root_dir, self.imgs[0]))
 
@@ -8,8 +8,6 @@ import cv2
 import numpy as np
 import torch
 
-from davis import cfg as eval_cfg
-
 from .helpers import listdir_nohidden
 from .vos_dataset import VOSDataset
 
@@ -92,8 +90,6 @@ class YouTube(VOSDataset):
             self.imgs = imgs
             self.labels = labels
 
-            self.setup_davis_eval()
-
     def get_random_frame_id(self):
         if self.random_frame_id_epsilon is not None:
             random_frame_id_epsilon = self.random_frame_id_epsilon
@@ -126,7 +122,9 @@ class YouTube(VOSDataset):
         self._multi_object_id_to_label = [
             int(k) for k in sorted(self._meta_data['videos'][self.seq_key]['objects'].keys())]
 
-        eval_cfg.NUM_OBJECTS = self.num_object_groups
+    @property
+    def eval_num_objects(self):
+        return self.num_object_groups
 
     def get_gt_frame_id(self, multi_object_id):
         objects_info = self._meta_data['videos'][self.seq_key]['objects']
@@ -184,21 +182,6 @@ class YouTube(VOSDataset):
         else:
             self.frame_id, self._label_id = self.get_gt_frame_id(self.multi_object_id)
 
-    def setup_davis_eval(self):
-        eval_cfg.MULTIOBJECT = bool(self.multi_object)
-        eval_cfg.YEAR = 2017
-        eval_cfg.PATH.ROOT = os.path.abspath(
-            os.path.join(os.path.dirname(__file__), '../..'))
-        eval_cfg.PATH.DATA = os.path.abspath(
-            os.path.join(eval_cfg.PATH.ROOT, self.root_dir, self._split))
-        eval_cfg.PATH.SEQUENCES = os.path.join(
-            eval_cfg.PATH.DATA, "JPEGImages")
-        eval_cfg.PATH.ANNOTATIONS = os.path.join(
-            eval_cfg.PATH.DATA, "Annotations")
-
-        eval_cfg.SEQUENCES = {n: {'name': n, 'attributes': [], 'set': 'train', 'eval_t': False, 'year': 2017, 'num_frames': len(set(v['labels']))}
-                              for n, v in self.seqs.items()}
-
     def __deepcopy__(self, memo):
         copy_obj = type(self)(self.seqs_key, self.root_dir, deepcopy=True)
 
@@ -0,0 +1,159 @@
+"""
+Generates synthetic multi-object sequences of moving textured shapes in the
+DAVIS 2017 directory layout with train_seqs.txt and val_seqs.txt split files.
+
+python src/generate_synthetic_davis.py --num_seqs 6 --num_frames 30 --num_objects 2
+"""
+import argparse
+import os
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+def davis_palette():
+    """Color palette of the DAVIS annotations."""
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    for label in range(256):
+        c = label
+        for j in range(8):
+            palette[label, 0] |= ((c >> 0) & 1) << (7 - j)
+            palette[label, 1] |= ((c >> 1) & 1) << (7 - j)
+            palette[label, 2] |= ((c >> 2) & 1) << (7 - j)
+            c >>= 3
+    return palette.flatten().tolist()
+
+
+def texture(rng, height, width, cell_size):
+    """Smooth random color texture."""
+    grid = rng.uniform(0, 255, (height // cell_size + 2, width // cell_size + 2, 3))
+    grid = cv2.resize(grid.astype(np.float32), (width, height), interpolation=cv2.INTER_CUBIC)
+    noise = rng.normal(0.0, 8.0, (height, width, 3))
+    return np.clip(grid + noise, 0, 255).astype(np.uint8)
+
+
+def shape_mask(shape, center, size, angle, height, width):
+    mask = np.zeros((height, width), dtype=np.uint8)
+    center = tuple(np.round(center).astype(int).tolist())
+    size = tuple(np.round(size).astype(int).tolist())
+    if shape == 'ellipse':
+        cv2.ellipse(mask, (center, size, angle), 1, -1)
+    else:
+        box = cv2.boxPoints((center, (2 * size[0], 2 * size[1]), angle))
+        cv2.fillPoly(mask, [np.round(box).astype(np.int32)], 1)
+    return mask.astype(bool)
+
+
+def synthetic_sequence(num_frames, num_objects, height, width, seed):
+    """
+    Frames [T, H, W, 3] and label maps [T, H, W] of textured shapes which
+    move, rotate and scale over a panning textured background. Objects with
+    a higher id occlude the others.
+    """
+    rng = np.random.RandomState(seed)
+
+    margin = 0.1 * width
+    background = texture(rng, height, int(width + 2 * margin), 64)
+    pan = rng.uniform(-margin, margin) / max(num_frames - 1, 1)
+
+    objects = []
+    for _ in range(num_objects):
+        size = rng.uniform(0.08, 0.18, 2) * min(height, width)
+        objects.append({'shape': rng.choice(['ellipse', 'rectangle']),
+                        'texture': texture(rng, height, width, 16),
+                        'center': rng.uniform(0.25, 0.75, 2) * (width, height),
+                        'velocity': rng.uniform(-0.01, 0.01, 2) * (width, height),
+                        'size': size,
+                        'scale_velocity': rng.uniform(-0.005, 0.005),
+                        'angle': rng.uniform(0, 180),
+                        'angular_velocity': rng.uniform(-3, 3)})
+
+    frames = np.zeros((num_frames, height, width, 3), dtype=np.uint8)
+    labels = np.zeros((num_frames, height, width), dtype=np.uint8)
+    for t in range(num_frames):
+        offset = int(round(margin + t * pan))
+        frames[t] = background[:, offset:offset + width]
+
+        for obj_id, obj in enumerate(objects, start=1):
+            # objects bounce off the image borders
+            for i, bound in enumerate([width, height]):
+                if not 0 < obj['center'][i] + obj['velocity'][i] < bound:
+                    obj['velocity'][i] *= -1
+            obj['center'] = obj['center'] + obj['velocity']
+            obj['angle'] += obj['angular_velocity']
+            scale = max(0.5, 1.0 + t * obj['scale_velocity'])
+
+            mask = shape_mask(obj['shape'], obj['center'], scale * obj['size'], obj['angle'],
+                              height, width)
+            frames[t][mask] = obj['texture'][mask]
+            labels[t][mask] = obj_id
+
+    return frames, labels
+
+
+def write_sequence(root_dir, seq_name, frames, labels, palette):
+    img_dir = os.path.join(root_dir, 'JPEGImages', '480p', seq_name)
+    label_dir = os.path.join(root_dir, 'Annotations', '480p', seq_name)
+    os.makedirs(img_dir, exist_ok=True)
+    os.makedirs(label_dir, exist_ok=True)
+
+    for t, (frame, label) in enumerate(zip(frames, labels)):
+        cv2.imwrite(os.path.join(img_dir, f"{t:05d}.jpg"), frame[..., ::-1])
+
+        # L to P keeps the pixel values as palette indices
+        label = Image.fromarray(label.astype(np.uint8)).convert('P')
+        label.putpalette(palette)
+        label.save(os.path.join(label_dir, f"{t:05d}.png"))
+
+
+def generate(root_dir, num_seqs, num_val_seqs, num_frames, num_objects, height, width, seed,
+             max_attempts=100):
+    palette = davis_palette()
+
+    seq_names = [f"synthetic-{i:03d}" for i in range(num_seqs)]
+    for i, seq_name in enumerate(seq_names):
+        # all objects must be visible in the first frame
+        seq_seed = seed + i
+        frames, labels = synthetic_sequence(num_frames, num_objects, height, width, seq_seed)
+        num_attempts = 1
+        while len(np.unique(labels[0])) != num_objects + 1:
+            if num_attempts == max_attempts:
+                raise ValueError(f"No first frame with all {num_objects} objects visible at "
+                                 f"{height}x{width} after {max_attempts} attempts. Reduce "
+                                 f"num_objects or increase the resolution.")
+            seq_seed += num_seqs
+            frames, labels = synthetic_sequence(num_frames, num_objects, height, width, seq_seed)
+            num_attempts += 1
+        write_sequence(root_dir, seq_name, frames, labels, palette)
+
+    splits = {'train_seqs': seq_names[num_val_seqs:],
+              'val_seqs': seq_names[:num_val_seqs]}
+    for split, split_seq_names in splits.items():
+        with open(os.path.join(root_dir, f"{split}.txt"), 'w') as f:
+            f.writelines([f"{s}\n" for s in split_seq_names])
+
+    return splits
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    # the DAVIS dataset derives the year from the digits of the directory name
+    parser.add_argument('--root_dir', type=str, default='data/Synthetic-DAVIS-2017')
+    parser.add_argument('--num_seqs', type=int, default=6)
+    parser.add_argument('--num_val_seqs', type=int, default=3)
+    parser.add_argument('--num_frames', type=int, default=30)
+    parser.add_argument('--num_objects', type=int, default=2)
+    parser.add_argument('--height', type=int, default=240)
+    parser.add_argument('--width', type=int, default=427)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    splits = generate(args.root_dir, args.num_seqs, args.num_val_seqs, args.num_frames,
+                      args.num_objects, args.height, args.width, args.seed)
+
+    print(f"{args.root_dir}: {', '.join([f'{len(s)} {n}' for n, s in splits.items()])}")
+
+
+if __name__ == '__main__':
+    main()
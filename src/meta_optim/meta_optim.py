@@ -22,6 +22,8 @@ class MetaOptimizer(nn.Module):
         self._use_log_init_lr = use_log_init_lr
         self._max_lr = max_lr
         self._lr_hierarchy_level = lr_hierarchy_level
+        # norm of the last step gradients in state["grad_norm"]
+        self.track_grad_norm = False
 
         self.meta_model = MetaModel(model)
 
@@ -203,6 +205,10 @@ class MetaOptimizer(nn.Module):
                                                     [p for p in self.meta_model.model.parameters()
                                                      if p.requires_grad])
 
+        if self.track_grad_norm:
+            self.state["grad_norm"] = torch.stack([grad.detach().norm()
+                                                   for grad in param_group_grads]).norm()
+
         param_group_step = [grad.to(lr.device) * lr
                             for lr, grad in zip(state_lr, param_group_grads)]
 
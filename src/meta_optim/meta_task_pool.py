@@ -0,0 +1,153 @@
+import queue
+import timeit
+from collections import deque
+
+import torch
+import torch.multiprocessing as mp
+
+from util.helper_func import set_random_seeds
+
+
+def prepare_task(meta_task_set, idx):
+    """
+    Builds the meta task with index idx and runs its train and meta loaders
+    once. The per task transforms are deterministic, i.e., the decoded and
+    augmented batches are identical for all fine-tuning epochs. Random train
+    transforms draw a new batch every epoch. Their train loader is returned
+    instead of a train batch.
+    """
+    task = meta_task_set[idx]
+    train_loader = task['train_loader']
+    meta_loader = task['meta_loader']
+
+    meta_batches = [{'image': b['image'], 'gt': b['gt']} for b in meta_loader]
+
+    prepared_task = {'seq_name': task['seq_name'],
+                     'box_coord_perm': task['box_coord_perm'],
+                     'flip_label': train_loader.dataset.flip_label,
+                     'train_loader': None,
+                     'train_batch': None,
+                     'meta_batches': meta_batches}
+
+    if task['random_train_transform']:
+        prepared_task['train_loader'] = train_loader
+    else:
+        train_batch = next(iter(train_loader))
+        prepared_task['train_batch'] = {'image': train_batch['image'], 'gt': train_batch['gt']}
+    return prepared_task
+
+
+def _produce_tasks(meta_task_set, seed, index_queue, task_queue):
+    mp.set_sharing_strategy('file_system')
+    torch.set_num_threads(1)
+
+    while True:
+        item = index_queue.get()
+        if item is None:
+            break
+
+        pos, idx = item
+        # seed per schedule position to make tasks independent of the producer
+        set_random_seeds(seed + pos)
+        task_queue.put((pos, prepare_task(meta_task_set, idx)))
+
+
+class MetaTaskPool:
+    """
+    Pool of producer processes which prepare meta tasks ahead of time.
+
+    Task indices are scheduled with extend() and returned by get() in the
+    same order. At most queue_depth + num_producers tasks are in flight.
+    With num_producers=0 tasks are prepared synchronously by get().
+    """
+
+    def __init__(self, meta_task_set, seed, num_producers, queue_depth):
+        self._meta_task_set = meta_task_set
+        self._seed = seed
+        self._num_producers = num_producers
+        self._queue_depth = queue_depth
+        self._max_in_flight = queue_depth + num_producers
+
+        self._pending = deque()
+        self._ready = {}
+        self._next_put_pos = 0
+        self._next_get_pos = 0
+
+        self._producers = []
+        self._index_queue = None
+        self._task_queue = None
+
+        self.wait_time = 0.0
+        self.num_tasks = 0
+
+    def __len__(self):
+        return len(self._meta_task_set)
+
+    def start(self):
+        if not self._num_producers:
+            return
+
+        ctx = mp.get_context('spawn')
+        self._index_queue = ctx.Queue()
+        self._task_queue = ctx.Queue(maxsize=self._queue_depth)
+
+        for producer_id in range(self._num_producers):
+            producer = ctx.Process(
+                target=_produce_tasks,
+                args=(self._meta_task_set, self._seed,
+                      self._index_queue, self._task_queue),
+                daemon=True)
+            producer.start()
+            self._producers.append(producer)
+
+    def close(self):
+        for _ in self._producers:
+            self._index_queue.put(None)
+        for producer in self._producers:
+            producer.join(timeout=5.0)
+            if producer.is_alive():
+                producer.terminate()
+        self._producers = []
+
+    def extend(self, task_ids):
+        self._pending.extend(task_ids)
+        self._fill()
+
+    def _fill(self):
+        if not self._num_producers:
+            return
+
+        while self._pending and self._next_put_pos - self._next_get_pos < self._max_in_flight:
+            self._index_queue.put((self._next_put_pos, self._pending.popleft()))
+            self._next_put_pos += 1
+
+    def get(self):
+        start_wait = timeit.default_timer()
+
+        if not self._num_producers:
+            assert self._pending, 'No meta tasks scheduled.'
+            set_random_seeds(self._seed + self._next_get_pos)
+            task = prepare_task(self._meta_task_set, self._pending.popleft())
+        else:
+            self._fill()
+            assert self._next_get_pos < self._next_put_pos, 'No meta tasks scheduled.'
+
+            # producers finish out of order. drain the queue while waiting to
+            # not block producers on a full queue.
+            while self._next_get_pos not in self._ready:
+                try:
+                    pos, task = self._task_queue.get(timeout=60.0)
+                except queue.Empty:
+                    if not all(p.is_alive() for p in self._producers):
+                        raise RuntimeError('Meta task producer died.')
+                    continue
+                self._ready[pos] = task
+            task = self._ready.pop(self._next_get_pos)
+
+        self._next_get_pos += 1
+        self.num_tasks += 1
+        self.wait_time += timeit.default_timer() - start_wait
+
+        self._fill()
+
+        return task
@@ -0,0 +1,88 @@
+import torch
+
+
+class MetaTaskScheduler:
+    """
+    Shards the meta tasks of each meta epoch across all meta processes.
+
+    Every task is run exactly once per meta epoch. With multiple nodes each
+    node plans a disjoint shard of the same permutation. The shards are
+    padded with repeated tasks to equal length. Meta batches are drawn
+    randomly and each meta batch is split among the processes by longest
+    processing time first with per sequence cost estimates. The estimates
+    are exponential moving averages of the observed task run times.
+    """
+
+    def __init__(self, task_keys: list, meta_batch_size: int,
+                 num_processes: int, seed: int, cost_momentum: float = 0.8,
+                 num_nodes: int = 1, node_rank: int = 0):
+        self._task_keys = task_keys
+        self._num_nodes = num_nodes
+        self._node_rank = node_rank
+        self._meta_batch_size = meta_batch_size
+        self._num_processes = num_processes
+        self._seed = seed
+        self._cost_momentum = cost_momentum
+
+        self.costs = {}
+        self.epoch_iter = 0
+
+    def __len__(self):
+        # number of tasks per node. shards are padded to equal length.
+        return -(-len(self._task_keys) // self._num_nodes)
+
+    def num_iters_per_epoch(self):
+        return -(-len(self) // self._meta_batch_size)
+
+    def task_cost(self, task_id):
+        key = self._task_keys[task_id]
+        if key in self.costs:
+            return self.costs[key]
+        # unseen sequences are assumed to be of average cost
+        if self.costs:
+            return sum(self.costs.values()) / len(self.costs)
+        return 1.0
+
+    def plan_epoch(self, meta_epoch: int):
+        """
+        Returns a plan per process. plans[rank][i] contains the task ids
+        process rank runs in the i-th meta iteration of the epoch. Iterations
+        before epoch_iter were already run, e.g., before a resume.
+        """
+        generator = torch.Generator()
+        generator.manual_seed(self._seed + meta_epoch)
+        task_ids = torch.randperm(len(self._task_keys), generator=generator).tolist()
+        task_ids += task_ids[:len(self) * self._num_nodes - len(task_ids)]
+        task_ids = task_ids[self._node_rank::self._num_nodes]
+
+        plans = [[] for _ in range(self._num_processes)]
+        for i in range(0, len(task_ids), self._meta_batch_size):
+            meta_batch = task_ids[i:i + self._meta_batch_size]
+
+            loads = [0.0] * self._num_processes
+            sub_meta_batches = [[] for _ in range(self._num_processes)]
+            for task_id in sorted(meta_batch, key=self.task_cost, reverse=True):
+                rank = min(range(self._num_processes),
+                           key=lambda r: (loads[r], len(sub_meta_batches[r])))
+                sub_meta_batches[rank].append(task_id)
+                loads[rank] += self.task_cost(task_id)
+
+            for plan, sub_meta_batch in zip(plans, sub_meta_batches):
+                plan.append(sub_meta_batch)
+
+        return [plan[self.epoch_iter:] for plan in plans]
+
+    def update(self, task_timings: list):
+        for key, run_time in task_timings:
+            if key in self.costs:
+                self.costs[key] = self._cost_momentum * self.costs[key] \
+                    + (1.0 - self._cost_momentum) * run_time
+            else:
+                self.costs[key] = run_time
+
+    def state_dict(self):
+        return {'costs': dict(self.costs), 'epoch_iter': self.epoch_iter}
+
+    def load_state_dict(self, state_dict):
+        self.costs = dict(state_dict['costs'])
+        self.epoch_iter = state_dict['epoch_iter']
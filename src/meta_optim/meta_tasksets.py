@@ -152,4 +152,5 @@ class MetaTaskset(Dataset):
         return {'seq_name': seq_name,
                 'box_coord_perm': box_coord_perm,
                 'train_loader': train_loader,
-                'meta_loader': meta_loader}
+                'meta_loader': meta_loader,
+                'random_train_transform': self.data_cfg['random_train_transform']}
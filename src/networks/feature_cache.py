@@ -0,0 +1,59 @@
+from collections import OrderedDict
+
+import torch
+
+
+class FeatureCache:
+    """
+    LRU cache of the FPN outputs of a frozen backbone.
+
+    Entries are looked up by the size the inputs are resized to, i.e., the
+    transform parameters, and by comparing the input images on their device
+    without copies to the host. Repeated fine-tuning iterations on the same
+    inputs only run the heads.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._features = []
+
+    def get(self, inputs: torch.Tensor, image_size: tuple):
+        image_size = tuple(image_size)
+        for i, (entry_inputs, entry_image_size, features) in enumerate(self._features):
+            if (entry_image_size == image_size
+                    and entry_inputs.shape == inputs.shape
+                    and entry_inputs.device == inputs.device
+                    and torch.equal(entry_inputs, inputs)):
+                self.hits += 1
+                self._features.append(self._features.pop(i))
+                return features
+
+        self.misses += 1
+        return None
+
+    def put(self, inputs: torch.Tensor, image_size: tuple, features: OrderedDict):
+        # the inputs might be modified in-place by the caller
+        self._features.append((inputs.detach().clone(), tuple(image_size), features))
+        while len(self._features) > self.max_size:
+            self._features.pop(0)
+
+    def clear(self):
+        self._features = []
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+
+def hit_rate(stats: list):
+    """Hit rate of the summed stats of multiple caches or None without lookups."""
+    hits = sum([s['hits'] for s in stats])
+    lookups = hits + sum([s['misses'] for s in stats])
+    if not lookups:
+        return None
+    return hits / lookups
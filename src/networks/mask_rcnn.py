@@ -1,7 +1,8 @@
+import contextlib
+import math
 import types
 from collections import OrderedDict
 
-import numpy as np
 import torch
 from torch import nn
 from torch.nn import functional as F
@@ -13,11 +14,14 @@ from torchvision.models.detection.roi_heads import (fastrcnn_loss,
                                                     maskrcnn_inference,
                                                     project_masks_on_boxes)
 from torchvision.models.detection.rpn import concat_box_prediction_layers
+from torchvision.models.detection.transform import resize_boxes
 from torchvision.models.utils import load_state_dict_from_url
 from torchvision.ops import MultiScaleRoIAlign
 from torchvision.ops import boxes as box_ops
 from torchvision.ops.misc import FrozenBatchNorm2d
 
+from .feature_cache import FeatureCache
+from .target_cache import TargetCache
 from .loss_lovasz import lovasz_hinge
 
 
@@ -214,6 +218,40 @@ def roi_heads_forward(self, features, proposals, image_shapes, targets=None, box
     return result, losses
 
 
+def masks_to_boxes(masks):
+    """
+    [K, 4] boxes of the [K, H, W] binary masks computed on their device.
+    Empty masks have zero boxes.
+    """
+    height, width = masks.shape[-2:]
+    masks = masks.float()
+    rows = masks.sum(dim=2).gt(0).float()
+    cols = masks.sum(dim=1).gt(0).float()
+    ys = torch.arange(height, dtype=torch.float, device=masks.device)
+    xs = torch.arange(width, dtype=torch.float, device=masks.device)
+
+    boxes = torch.stack([(xs + (1.0 - cols) * width).min(dim=1)[0],
+                         (ys + (1.0 - rows) * height).min(dim=1)[0],
+                         (xs * cols).max(dim=1)[0] + 1.0,
+                         (ys * rows).max(dim=1)[0] + 1.0], dim=1)
+    return boxes * rows.max(dim=1, keepdim=True)[0]
+
+
+def jitter_boxes(boxes, num_augs, random_share, img_height, img_width):
+    """
+    [K * num_augs, 4] boxes randomly enlarged by up to random_share of their
+    size on every side and clamped to the image. Generated on the device of
+    the [K, 4] boxes.
+    """
+    box_sizes = (boxes[:, 2:] - boxes[:, :2]).repeat(1, 2)
+    directions = boxes.new_tensor([-1.0, -1.0, 1.0, 1.0])
+    max_coords = boxes.new_tensor([img_width, img_height, img_width, img_height])
+
+    jitter = torch.rand((len(boxes), num_augs, 4), dtype=boxes.dtype, device=boxes.device)
+    box_augs = boxes[:, None] + jitter * box_sizes[:, None] * random_share * directions
+    return torch.min(box_augs.clamp(min=0), max_coords).view(-1, 4)
+
+
 def rpn_forward(self, images, features, targets=None):
     """
     Arguments:
@@ -257,70 +295,17 @@ def rpn_forward(self, images, features, targets=None):
             num_box_augs = self.post_nms_top_n // 2
 
         for i, target in enumerate(targets):
-            img = images.tensors[i]
-            img_height, img_width = img.shape[-2:]
-
-            target_boxes = []
-            # for box in boxes_width_height:
-            for box in target['boxes']:
-                # if self.augment_target_proposals:
-                box_width, box_height = box[2] - box[0], box[3] - box[1]
-
-                # if self._eval_augment_proposals_mode == 'EXTEND':
-                random_x_mins = box[0] - torch.rand((num_box_augs,)) * box_width * random_share
-                random_y_mins = box[1] - torch.rand((num_box_augs,)) * box_height * random_share
-                random_x_maxs = box[2] + torch.rand((num_box_augs,)) * box_width * random_share
-                random_y_maxs = box[3] + torch.rand((num_box_augs,)) * box_height * random_share
-                # elif self._eval_augment_proposals_mode == 'REPLACE':
-                #     random_x_mins = box[0] - torch.ones((1,)) * box_width * 0.2
-                #     random_y_mins = box[1] - torch.ones((1,)) * box_height * 0.2
-                #     random_x_maxs = box[2] + torch.ones((1,)) * box_width * 0.2
-                #     random_y_maxs = box[3] + torch.ones((1,)) * box_height * 0.2
-
-                box_augs = torch.stack([random_x_mins.clamp(0, img_width),
-                                        random_y_mins.clamp(0, img_height),
-                                        random_x_maxs.clamp(0, img_width),
-                                        random_y_maxs.clamp(0, img_height)], dim=1)
-
-                # import numpy as np
-                # import matplotlib.pyplot as plt
-                # fig = plt.figure()
-                # ax = plt.Axes(fig, [0., 0., 1., 1.])
-                # ax.set_axis_off()
-                # fig.add_axes(ax)
-                #
-                # # ax.imshow(images[i], cmap='jet', vmin=0, vmax=test_loader.dataset.num_objects)
-                # ax.imshow(np.transpose(images.tensors[i].mul(255).cpu().numpy(), (1, 2, 0)).astype(np.uint8))
-                #
-                # ax.add_patch(
-                #     plt.Rectangle(
-                #         (box[0].item(), box[1].item()),
-                #         box[2].item() - box[0].item(),
-                #         box[3].item() - box[1].item(),
-                #         fill=False,
-                #         linewidth=2.0,
-                #     ))
-                # for box_a in box_augs:
-                #     ax.add_patch(
-                #         plt.Rectangle(
-                #             (box_a[0].item(), box_a[1].item()),
-                #             box_a[2].item() - box_a[0].item(),
-                #             box_a[3].item() - box_a[1].item(),
-                #             fill=False,
-                #             linewidth=1.0,
-                #         ))
-                #
-                # plt.axis('off')
-                # # plt.tight_layout()
-                # plt.draw()
-                # plt.savefig('box_augs.png', dpi=100)
-                # plt.close()
-                # exit()
-
-                target_boxes.append(box_augs)
-
-            target_boxes = torch.cat(target_boxes, dim=0)
-            target_boxes = target_boxes.to(scores[0].device)
+            img_height, img_width = images.tensors[i].shape[-2:]
+
+            # all target boxes share eval_augment_proposals_num jittered boxes. otherwise
+            # every target box gets num_box_augs.
+            num_target_boxes = len(target['boxes'])
+            num_augs_per_box = num_box_augs
+            if self._eval_augment_proposals_num is not None:
+                num_augs_per_box = max(1, self._eval_augment_proposals_num // max(1, num_target_boxes))
+
+            target_boxes = jitter_boxes(target['boxes'].to(scores[0].device), num_augs_per_box,
+                                        random_share, img_height, img_width)
 
             if self._eval_augment_proposals_mode == 'EXTEND':
                 boxes[i] = torch.cat([boxes[i][:self.post_nms_top_n // 2], target_boxes], dim=0)
@@ -345,87 +330,72 @@ def rpn_forward(self, images, features, targets=None):
 
 
 def postprocess_detections(self, class_logits, box_regression, proposals, image_shapes):
+    """Filters the detections of all images at once."""
     device = class_logits.device
     num_classes = class_logits.shape[-1]
+    num_images = len(proposals)
 
     boxes_per_image = [len(boxes_in_image) for boxes_in_image in proposals]
     pred_boxes = self.box_coder.decode(box_regression, proposals)
 
     pred_scores = F.softmax(class_logits, -1)
 
-    # split boxes and scores per image
-    pred_boxes = pred_boxes.split(boxes_per_image, 0)
-    pred_scores = pred_scores.split(boxes_per_image, 0)
-
-    all_boxes = []
-    all_scores = []
-    all_labels = []
-    for boxes, scores, image_shape in zip(pred_boxes, pred_scores, image_shapes):
-        boxes = box_ops.clip_boxes_to_image(boxes, image_shape)
-        # print(self.training, boxes.shape)
-
-        # create labels for each prediction
-        labels = torch.arange(num_classes, device=device)
-        labels = labels.view(1, -1).expand_as(scores)
-
-        # remove predictions with the background label
-        boxes = boxes[:, 1:]
-        scores = scores[:, 1:]
-        labels = labels[:, 1:]
-
-        # batch everything, by making every class prediction be a separate instance
-        boxes = boxes.reshape(-1, 4)
-        scores = scores.flatten()
-        labels = labels.flatten()
-
-        orig_inds = torch.arange(boxes.shape[0])
-
-        # remove low scoring boxes
-        inds = torch.nonzero(scores > self.score_thresh).squeeze(1)
-        boxes, scores, labels, orig_inds = boxes[inds], scores[inds], labels[inds], orig_inds[inds]
-
-        # remove empty boxes
-        keep = box_ops.remove_small_boxes(boxes, min_size=1e-2)
-        boxes, scores, labels, orig_inds = boxes[keep], scores[keep], labels[keep], orig_inds[keep]
-
-        # non-maximum suppression, independently done per class
-        keep = box_ops.batched_nms(boxes, scores, labels, self.nms_thresh)
-        # keep only topk scoring predictions
-
-        # if self._eval_augment_proposals_mode == 'EXTEND':
-        #     assert self.detections_per_img == 1
-
-        #     use_local = False
-        #     for i, orig_ind in enumerate(orig_inds[keep]):
-        #         if orig_ind >= 500:
-        #             print(orig_ind)
-        #             keep = keep[i:i + self.detections_per_img]
-        #             use_local = True
-        #             break
-
-        #     if not use_local:
-        #         print('not local')
-        #         keep = keep[:self.detections_per_img]
-        # else:
-        #    keep = keep[:self.detections_per_img]
+    image_ids = torch.repeat_interleave(torch.arange(num_images, device=device),
+                                        torch.tensor(boxes_per_image, device=device))
+
+    # clip the boxes to their image
+    image_sizes = torch.tensor(image_shapes, dtype=pred_boxes.dtype, device=device)
+    max_coords = image_sizes[:, [1, 0, 1, 0]][image_ids]
+    pred_boxes = torch.min(pred_boxes.clamp(min=0), max_coords[:, None])
+
+    # create labels for each prediction
+    labels = torch.arange(num_classes, device=device)
+    labels = labels.view(1, -1).expand_as(pred_scores)
+    image_ids = image_ids.view(-1, 1).expand_as(pred_scores)
+
+    # remove predictions with the background label and batch everything, by
+    # making every class prediction be a separate instance
+    boxes = pred_boxes[:, 1:].reshape(-1, 4)
+    scores = pred_scores[:, 1:].flatten()
+    labels = labels[:, 1:].flatten()
+    image_ids = image_ids[:, 1:].flatten()
 
-        keep = keep[:self.detections_per_img]
+    # remove low scoring boxes
+    inds = torch.nonzero(scores > self.score_thresh).squeeze(1)
+    boxes, scores, labels, image_ids = boxes[inds], scores[inds], labels[inds], image_ids[inds]
 
-        boxes, scores, labels = boxes[keep], scores[keep], labels[keep]
+    # remove empty boxes
+    keep = box_ops.remove_small_boxes(boxes, min_size=1e-2)
+    boxes, scores, labels, image_ids = boxes[keep], scores[keep], labels[keep], image_ids[keep]
 
-        all_boxes.append(boxes)
-        all_scores.append(scores)
-        all_labels.append(labels)
+    # non-maximum suppression, independently done per image and class
+    keep = box_ops.batched_nms(boxes, scores, image_ids * num_classes + labels, self.nms_thresh)
 
-    return all_boxes, all_scores, all_labels
+    # keep only topk scoring predictions of every image
+    image_one_hot = (image_ids[keep][:, None] == torch.arange(num_images, device=device)[None]).long()
+    rank = (image_one_hot.cumsum(dim=0) * image_one_hot).sum(dim=1) - 1
+    keep = keep[rank < self.detections_per_img]
+
+    # group by image in the order of the scores
+    order = (image_ids[keep] * len(keep) + torch.arange(len(keep), device=device)).argsort()
+    keep = keep[order]
+
+    boxes_per_image = torch.bincount(image_ids[keep], minlength=num_images).tolist()
+    all_boxes = boxes[keep].split(boxes_per_image, 0)
+    all_scores = scores[keep].split(boxes_per_image, 0)
+    all_labels = labels[keep].split(boxes_per_image, 0)
+
+    return list(all_boxes), list(all_scores), list(all_labels)
 
 
 class MaskRCNN(_MaskRCNN):
 
     def __init__(self, backbone, num_classes, batch_norm=None, train_encoder=True,
                  roi_pool_output_sizes=None, eval_augment_rpn_proposals_mode=None,
+                 eval_augment_rpn_proposals_num=None,
                  replace_batch_with_group_norms=False, box_nms_thresh=0.5,
-                 maskrcnn_loss='LOVASZ'):
+                 maskrcnn_loss='LOVASZ', feature_cache_size=0, transform_sizes=None,
+                 target_cache_size=0):
 
         self._num_groups = 32
         backbone_model = resnet_fpn_backbone(backbone, True)
@@ -453,7 +423,20 @@ class MaskRCNN(_MaskRCNN):
         )
 
         self.num_classes = num_classes
+
+        # min and max image size of the transform in train and eval mode. the train
+        # sizes are scaled by transform_scale, e.g., for low resolution fine-tuning.
+        self._transform_sizes = {}
+        for mode in ['train', 'eval']:
+            sizes = {} if transform_sizes is None else transform_sizes[mode]
+            min_size = sizes.get('min_size')
+            max_size = sizes.get('max_size')
+            self._transform_sizes[mode] = (self.transform.min_size[-1] if min_size is None else min_size,
+                                           self.transform.max_size if max_size is None else max_size)
+        self._transform_scale = 1.0
+
         self.rpn._eval_augment_proposals_mode = eval_augment_rpn_proposals_mode
+        self.rpn._eval_augment_proposals_num = eval_augment_rpn_proposals_num
         self.rpn.forward = types.MethodType(rpn_forward, self.rpn)
 
         self.roi_heads._eval_augment_proposals_mode = eval_augment_rpn_proposals_mode
@@ -509,6 +492,15 @@ class MaskRCNN(_MaskRCNN):
                     m.weight.requires_grad = batch_norm['learn_weight']
                     m.bias.requires_grad = batch_norm['learn_bias']
 
+        # the features of a backbone without trainable parameters are fixed
+        self.feature_cache = None
+        if feature_cache_size and not any([p.requires_grad for p in self.backbone.parameters()]):
+            self.feature_cache = FeatureCache(feature_cache_size)
+
+        self.target_cache = None
+        if target_cache_size:
+            self.target_cache = TargetCache(target_cache_size)
+
         # self._second_order_derivates_module_names = ['rpn', 'roi_heads']
         self._second_order_derivates_module_names = ['roi_heads']
 
@@ -543,8 +535,40 @@ class MaskRCNN(_MaskRCNN):
             if param.requires_grad and not any([module_name in name for module_name in self._second_order_derivates_module_names]):
                 yield name, param
 
+    @property
+    def transform_scale(self):
+        return self._transform_scale
+
+    @transform_scale.setter
+    def transform_scale(self, scale):
+        self._transform_scale = scale
+        self._apply_transform_sizes()
+
+    def _apply_transform_sizes(self):
+        min_size, max_size = self._transform_sizes['train' if self.training else 'eval']
+        if self.training:
+            min_size = int(round(min_size * self._transform_scale))
+            max_size = int(round(max_size * self._transform_scale))
+        self.transform.min_size = (min_size,)
+        self.transform.max_size = max_size
+
+    @contextlib.contextmanager
+    def crop_transform(self, image_size, crop_size):
+        """Transforms crops of crop_size at the resolution of image_size images."""
+        min_size, max_size = self.transform.min_size, self.transform.max_size
+        scale = min(min_size[-1] / min(image_size), max_size / max(image_size))
+
+        self.transform.min_size = (int(round(scale * min(crop_size))),)
+        self.transform.max_size = int(math.ceil(scale * max(crop_size))) + 1
+        try:
+            yield
+        finally:
+            self.transform.min_size = min_size
+            self.transform.max_size = max_size
+
     def train(self, mode=True):
         super(MaskRCNN, self).train(mode)
+        self._apply_transform_sizes()
         if not self._train_encoder:
             self.backbone.eval()
             # self.backbone.body.layer4.train()
@@ -569,6 +593,120 @@ class MaskRCNN(_MaskRCNN):
             if isinstance(m, torch.nn.Dropout2d) or isinstance(m, torch.nn.Dropout):
                 m.eval()
 
+    def _mask_rcnn_targets(self, inputs, targets, flip_label=False):
+        """Converts label maps to the box, label and mask targets of Mask R-CNN."""
+        mask_rcnn_targets = []
+        for target in targets:
+            mask_rcnn_target = None
+            if self.target_cache is not None:
+                mask_rcnn_target = self.target_cache.get(target, flip_label)
+
+            if mask_rcnn_target is None:
+                mask_rcnn_target = self._mask_rcnn_target(inputs, target, flip_label)
+                if self.target_cache is not None:
+                    self.target_cache.put(target, flip_label, mask_rcnn_target)
+
+            # the transform replaces the entries of the target dicts
+            mask_rcnn_targets.append(dict(mask_rcnn_target))
+        return mask_rcnn_targets
+
+    def _mask_rcnn_target(self, inputs, target, flip_label=False):
+        device = inputs.device
+
+        mask = target.to(device)
+        if flip_label:
+            mask = 1 - mask
+
+        # instances are encoded as different colors
+        obj_ids = torch.unique(mask)
+
+        # remove the background and ignored pixels
+        obj_ids = obj_ids[obj_ids.ne(0.0) & obj_ids.ne(255.0)]
+
+        # split the color-encoded mask into a set
+        # of binary masks
+        masks = mask == obj_ids[:, None, None]
+
+        ignore = mask == 255.0
+        masks = masks | ignore
+
+        num_objs = len(obj_ids)
+
+        if num_objs == 0:
+            raise ValueError("Target label map without objects.")
+
+        boxes = masks_to_boxes(masks)
+
+        labels = obj_ids.type(torch.int64)
+
+        # with ignored pixels the background is ignored as well
+        masks = masks.type(torch.uint8)
+        masks = masks.masked_fill(ignore | (mask.eq(0.0) & ignore.sum().gt(0)), 255)
+
+        area = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
+        # suppose all instances are not crowd
+        iscrowd = torch.zeros((num_objs,), dtype=torch.int64, device=device)
+
+        if flip_label:
+            masks = 1 - masks
+
+        return {"boxes": boxes,
+                "labels": labels,
+                "masks": masks,
+                "image_id": torch.tensor([0], device=device),
+                "area": area,
+                "iscrowd": iscrowd}
+
+    def _outputs_per_class(self, inputs, outputs_raw):
+        """
+        Stacks the highest scoring mask and box of every class of all images
+        to [B, C, H, W] masks and [B, C, 4] boxes. Missing classes are zero.
+        """
+        num_images = len(outputs_raw)
+        num_classes = self.num_classes - 1
+        height, width = inputs.shape[-2:]
+
+        masks = torch.cat([o['masks'] for o in outputs_raw])
+        boxes = torch.cat([o['boxes'] for o in outputs_raw])
+        if not len(masks):
+            return (inputs.new_zeros(num_images, num_classes, height, width),
+                    inputs.new_zeros(num_images, num_classes, 4))
+
+        image_ids = torch.cat([torch.full_like(o['labels'], i) for i, o in enumerate(outputs_raw)])
+        keys = image_ids * num_classes + torch.cat([o['labels'] for o in outputs_raw]) - 1
+
+        # the detections of an image are sorted by their score, i.e., the
+        # first detection of every image and class is selected
+        priorities = torch.arange(len(keys), 0, -1, device=keys.device)
+        key_one_hot = (keys[:, None] == torch.arange(num_images * num_classes, device=keys.device)[None]).long()
+        first_priorities, first_inds = (key_one_hot * priorities[:, None]).max(dim=0)
+        detected = first_priorities.gt(0).to(masks.dtype)
+
+        output_masks = masks[first_inds, 0] * detected[:, None, None]
+        output_boxes = boxes[first_inds] * detected[:, None]
+        return (output_masks.view(num_images, num_classes, height, width),
+                output_boxes.view(num_images, num_classes, 4))
+
+    def _forward_cached_features(self, inputs, targets):
+        """Training forward which looks up the backbone features in the feature cache."""
+        images, targets = self.transform([i for i in inputs], targets)
+
+        features = self.feature_cache.get(inputs, images.tensors.shape[-2:])
+        if features is None:
+            with torch.no_grad():
+                features = self.backbone(images.tensors)
+            if isinstance(features, torch.Tensor):
+                features = OrderedDict([(0, features)])
+            self.feature_cache.put(inputs, images.tensors.shape[-2:], features)
+
+        proposals, proposal_losses = self.rpn(images, features, targets)
+        _, detector_losses = self.roi_heads(features, proposals, images.image_sizes, targets)
+
+        losses = {}
+        losses.update(detector_losses)
+        losses.update(proposal_losses)
+        return losses
+
     def forward(self, inputs, targets=None, box_coord_perm=None, flip_label=False):
 
         # # TODO: solve not here.
@@ -577,143 +715,15 @@ class MaskRCNN(_MaskRCNN):
         # crop = [0, 0, 0, 0]
 
         # inputs_padded = F.pad(input=inputs, pad=pad, mode='constant', value=0)
-        device = inputs.device
 
         if targets is not None:
             # assert self.training
+            targets = self._mask_rcnn_targets(inputs, targets, flip_label)
 
-            if flip_label:
-                targets  = 1 - targets
-
-            mask_rcnn_targets = []
-            for target in targets:
-
-                mask = target
-                # instances are encoded as different colors
-                obj_ids = torch.unique(mask)
-
-                # first id is the background, so remove it
-                obj_ids = torch.tensor([obj_id.item() for obj_id in obj_ids
-                                        if obj_id.item() != 0.0 and obj_id.item() != 255.0]).to(obj_ids.device)
-                # obj_ids = obj_ids[1:]
-
-                # split the color-encoded mask into a set
-                # of binary masks
-                masks = mask == obj_ids[:, None, None]
-
-                masks[mask == 255.0] = True
-
-                # get bounding box coordinates for each mask
-                num_objs = len(obj_ids)
-
-                if num_objs == 0:
-                    pred = np.transpose(inputs[0].cpu().numpy(), (1, 2, 0))
-                    import os
-
-                    import imageio
-                    pred_path = os.path.join(f"img.png")
-                    imageio.imsave(pred_path, pred)
-
-                    # pred = np.transpose(masks.cpu().numpy(), (1, 2, 0)).astype(np.uint8)
-                    # # pred = mask.cpu().numpy().astype(np.uint8)
-                    # import os, imageio
-                    # pred_path = os.path.join(f"mask.png")
-                    # imageio.imsave(pred_path, 20 * pred)
-
-                    assert num_objs == 1, f"num_objs: {num_objs}"
-
-                boxes = []
-                for i in range(num_objs):
-                    pos = np.where(masks[i].cpu().numpy())
-                    xmin = np.min(pos[1])
-                    xmax = np.max(pos[1]) + 1
-                    ymin = np.min(pos[0])
-                    ymax = np.max(pos[0]) + 1
-                    boxes.append([xmin, ymin, xmax, ymax])
-
-                # convert everything into a torch.Tensor
-                boxes = torch.as_tensor(boxes, dtype=torch.float32)
-                # there is only one class
-
-                # labels = torch.ones((num_objs,), dtype=torch.int64)
-                labels = obj_ids.type(torch.int64)
-
-                masks = masks.type(torch.uint8)
-                # masks[mask == 255.0] = 255.0
-                if (mask == 255.0).any():
-                    masks[mask == 255.0] = 255.0
-                    masks[mask == 0.0] = 255.0
-
-                # if self.training:
-                #     print(torch.unique(masks))
-
-                image_id = torch.tensor([0])
-
-                # # if not num_objs:
-                # pred = np.transpose(masks.cpu().numpy(), (1, 2, 0)).astype(np.uint8)
-                # # pred = mask.cpu().numpy().astype(np.uint8)
-                # import os, imageio
-                # pred_path = os.path.join(f"mask.png")
-                # imageio.imsave(pred_path, 20 * pred)
-
-                # pred = np.transpose(inputs[0].cpu().numpy(), (1, 2, 0))
-                # # pred = mask.cpu().numpy().astype(np.uint8)
-                # import os, imageio
-                # pred_path = os.path.join(f"img.png")
-                # imageio.imsave(pred_path, (pred * 255).astype(np.uint8))
-
-
-                # # pred_ = np.transpose(preds[frame_id].cpu().numpy(), (1, 2, 0)).astype(np.uint8)
-                # # # pred = mask.cpu().numpy().astype(np.uint8)
-                # # imageio.imsave(f"mask.png", 20 * pred_)
-
-                # # pred_ *= 20
-                # import matplotlib.pyplot as plt
-
-                # pred = np.transpose(masks.cpu().numpy(),
-                #                     (1, 2, 0)).astype(np.uint8)
-                # fig = plt.figure()
-                # ax = plt.Axes(fig, [0., 0., 1., 1.])
-                # ax.set_axis_off()
-                # fig.add_axes(ax)
-                # ax.imshow(pred.squeeze(2))
-
-                # for box in boxes:
-                #     ax.add_patch(
-                #         plt.Rectangle(
-                #             (box[0], box[1]),
-                #             box[2] - box[0],
-                #             box[3] - box[1],
-                #             fill=False,
-                #             linewidth=1.0,
-                #         ))
-
-                # plt.axis('off')
-                # # plt.tight_layout()
-                # plt.draw()
-                # plt.savefig(f"mask_with_boxes.png", dpi=100)
-                # plt.close()
-                # # exit()
-
-                area = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
-                # suppose all instances are not crowd
-                iscrowd = torch.zeros((num_objs,), dtype=torch.int64)
-
-                if flip_label:
-                    masks = 1 - masks
-
-                mask_rcnn_target = {}
-                mask_rcnn_target["boxes"] = boxes.to(device)
-                mask_rcnn_target["labels"] = labels.to(device)
-                mask_rcnn_target["masks"] = masks.to(device)
-                mask_rcnn_target["image_id"] = image_id.to(device)
-                mask_rcnn_target["area"] = area.to(device)
-                mask_rcnn_target["iscrowd"] = iscrowd.to(device)
-
-                mask_rcnn_targets.append(mask_rcnn_target)
-            targets = mask_rcnn_targets
-
-        outputs_raw = super(MaskRCNN, self).forward([i for i in inputs], targets)#, box_coord_perm)
+        if self.training and self.feature_cache is not None:
+            outputs_raw = self._forward_cached_features(inputs, targets)
+        else:
+            outputs_raw = super(MaskRCNN, self).forward([i for i in inputs], targets)#, box_coord_perm)
 
         # if crop[0]:
         #     outputs = outputs[..., crop[0]:]
@@ -730,46 +740,41 @@ class MaskRCNN(_MaskRCNN):
             loss = sum([loss for loss in losses.values()])
             return loss, losses
         else:
-            boxes = torch.zeros(inputs.size(0), 4)
-            outputs = torch.zeros_like(inputs)[:, :1]
+            return self._outputs_per_class(inputs, outputs_raw)
+
+    def forward_features(self, inputs):
+        """
+        Runs the transform and backbone only. The features can be shared by
+        the heads of multiple fine-tuned models with the same backbone.
+        """
+        original_image_sizes = [i.shape[-2:] for i in inputs]
+        images, _ = self.transform([i for i in inputs])
+        features = self.backbone(images.tensors)
+        if isinstance(features, torch.Tensor):
+            features = OrderedDict([(0, features)])
+        return images, features, original_image_sizes
+
+    def forward_heads(self, inputs, images, features, original_image_sizes,
+                      targets=None, rpn=None, roi_heads=None):
+        """
+        Inference of the RPN and RoI heads on the output of forward_features.
+        Defaults to the heads of this model.
+        """
+        assert not self.training
+
+        if rpn is None:
+            rpn = self.rpn
+        if roi_heads is None:
+            roi_heads = self.roi_heads
 
-            assert len(outputs_raw) == 1
-
-            # print(outputs_raw[0])
-            # print(outputs_raw[0]['masks'].shape)
-            # print(outputs_raw[0]['boxes'].shape)
-
-            # for i, output in enumerate(outputs_raw):
-            #     assert len(torch.unique(output['labels'])) == num_objs
-
-            #     if output['masks'].shape[0] >= 1:
-            #         outputs[i] = output['masks'][0]
-            #         boxes[i] = output['boxes'][0]
-
-            # return outputs, boxes
-
-            # print(torch.cat([o['masks'] for o in outputs_raw['masks'], dim=0).shape)
-
-            output_masks = []
-            output_boxes = []
-            for output_raw in outputs_raw:
-                output_mask = []
-                output_box = []
-
-                for i in range(1, self.num_classes):
-                    if len((output_raw['labels'] == i).nonzero()):
-                        first_index = (output_raw['labels'] == i).nonzero()[0]
-                        output_mask.append(output_raw['masks'][first_index][0])
-                        output_box.append(output_raw['boxes'][first_index])
-                    else:
-                        output_mask.append(
-                            torch.zeros_like(inputs)[0, 0].unsqueeze(dim=0).to(device))
-                        output_box.append(torch.zeros(1, 4).to(device))
-                output_masks.append(torch.cat(output_mask, dim=0).unsqueeze(dim=0))
-                output_boxes.append(
-                    torch.cat(output_box, dim=0).unsqueeze(dim=0))
+        if targets is not None:
+            targets = self._mask_rcnn_targets(inputs, targets)
+            # only the boxes are used for inference
+            for target, original_image_size, image_size in zip(targets, original_image_sizes, images.image_sizes):
+                target['boxes'] = resize_boxes(target['boxes'], original_image_size, image_size)
 
-            # print(torch.cat(output_masks, dim=0).shape)
-            # print(torch.cat([o['masks'].unsqueeze(dim=0).squeeze(dim=2) for o in outputs_raw]).shape)
+        proposals, _ = rpn(images, features, targets)
+        detections, _ = roi_heads(features, proposals, images.image_sizes, targets)
+        detections = self.transform.postprocess(detections, images.image_sizes, original_image_sizes)
 
-            return torch.cat(output_masks, dim=0), torch.cat(output_boxes, dim=0)
+        return self._outputs_per_class(inputs, detections)
@@ -0,0 +1,46 @@
+import torch
+
+
+class TargetCache:
+    """
+    LRU cache of the Mask R-CNN targets of label maps.
+
+    Entries are looked up by comparing the label maps on their device, i.e.,
+    without copies to the host. Repeated fine-tuning iterations on the same
+    frame skip the target construction.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._targets = []
+
+    def get(self, label_map: torch.Tensor, flip_label: bool = False):
+        for i, (entry_label_map, entry_flip_label, targets) in enumerate(self._targets):
+            if (entry_flip_label == flip_label
+                    and entry_label_map.shape == label_map.shape
+                    and entry_label_map.device == label_map.device
+                    and torch.equal(entry_label_map, label_map)):
+                self.hits += 1
+                self._targets.append(self._targets.pop(i))
+                return targets
+
+        self.misses += 1
+        return None
+
+    def put(self, label_map: torch.Tensor, flip_label: bool, targets: dict):
+        # the label maps might be modified in-place by the caller
+        self._targets.append((label_map.detach().clone(), flip_label, targets))
+        while len(self._targets) > self.max_size:
+            self._targets.pop(0)
+
+    def clear(self):
+        self._targets = []
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
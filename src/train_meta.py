@@ -1,3 +1,4 @@
+import atexit
 import copy
 import logging
 import os
@@ -12,10 +13,19 @@ import torch.multiprocessing as mp
 import torchvision
 
 from meta_optim.meta_optim import MetaOptimizer
-from util.helper_func import (init_parent_model, load_state_dict, set_random_seeds)
-from util.radam import RAdam
+from meta_optim.meta_task_scheduler import MetaTaskScheduler
+from networks.feature_cache import hit_rate
+from util.helper_func import (cpu_process_layout, eval_dataset_keys,
+                              init_parent_model, load_state_dict,
+                              set_random_seeds)
+from util.checkpoint import CheckpointWriter
+from util.distributed import (all_reduce_grads, broadcast_counters,
+                              broadcast_parameters, init_distributed,
+                              is_main_node, reduce_metric, world_size)
+from util.stage_timer import format_summary, merge_summaries, save_json
 from util.visualize import init_vis
-from util.meta_run import meta_run
+from util.meta_run import (init_meta_optim_optim, init_meta_task_set, meta_run,
+                           meta_task_keys)
 from util.evaluate import evaluate
 
 ex = sacred.Experiment('e-osvos-meta')
@@ -23,6 +33,7 @@ ex.add_config('cfgs/meta.yaml')
 ex.add_config('cfgs/torch.yaml')
 ex.add_named_config('DAVIS-2017', 'cfgs/meta_davis-2017.yaml')
 ex.add_named_config('YouTube-VOS', 'cfgs/meta_youtube-vos.yaml')
+ex.add_named_config('Synthetic-DAVIS-2017', 'cfgs/meta_synthetic-davis-2017.yaml')
 ex.add_named_config('e-OSVOS', 'cfgs/eval_e-osvos.yaml')
 ex.add_named_config('e-OSVOS-OnA', 'cfgs/eval_e-osvos-OnA.yaml')
 
@@ -44,6 +55,7 @@ def main(save_dir: str, resume_meta_run_epoch_mode: str, env_suffix: str,
          meta_optim_optim_cfg: dict, seed: int, _config: dict, _log: logging,
          meta_optim_model_file: str, num_eval_gpus: int, no_vis: bool,
          meta_batch_size: int, vis_interval: int, data_cfg: dict, torch_cfg: dict,
+         num_cpu_threads_per_process: int, distributed: dict,
          _run: sacred.run.Run):
     mp.set_start_method('spawn')
     mp.set_sharing_strategy('file_system')
@@ -53,19 +65,32 @@ def main(save_dir: str, resume_meta_run_epoch_mode: str, env_suffix: str,
 
     assert datasets['train'] is not None
 
+    if init_distributed(**distributed):
+        _log.info(f"Node {distributed['rank']} of {distributed['world_size']} joined.")
+
+    if not is_main_node():
+        # rank 0 evaluates, visualizes and saves. meta parameters and
+        # counters of a resumed run are broadcast from rank 0.
+        eval_datasets = False
+        _config['eval_datasets'] = False
+        no_vis = True
+        resume_meta_run_epoch_mode = None
+
     set_random_seeds(seed)
 
-    vis_dict = init_vis(get_run_name())  # pylint: disable=E1120
+    vis_dict = init_vis(get_run_name(), no_vis=no_vis,  # pylint: disable=E1120
+                        resume_meta_run_epoch_mode=resume_meta_run_epoch_mode)
 
     assert save_dir is not None
 
     save_dir = os.path.join(save_dir, get_run_name())  # pylint: disable=E1120
-    if os.path.exists(save_dir):
-        if resume_meta_run_epoch_mode is None:
-            shutil.rmtree(save_dir)
+    if is_main_node():
+        if os.path.exists(save_dir):
+            if resume_meta_run_epoch_mode is None:
+                shutil.rmtree(save_dir)
+                os.makedirs(save_dir)
+        else:
             os.makedirs(save_dir)
-    else:
-        os.makedirs(save_dir)
 
     if resume_meta_run_epoch_mode is not None:
         if resume_meta_run_epoch_mode == 'LAST':
@@ -74,7 +99,8 @@ def main(save_dir: str, resume_meta_run_epoch_mode: str, env_suffix: str,
             resume_model_name = f"best_{resume_meta_run_epoch_mode.split('_')[1].lower()}_meta_iter.model"
         else:
             raise NotImplementedError
-        saved_meta_run = torch.load(os.path.join(save_dir, resume_model_name))
+        saved_meta_run = torch.load(os.path.join(save_dir, resume_model_name),
+                                    map_location=lambda storage, loc: storage)
         # TODO: refactor and do in init_vis method
         for n in vis_dict.keys():
             if n in saved_meta_run['vis_win_names']:
@@ -99,7 +125,8 @@ def main(save_dir: str, resume_meta_run_epoch_mode: str, env_suffix: str,
     meta_optim.init_zero_grad()
 
     if meta_optim_model_file is not None:
-        previous_meta_optim_state_dict = torch.load(meta_optim_model_file)['meta_optim_state_dict']
+        previous_meta_optim_state_dict = torch.load(
+            meta_optim_model_file, map_location=lambda storage, loc: storage)['meta_optim_state_dict']
         meta_optim.load_state_dict(previous_meta_optim_state_dict)
 
     if resume_meta_run_epoch_mode is not None:
@@ -107,49 +134,61 @@ def main(save_dir: str, resume_meta_run_epoch_mode: str, env_suffix: str,
 
     _log.info(f"Meta optim model parameters: {sum([p.numel() for p in meta_optim.parameters()])}")
 
-    meta_optim_params = []
-    for n, p in meta_optim.named_parameters():
-        weight_decay = 0.0
-        if 'model_init' in n:
-            lr = meta_optim_optim_cfg['model_init_lr']
-            weight_decay = meta_optim_optim_cfg['model_init_weight_decay']
-        elif 'log_init_lr' in n:
-            lr = meta_optim_optim_cfg['log_init_lr_lr']
-        else:
-            lr = meta_optim_optim_cfg['lr']
-
-        if meta_optim_optim_cfg['freeze_encoder'] and ('backbone' in n or 'rpn' in n):
-            lr = 0.0
+    meta_optim_optim = init_meta_optim_optim(meta_optim, meta_optim_optim_cfg)
 
-        meta_optim_params.append({'params': [p], 'lr': lr, 'weight_decay': weight_decay})
+    if resume_meta_run_epoch_mode is not None:
+        if 'meta_optim_optim_state_dict' in saved_meta_run:
+            meta_optim_optim.load_state_dict(saved_meta_run['meta_optim_optim_state_dict'])
+        else:
+            _log.warning(f"{resume_model_name} has no meta optimizer state. "
+                         "Resuming with a reset RAdam state.")
 
-    meta_optim_optim = RAdam(
-        meta_optim_params, lr=meta_optim_optim_cfg['lr'])
+    checkpoint_writer = CheckpointWriter()
+    # meta training only ends by termination. queued checkpoints are written before exiting.
+    atexit.register(checkpoint_writer.close)
 
     #
     # processes
     #
     num_meta_processes = torch.cuda.device_count()
-    eval_processes = {}
-    if eval_datasets:
-        eval_processes = [{'dataset_key': k}
-                          for k, v in datasets.items()
-                          if v['eval'] and v['split'] is not None]
+    eval_processes = [{'dataset_key': k} for k in eval_dataset_keys(datasets, eval_datasets)]
 
-        if num_eval_gpus is None:
-            num_eval_gpus = len(eval_processes)
-            _config['num_eval_gpus'] = num_eval_gpus
-        assert len(eval_processes) % num_eval_gpus == 0
+    if torch.cuda.is_available():
+        if eval_datasets:
+            if num_eval_gpus is None:
+                num_eval_gpus = len(eval_processes)
+                _config['num_eval_gpus'] = num_eval_gpus
+            assert len(eval_processes) % num_eval_gpus == 0
 
-        num_meta_processes -= num_eval_gpus
+            num_meta_processes -= num_eval_gpus
 
-        assert num_meta_processes >= 0
+            assert num_meta_processes >= 0
 
-    if num_meta_processes and num_meta_processes_per_gpu:
-        num_meta_processes *= num_meta_processes_per_gpu
-        assert not meta_batch_size % num_meta_processes, ('meta_batch_size is not a multiple of num_meta_processes.')
+        # eval processes share the eval GPUs
+        num_eval_devices = num_eval_gpus
+
+        if num_meta_processes and num_meta_processes_per_gpu:
+            num_meta_processes *= num_meta_processes_per_gpu
+            assert not meta_batch_size % num_meta_processes, ('meta_batch_size is not a multiple of num_meta_processes.')
+        else:
+            num_meta_processes = 0
     else:
-        num_meta_processes = 0
+        # every eval process gets its own core slice
+        num_eval_devices = len(eval_processes)
+
+        num_cpu_threads_per_process, num_meta_processes = cpu_process_layout(
+            len(eval_processes), meta_batch_size, num_cpu_threads_per_process)
+        _config['num_cpu_threads_per_process'] = num_cpu_threads_per_process
+
+        # num_meta_processes_per_gpu=0 still selects the eval modus
+        if not num_meta_processes_per_gpu:
+            num_meta_processes = 0
+
+        _log.info(f"CPU modus: {num_meta_processes} meta and {len(eval_processes)} eval "
+                  f"processes with {num_cpu_threads_per_process} threads each.")
+
+    if not num_meta_processes:
+        assert world_size() == 1, 'Distributed meta training requires meta processes on every node.'
         _log.warning(f"EVAL modus.")
 
     process_manager = mp.Manager()
@@ -171,13 +210,36 @@ def main(save_dir: str, resume_meta_run_epoch_mode: str, env_suffix: str,
         shared_variables['meta_iter'] = saved_meta_run['meta_iter']
         shared_variables['meta_epoch'] = saved_meta_run['meta_epoch']
 
+    if num_meta_processes:
+        meta_task_scheduler = MetaTaskScheduler(
+            meta_task_keys(init_meta_task_set(_config)), meta_batch_size,
+            num_meta_processes, seed, num_nodes=world_size(),
+            node_rank=distributed['rank'])
+
+        if resume_meta_run_epoch_mode is not None and 'meta_task_scheduler_state_dict' in saved_meta_run:
+            meta_task_scheduler.load_state_dict(saved_meta_run['meta_task_scheduler_state_dict'])
+
+        # all nodes start from the state of rank 0
+        shared_variables['meta_iter'], shared_variables['meta_epoch'], meta_task_scheduler.epoch_iter = \
+            broadcast_counters([shared_variables['meta_iter'],
+                                shared_variables['meta_epoch'],
+                                meta_task_scheduler.epoch_iter])
+        broadcast_parameters(meta_optim)
+
+        epoch_plans = meta_task_scheduler.plan_epoch(shared_variables['meta_epoch'])
+
     # start train and val evaluation
     for rank, p in enumerate(eval_processes):
         p['shared_dict'] = process_manager.dict()
         p['shared_dict']['meta_iter'] = None
         p['shared_dict']['best_mean_J'] = 0.0
 
-        rank = rank % num_eval_gpus
+        best_model_path = os.path.join(save_dir, f"best_{p['dataset_key']}_meta_iter.model")
+        if resume_meta_run_epoch_mode is not None and os.path.exists(best_model_path):
+            p['shared_dict']['best_mean_J'] = torch.load(
+                best_model_path, map_location=lambda storage, loc: storage).get('mean_J', 0.0)
+
+        rank = rank % num_eval_devices
 
         process_args = [rank, p['dataset_key'], meta_optim.state_dict(), shared_variables,
                         _config, p['shared_dict'], save_dir, {n: v.win for n, v in vis_dict.items()},
@@ -191,6 +253,7 @@ def main(save_dir: str, resume_meta_run_epoch_mode: str, env_suffix: str,
             p['shared_dict'] = process_manager.dict()
             p['shared_dict']['sub_iter_done'] = False
             p['shared_dict']['meta_epoch_done'] = False
+            p['shared_dict']['epoch_plan'] = epoch_plans[rank]
 
             process_args = [rank, model.state_dict(), meta_optim.state_dict(),
                             global_rng_state, _config, datasets['train'],
@@ -239,6 +302,23 @@ def main(save_dir: str, resume_meta_run_epoch_mode: str, env_suffix: str,
                         eval_seq_vis, shared_dict['meta_iter'])
 
                 _log.info(f"{p['dataset_key']}: J mean {torch.tensor(shared_dict['J_seq']).mean():.1%}")
+                if shared_dict['feature_cache_hit_rate'] is not None:
+                    _log.info(f"{p['dataset_key']}: feature cache hit rate "
+                              f"{shared_dict['feature_cache_hit_rate']:.1%}")
+                if shared_dict['target_cache_hit_rate'] is not None:
+                    _log.info(f"{p['dataset_key']}: target cache hit rate "
+                              f"{shared_dict['target_cache_hit_rate']:.1%}")
+                if shared_dict['fine_tune_epochs_saved'] is not None:
+                    _log.info(f"{p['dataset_key']}: fine-tuning epochs {shared_dict['fine_tune_epochs']:.1f} "
+                              f"({shared_dict['fine_tune_epochs_saved']:.1%} saved)")
+                if _config['eval_online_adapt']['step']:
+                    _log.info(f"{p['dataset_key']}: online adaptations {shared_dict['num_online_adaptations']} "
+                              f"({shared_dict['num_online_adapt_triggers']} triggered)")
+                if _config['eval_keyframes']['mode'] is not None:
+                    _log.info(f"{p['dataset_key']}: propagated frames {shared_dict['propagated_frames']:.1%}")
+                if _config['eval_roi_crop']['enabled']:
+                    _log.info(f"{p['dataset_key']}: mean roi crop area {shared_dict['roi_crop_area']:.1%}")
+                _log.info(f"{p['dataset_key']}: stage times {shared_dict['stage_timings']}")
 
                 # evalutate only once if in eval mode
                 if not num_meta_processes:
@@ -249,6 +329,7 @@ def main(save_dir: str, resume_meta_run_epoch_mode: str, env_suffix: str,
 
         # finish in eval mode when all evaluations are done
         if not num_meta_processes and all([not p['process'].is_alive() for p in eval_processes]):
+            checkpoint_writer.close()
             return
 
         if num_meta_processes and all([p['shared_dict']['sub_iter_done'] for p in meta_processes]):
@@ -260,6 +341,7 @@ def main(save_dir: str, resume_meta_run_epoch_mode: str, env_suffix: str,
 
             meta_iter_metrics = {'train_loss': [], 'train_losses': [], 'meta_loss': [],
                                  'meta_losses': [], 'loss': [], 'J': [], 'F': []}
+            task_wait_times = [p['shared_dict']['task_wait_time'] for p in meta_processes]
 
             for p in meta_processes:
                 shared_dict = p['shared_dict']
@@ -273,33 +355,53 @@ def main(save_dir: str, resume_meta_run_epoch_mode: str, env_suffix: str,
                         meta_iter_metrics[metric].extend(seq_values)
                 shared_dict['seqs_metrics'] = {}
 
+                meta_task_scheduler.update(shared_dict['task_timings'])
+
+            meta_task_scheduler.epoch_iter += 1
+
             # ITER
             if shared_variables['meta_iter'] == 1 or not shared_variables['meta_iter'] % vis_interval:
-                # SAVE MODEL
-                if save_dir is not None:
-                    save_meta_run = {'meta_optim_state_dict': meta_optim.state_dict(),
-                                    #  'meta_optim_optim_state_dict': meta_optim_optim.state_dict(),
-                                     'vis_win_names': {n: v.win for n, v in vis_dict.items()},
-                                     'meta_iter': shared_variables['meta_iter'],
-                                     'meta_epoch': shared_variables['meta_epoch']}
-                    torch.save(save_meta_run, os.path.join(
-                        save_dir, f"last_meta_iter.model"))
-
                 # VIS METRICS
-                meta_iter_train_loss = torch.tensor(meta_iter_metrics['train_loss'])
-                meta_iter_meta_loss = torch.tensor(meta_iter_metrics['meta_loss'])
-
-                meta_metrics = [meta_iter_train_loss.mean(),
-                                meta_iter_meta_loss.mean(),
-                                meta_iter_meta_loss.std(),
-                                meta_iter_meta_loss.max(),
-                                meta_iter_meta_loss.min()]
+                # reduced over the meta processes of all nodes
+                meta_iter_train_loss = reduce_metric(meta_iter_metrics['train_loss'])
+                meta_iter_meta_loss = reduce_metric(meta_iter_metrics['meta_loss'])
+
+                meta_metrics = [meta_iter_train_loss['mean'],
+                                meta_iter_meta_loss['mean'],
+                                meta_iter_meta_loss['std'],
+                                meta_iter_meta_loss['max'],
+                                meta_iter_meta_loss['min']]
                 meta_metrics.append((timeit.default_timer() - start_time) / 60)
-                vis_dict['meta_metrics_vis'].plot(
-                    meta_metrics, shared_variables['meta_iter'])
+                meta_metrics.append(torch.tensor(task_wait_times).mean())
+                if not no_vis:
+                    vis_dict['meta_metrics_vis'].plot(
+                        meta_metrics, shared_variables['meta_iter'])
+
+                _log.info(f"Meta iter {shared_variables['meta_iter']}: "
+                          f"task queue wait {torch.tensor(task_wait_times).mean():.2f}s "
+                          f"(max {max(task_wait_times):.2f}s)")
+
+                meta_iter_hit_rate = hit_rate([p['shared_dict']['feature_cache_stats'] for p in meta_processes
+                                               if 'feature_cache_stats' in p['shared_dict']])
+                if meta_iter_hit_rate is not None:
+                    _log.info(f"Meta iter {shared_variables['meta_iter']}: "
+                              f"feature cache hit rate {meta_iter_hit_rate:.1%}")
+
+                meta_iter_stage_timings = merge_summaries([p['shared_dict']['stage_timings']
+                                                           for p in meta_processes])
+                meta_iter_task_timings = [t for p in meta_processes for _, t in p['shared_dict']['task_timings']]
+                _log.info(f"Meta iter {shared_variables['meta_iter']}: "
+                          f"stage times {format_summary(meta_iter_stage_timings)}")
+                if is_main_node():
+                    save_json({'meta_iter': shared_variables['meta_iter'],
+                               'num_tasks': len(meta_iter_task_timings),
+                               'task_time': sum(meta_iter_task_timings),
+                               'tasks_per_second': len(meta_iter_task_timings) / sum(meta_iter_task_timings),
+                               'stages': meta_iter_stage_timings},
+                              os.path.join(save_dir, "meta_stage_timings.json"))
 
                 # VIS LR
-                if _config['num_epochs']['train'] > 1:
+                if not no_vis and _config['num_epochs']['train'] > 1:
                     lrs_hist = []
                     for p in meta_processes:
                         lrs_hist.extend(chain.from_iterable(list(p['shared_dict']['vis_data_seqs'].values())))
@@ -319,8 +421,9 @@ def main(save_dir: str, resume_meta_run_epoch_mode: str, env_suffix: str,
                 meta_init_lr = [meta_optim.init_lr.mean(),
                                 meta_optim.init_lr.std()]
                 meta_init_lr += meta_optim.init_lr.detach().numpy().tolist()
-                vis_dict['init_lr_vis'].plot(
-                    meta_init_lr, shared_variables['meta_iter'])
+                if not no_vis:
+                    vis_dict['init_lr_vis'].plot(
+                        meta_init_lr, shared_variables['meta_iter'])
 
             # EPOCH
             if all([p['shared_dict']['meta_epoch_done'] for p in meta_processes]):
@@ -329,27 +432,33 @@ def main(save_dir: str, resume_meta_run_epoch_mode: str, env_suffix: str,
 
                 # VIS LOSS
                 for loss_name in ['train', 'meta']:
-                    meta_loss_seq = [torch.tensor(list(chain.from_iterable(
-                                    list(meta_epoch_metrics[f'{loss_name}_loss'].values())))).mean()]
+                    meta_loss_seq = [reduce_metric(list(chain.from_iterable(
+                                    list(meta_epoch_metrics[f'{loss_name}_loss'].values()))))['mean']]
 
                     if _config['parent_model']['architecture'] == 'MaskRCNN':
                         # 'MEAN cls_score', 'MEAN bbox_pred', 'MEAN mask_fcn_logits'
                         meta_losses_list = list(chain.from_iterable(list(meta_epoch_metrics[f'{loss_name}_losses'].values())))
-                        meta_loss_seq.append(torch.tensor(
-                            [v['loss_classifier'] for v in meta_losses_list]).mean())
-                        meta_loss_seq.append(torch.tensor(
-                            [v['loss_box_reg'] for v in meta_losses_list]).mean())
-                        meta_loss_seq.append(torch.tensor(
-                            [v['loss_mask'] for v in meta_losses_list]).mean())
+                        meta_loss_seq.append(reduce_metric(
+                            [v['loss_classifier'] for v in meta_losses_list])['mean'])
+                        meta_loss_seq.append(reduce_metric(
+                            [v['loss_box_reg'] for v in meta_losses_list])['mean'])
+                        meta_loss_seq.append(reduce_metric(
+                            [v['loss_mask'] for v in meta_losses_list])['mean'])
 
-                    vis_dict[f'{loss_name}_loss_seq_vis'].plot(
-                        meta_loss_seq, shared_variables['meta_epoch'])
+                    if not no_vis:
+                        vis_dict[f'{loss_name}_loss_seq_vis'].plot(
+                            meta_loss_seq, shared_variables['meta_epoch'])
 
                 meta_epoch_metrics = {'train_loss': {}, 'train_losses': {}, 'meta_loss': {},
                                       'meta_losses': {}, 'loss': {}, 'J': {}, 'F': {}}
 
-                for p in meta_processes:
+                # plan next epoch with the updated task cost estimates
+                meta_task_scheduler.epoch_iter = 0
+                epoch_plans = meta_task_scheduler.plan_epoch(shared_variables['meta_epoch'])
+
+                for p, epoch_plan in zip(meta_processes, epoch_plans):
                     p['shared_dict']['meta_epoch_done'] = False
+                    p['shared_dict']['epoch_plan'] = epoch_plan
 
             #
             # STEP
@@ -358,19 +467,38 @@ def main(save_dir: str, resume_meta_run_epoch_mode: str, env_suffix: str,
 
             start_time = timeit.default_timer()
 
-            for name, param in meta_optim.named_parameters():
-                param.grad = shared_meta_optim_grads[name] / meta_batch_size
+            # sum of the meta batches of all nodes
+            all_reduce_grads(shared_meta_optim_grads)
+
+            if is_main_node():
+                for name, param in meta_optim.named_parameters():
+                    param.grad = shared_meta_optim_grads[name] / (meta_batch_size * world_size())
+
+                    grad_clip = _config['meta_optim_optim_cfg']['grad_clip']
+                    if grad_clip is not None:
+                        param.grad.clamp_(-1.0 * grad_clip, grad_clip)
+
+                meta_optim_optim.step()
+                meta_optim_optim.zero_grad()
 
-                grad_clip = _config['meta_optim_optim_cfg']['grad_clip']
-                if grad_clip is not None:
-                    param.grad.clamp_(-1.0 * grad_clip, grad_clip)
+                meta_optim.clamp_init_lr()
 
-            meta_optim_optim.step()
-            meta_optim_optim.zero_grad()
             for grad in shared_meta_optim_grads.values():
                 grad.zero_()
 
-            meta_optim.clamp_init_lr()
+            broadcast_parameters(meta_optim)
+
+            # SAVE MODEL
+            # after the step, i.e., the checkpoint holds the state after meta_iter updates
+            if is_main_node() and save_dir is not None and (shared_variables['meta_iter'] == 1 or not shared_variables['meta_iter'] % vis_interval):
+                save_meta_run = {'meta_optim_state_dict': meta_optim.state_dict(),
+                                 'meta_optim_optim_state_dict': meta_optim_optim.state_dict(),
+                                 'vis_win_names': {n: v.win for n, v in vis_dict.items()},
+                                 'meta_iter': shared_variables['meta_iter'],
+                                 'meta_epoch': shared_variables['meta_epoch'],
+                                 'meta_task_scheduler_state_dict': meta_task_scheduler.state_dict()}
+                checkpoint_writer.save(save_meta_run, os.path.join(
+                    save_dir, f"last_meta_iter.model"))
 
             for p in meta_processes:
                 # p['shared_dict']['sub_meta_mini_batch'] = sub_meta_mini_batch
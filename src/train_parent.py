@@ -238,7 +238,6 @@ elif 'YouTube-VOS' in db_root_dir:
     db_test = DAVIS(seqs_key='val_seqs',
                     root_dir='data/DAVIS-2017',
                     transform=tr.ToTensor())
-    db_test.resetup_davis_eval()
 
     # db_test = YouTube(seqs_key=test_dataset,
     #                    root_dir=db_root_dir,
@@ -0,0 +1,72 @@
+import copy
+import logging
+import os
+import queue
+import threading
+
+import torch
+
+
+def snapshot(obj):
+    """
+    Returns a copy of obj with all tensors detached, moved to the CPU and
+    cloned. The snapshot is safe to serialize while the original (shared
+    memory) tensors continue to be updated.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def atomic_save(obj, path):
+    """Writes to a temporary file and renames it, i.e., path is never partially written."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class CheckpointWriter:
+    """
+    Saves checkpoints in a background thread.
+
+    save() only snapshots the given state and returns. Serialization and
+    the atomic write happen off-thread. Call flush() before reading a
+    checkpoint and close() before the process exits.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                obj, path = item
+                atomic_save(obj, path)
+            except Exception:  # pylint: disable=W0703
+                logging.getLogger(__name__).exception(f"Saving checkpoint {path} failed.")
+            finally:
+                self._queue.task_done()
+
+    def save(self, obj, path):
+        self._queue.put((snapshot(obj), path))
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        if not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,110 @@
+"""Multi-node meta training over torch.distributed.
+
+The main process of every node joins a gloo process group. The meta
+processes of a node aggregate their gradients in shared memory as before.
+The nodes all-reduce these aggregated gradients, rank 0 applies the meta
+update and broadcasts the new meta parameters.
+"""
+import datetime
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(world_size: int, rank: int, init_method: str,
+                     timeout_min: int = 30):
+    if world_size == 1:
+        return False
+
+    dist.init_process_group('gloo', init_method=init_method,
+                            world_size=world_size, rank=rank,
+                            timeout=datetime.timedelta(minutes=timeout_min))
+    return True
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def world_size():
+    if is_distributed():
+        return dist.get_world_size()
+    return 1
+
+
+def is_main_node():
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def _flatten(tensors):
+    return torch.cat([t.detach().reshape(-1).cpu() for t in tensors])
+
+
+def _unflatten_(flat, tensors):
+    offset = 0
+    for t in tensors:
+        t.data.copy_(flat[offset:offset + t.numel()].view_as(t))
+        offset += t.numel()
+
+
+def all_reduce_grads(grads: dict):
+    """Sums the gradients of all nodes in place with a single collective."""
+    if not is_distributed():
+        return
+
+    names = sorted(grads.keys())
+    flat = _flatten([grads[n] for n in names])
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    _unflatten_(flat, [grads[n] for n in names])
+
+
+def broadcast_parameters(module: torch.nn.Module, src: int = 0):
+    if not is_distributed():
+        return
+
+    params = [p for _, p in sorted(module.named_parameters(), key=lambda x: x[0])]
+    flat = _flatten(params)
+    dist.broadcast(flat, src=src)
+    _unflatten_(flat, params)
+
+
+def broadcast_counters(counters: list, src: int = 0):
+    if not is_distributed():
+        return counters
+
+    counters = torch.tensor(counters, dtype=torch.int64)
+    dist.broadcast(counters, src=src)
+    return counters.tolist()
+
+
+def reduce_metric(values: list):
+    """
+    Returns mean, std, max and min of the metric values of all nodes. Nodes
+    might report a different number of values.
+    """
+    values = torch.tensor(values, dtype=torch.float64)
+
+    stats = torch.tensor([values.numel(), values.sum(), values.pow(2).sum()],
+                         dtype=torch.float64)
+    max_value = values.max() if values.numel() else torch.tensor(float('-inf'))
+    min_value = values.min() if values.numel() else torch.tensor(float('inf'))
+    max_value = max_value.reshape(1).double()
+    min_value = min_value.reshape(1).double()
+
+    if is_distributed():
+        dist.all_reduce(stats, op=dist.ReduceOp.SUM)
+        dist.all_reduce(max_value, op=dist.ReduceOp.MAX)
+        dist.all_reduce(min_value, op=dist.ReduceOp.MIN)
+
+    count, total, total_sq = stats.tolist()
+    if not count:
+        nan = float('nan')
+        return {'mean': nan, 'std': nan, 'max': nan, 'min': nan}
+
+    mean = total / count
+    # unbiased like torch.std
+    var = (total_sq - count * mean ** 2) / max(count - 1, 1)
+    return {'mean': mean,
+            'std': max(var, 0.0) ** 0.5,
+            'max': max_value.item(),
+            'min': min_value.item()}
@@ -1,6 +1,7 @@
 import copy
 import logging
 import os
+import queue
 import time
 import timeit
 
@@ -8,345 +9,749 @@ import imageio
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
+import torch.multiprocessing as mp
 from data import custom_transforms
 from meta_optim.meta_optim import MetaOptimizer
+from networks.feature_cache import hit_rate
 from networks.mask_rcnn import MaskRCNN
 
-from util.helper_func import (compute_loss, data_loaders, early_stopping,
-                              epoch_iter, eval_davis_seq, eval_loader,
-                              init_parent_model, run_loader, set_random_seeds)
-
+from util.checkpoint import CheckpointWriter
+from util.fine_tune_budget import FineTuneBudget, saved_epochs
+from util.keyframes import KeyframeSelector
+from util.mask_accumulator import MaskAccumulator
+from util.metrics import GroundTruthCache
+from util.online_adapt_trigger import OnlineAdaptTrigger
+from util.roi_crop import RoiCrop
+from util.stage_timer import (StageTimer, format_summary, merge_summaries,
+                              save_json, stage, timed_iter)
+from util.weight_cache import FineTuneCache
+from util.helper_func import (compute_loss, data_loaders,
+                              device_for_eval_process, early_stopping,
+                              epoch_iter, eval_loader, init_parent_model,
+                              init_seq_evaluator, run_loader,
+                              run_loader_shared_backbone,
+                              set_cpu_threads_for_process, set_random_seeds,
+                              transform_scale)
+
+
+def init_eval_loaders(dataset_key: str, _config: dict):
+    train_loader, test_loader, meta_loader = data_loaders(  # pylint: disable=E1120
+        _config['datasets'][dataset_key], **copy.deepcopy(_config['data_cfg']))
+    # remove random cropping
+    train_loader.dataset.crop_size = None
+    test_loader.dataset.crop_size = None
+    meta_loader.dataset.crop_size = None
+
+    return train_loader, test_loader, meta_loader
+
+
+def init_eval_model(dataset_key: str, meta_optim_state_dict: dict,
+                    _config: dict, device: torch.device):
+    set_random_seeds(_config['seed'])
+
+    model, parent_states = init_parent_model(**_config['parent_model'])
+    if dataset_key in parent_states and parent_states[dataset_key]['states']:
+        if len(parent_states[dataset_key]['states']) > 1:
+            raise NotImplementedError
+        model.load_state_dict(parent_states[dataset_key]['states'][0])
+
+    meta_optim = MetaOptimizer(model, **_config['meta_optim_cfg'])
+    if meta_optim_state_dict is not None:
+        meta_optim.load_state_dict(meta_optim_state_dict)
 
-def evaluate(rank: int, dataset_key: str,
-             shared_meta_optim_state_dict: dict, shared_variables: dict,
-             _config: dict, shared_dict: dict, save_dir: str,
-             vis_win_names: dict, evaluate_only: bool, _log: logging):
-    seed = _config['seed']
+    model.to(device)
+    meta_optim.to(device)
+
+    if _config['data_cfg']['multi_object'] == 'single_id':
+        model.roi_heads.detections_per_img = 1
+
+    return model, meta_optim
+
+
+def fine_tune_cache_state_digest(fine_tune_cache: FineTuneCache, meta_optim_state_dict: dict, model):
+    """FineTuneCache.state_digest of an evaluation round or None without cache."""
+    if fine_tune_cache is None or not fine_tune_cache.enabled:
+        return None
+    return fine_tune_cache.state_digest(meta_optim_state_dict, model.state_dict())
+
+
+def shares_backbone(model, _config: dict):
+    """
+    The backbone features of a frame are the same for all objects of a
+    sequence if fine-tuning does not update the backbone.
+    """
+    if not _config['eval_shared_backbone'] or not isinstance(model, MaskRCNN):
+        return False
+    if any([p.requires_grad for p in model.backbone.parameters()]):
+        return False
+    # all objects are adapted in turn which requires a model reset at every step
+    return not _config['eval_online_adapt']['step'] \
+        or _config['eval_online_adapt']['reset_model_mode'] in ['FIRST_STEP', 'FULL']
+
+
+def evaluate_seq(seq_name: str, model, meta_optim, meta_optim_state_dict: dict,
+                 loaders: tuple, random_transformation_transforms,
+                 _config: dict, gt_cache: GroundTruthCache,
+                 fine_tune_cache: FineTuneCache = None, fine_tune_cache_digest: str = None):
+    """
+    Fine-tunes on and evaluates all object groups of a single sequence.
+    Returns the sequence metrics and the predicted label map of every frame.
+    fine_tune_cache_digest is the FineTuneCache.state_digest of the round.
+    """
     loss_func = _config['loss_func']
-    datasets = _config['datasets']
+    device = next(model.parameters()).device
+    train_loader, test_loader, meta_loader = loaders
 
-    torch.backends.cudnn.fastest = False
-    torch.backends.cudnn.benchmark = False
-    torch.backends.cudnn.deterministic = True
+    def early_stopping_func(loss_hist):
+        return early_stopping(loss_hist, **_config['train_early_stopping_cfg'])
 
-    data_cfg = copy.deepcopy(_config['data_cfg'])
+    init_J_seq = []
+    train_loss_seq = []
+    train_losses_seq = []
 
-    while True:
-        while shared_dict['meta_iter'] is not None:
-            time.sleep(0.25)
+    train_loader.dataset.set_seq(seq_name)
+    test_loader.dataset.set_seq(seq_name)
+    meta_loader.dataset.set_seq(seq_name)
 
-        meta_optim_state_dict = copy.deepcopy(shared_meta_optim_state_dict)
-        meta_iter = shared_variables['meta_iter']
-        meta_epoch = shared_variables['meta_epoch']
+    feature_cache = model.feature_cache if isinstance(model, MaskRCNN) else None
+    if feature_cache is not None:
+        # frames are not shared between sequences
+        feature_cache.clear()
+        feature_cache.reset_stats()
 
-        set_random_seeds(seed)
+    target_cache = model.target_cache if isinstance(model, MaskRCNN) else None
+    if target_cache is not None:
+        target_cache.clear()
+        target_cache.reset_stats()
 
-        device = torch.device(f'cuda:{rank}')
+    timer = StageTimer(device, **_config['stage_timer'])
+    for loader in loaders:
+        loader.dataset.stage_timer = timer
 
-        model, parent_states = init_parent_model(**_config['parent_model'])
-        if dataset_key in parent_states and parent_states[dataset_key]['states']:
-            if len(parent_states[dataset_key]['states']) > 1:
-                raise NotImplementedError
-            model.load_state_dict(parent_states[dataset_key]['states'][0])
+    if train_loader.dataset.num_object_groups == 1:
+        test_loader.dataset.multi_object_id = 0
 
-        meta_optim = MetaOptimizer(model, **_config['meta_optim_cfg'])
         meta_optim.load_state_dict(meta_optim_state_dict)
+        meta_optim.reset()
+        meta_optim.eval()
+
+        if test_loader.dataset.test_mode or test_loader.dataset.all_frames:
+            J = [0.0]
+        else:
+            _, _, J, _,  = eval_loader(model, test_loader, loss_func, gt_cache=gt_cache, timer=timer)
+        init_J_seq.extend(J)
+
+    boxes = [None] * len(test_loader.dataset)
+    masks = None
+
+    shared_backbone = shares_backbone(model, _config)
+
+    online_adapt_trigger = OnlineAdaptTrigger(min_prop=_config['eval_online_adapt']['min_prop'],
+                                              **_config['eval_online_adapt']['trigger'])
+    triggered = _config['eval_online_adapt']['step'] and online_adapt_trigger.enabled
+
+    # number of online adaptation steps and first mask channel of every object group
+    objs = []
+    for obj_id in range(train_loader.dataset.num_object_groups):
+        train_loader.dataset.multi_object_id = obj_id
+        train_loader.dataset.set_gt_frame_id()
+
+        if triggered:
+            # the steps end at the frames which trigger an adaptation
+            num_steps = None
+        elif _config['eval_online_adapt']['step']:
+            num_steps = len(range(train_loader.dataset.frame_id + 1,
+                                  len(test_loader.dataset),
+                                  _config['eval_online_adapt']['step']))
+        else:
+            # one iteration with original meta frame and evaluation of entire sequence
+            num_steps = 1
+
+        objs.append({'num_steps': num_steps,
+                     'next_step': 0,
+                     'eval_frame_range_max': train_loader.dataset.frame_id + 1,
+                     'channel': sum([obj['num_objects'] for obj in objs]),
+                     'num_objects': train_loader.dataset.num_objects_in_group,
+                     'boxes': {}})
+
+    def has_next_step(obj):
+        if obj['num_steps'] is None:
+            return obj['eval_frame_range_max'] < len(test_loader.dataset)
+        return obj['next_step'] < obj['num_steps']
+
+    def next_scheduled_steps():
+        steps = [(obj_id, obj['next_step']) for obj_id, obj in enumerate(objs) if has_next_step(obj)]
+        if shared_backbone:
+            # all objects run an online adaptation step before their joint inference
+            return steps
+        return steps[:1]
+
+    keyframes = KeyframeSelector(**_config['eval_keyframes'])
+    roi_crop = RoiCrop(**_config['eval_roi_crop'])
+
+    # the epochs of the first fine-tuning of every object
+    fine_tune_budget = FineTuneBudget(**_config['eval_fine_tune_budget'])
+    fine_tune_budget.start_seq(len(objs))
+    meta_optim.track_grad_norm = fine_tune_budget.tracks_grad_norm
+
+    def add_frame_range(obj, frame_ids, probs_frame_range, boxes_frame_range):
+        for frame_id, probs, box in zip(frame_ids, probs_frame_range.cpu(), boxes_frame_range.cpu()):
+            obj['boxes'][frame_id] = box
+            masks.set(frame_id, obj['channel'], probs)
+
+    start_eval = timeit.default_timer()
+    while True:
+        scheduled_steps = next_scheduled_steps()
+        if not scheduled_steps:
+            break
+        object_heads = []
 
-        model.to(device)
-        meta_optim.to(device)
+        for obj_id, eval_online_step_count in scheduled_steps:
+            obj = objs[obj_id]
+            obj['next_step'] += 1
 
-        train_loader, test_loader, meta_loader = data_loaders(  # pylint: disable=E1120
-            datasets[dataset_key], **data_cfg)
-        # remove random cropping
-        train_loader.dataset.crop_size = None
-        test_loader.dataset.crop_size = None
-        meta_loader.dataset.crop_size = None
+            train_loader.dataset.multi_object_id = obj_id
+            test_loader.dataset.multi_object_id = obj_id
+            meta_loader.dataset.multi_object_id = obj_id
 
-        def early_stopping_func(loss_hist):
-            return early_stopping(loss_hist, **_config['train_early_stopping_cfg'])
+            train_loader.dataset.set_gt_frame_id()
 
-        # save predictions in human readable format and with boxes
-        if save_dir is not None:
-            debug_preds_save_dir = os.path.join(save_dir,
-                                                'best_eval_preds_debug',
-                                                f"{datasets[dataset_key]['name']}",
-                                                f"{datasets[dataset_key]['split']}")
+            if _config['eval_online_adapt']['step']:
+                eval_online_adapt_step = _config['eval_online_adapt']['step']
+            else:
+                eval_online_adapt_step = len(test_loader.dataset)
 
-            if not os.path.exists(debug_preds_save_dir):
-                os.makedirs(debug_preds_save_dir)
+            # range [min, max[
+            if eval_online_step_count == 0:
+                train_frame = test_loader.dataset[train_loader.dataset.frame_id]
+                train_frame_gt = train_frame['gt']
 
-            for seq_name in train_loader.dataset.seqs_names:
-                if not os.path.exists(os.path.join(debug_preds_save_dir, seq_name)):
-                    os.makedirs(os.path.join(debug_preds_save_dir, seq_name))
+                if masks is None:
+                    masks = MaskAccumulator(len(test_loader.dataset),
+                                            sum([o['num_objects'] for o in objs]),
+                                            train_frame_gt.shape[1], train_frame_gt.shape[2],
+                                            **_config['eval_masks'])
 
-            preds_save_dir = os.path.join(save_dir,
-                                          'best_eval_preds',
-                                          f"{datasets[dataset_key]['name']}",
-                                          f"{datasets[dataset_key]['split']}")
-            if not os.path.exists(preds_save_dir):
-                os.makedirs(preds_save_dir)
-            for seq_name in train_loader.dataset.seqs_names:
-                if not os.path.exists(os.path.join(preds_save_dir, seq_name)):
-                    os.makedirs(os.path.join(preds_save_dir, seq_name))
+                masks.set(train_loader.dataset.frame_id, obj['channel'], 2 * train_frame_gt)
 
-        eval_time = 0
-        num_frames = 0
-        init_J_seq = []
-        J_seq = []
-        J_recall_seq = []
-        J_decay_seq = []
-        train_loss_seq = []
-        train_losses_seq = []
-        F_seq = []
-        F_recall_seq = []
-        F_decay_seq = []
-        masks = {}
-        boxes = {}
+                eval_frame_range_min = train_loader.dataset.frame_id + 1
+                eval_frame_range_max = eval_frame_range_min # + eval_online_adapt_step // 2
+            else:
+                # eval_frame_range_min = (meta_frame_id - eval_online_adapt_step // 2) + 1
+                eval_frame_range_min = obj['eval_frame_range_max']
+                eval_frame_range_max = eval_frame_range_min
 
-        if _config['data_cfg']['multi_object'] == 'single_id':
-            model.roi_heads.detections_per_img = 1
+                propagate_frame_gt = masks.get(eval_frame_range_min - 1,
+                                               obj['channel']).ge(_config['eval_online_adapt']['min_prop']).float()
 
-        random_transformation_transforms = train_loader.dataset.transform
+                propagate_frame_gts = []
+                for propagate_frame_id in range(1, _config['eval_online_adapt']['step']):
+                    # triggered adaptations might follow the first frame closer than step
+                    if eval_frame_range_min - propagate_frame_id < 0:
+                        propagate_frame_gts.append(None)
+                        continue
 
-        for seq_name in train_loader.dataset.seqs_names:
-            train_loader.dataset.set_seq(seq_name)
-            test_loader.dataset.set_seq(seq_name)
-            meta_loader.dataset.set_seq(seq_name)
+                    propagate_frame_gt_numpy = masks.get(eval_frame_range_min - propagate_frame_id,
+                                                         obj['channel']).ge(_config['eval_online_adapt']['min_prop']).float()
 
-            if train_loader.dataset.num_object_groups == 1:
-                test_loader.dataset.multi_object_id = 0
+                    propagate_frame_gt_numpy = np.copy(np.transpose(propagate_frame_gt_numpy.cpu().numpy(), (1, 2, 0)))
 
+                    propagate_frame_gts.append(
+                        propagate_frame_gt_numpy)
+
+            eval_frame_range_max += eval_online_adapt_step
+            # if eval_frame_range_max + (eval_online_adapt_step // 2 + 1) > len(test_loader.dataset):
+            if eval_frame_range_max > len(test_loader.dataset):
+                eval_frame_range_max = len(test_loader.dataset)
+            obj['eval_frame_range_max'] = eval_frame_range_max
+
+            # load_state_dict(model, seq_name, parent_states[dataset_key])
+            if eval_online_step_count == 0 or _config['eval_online_adapt']['reset_model_mode'] == 'FULL':
                 meta_optim.load_state_dict(meta_optim_state_dict)
                 meta_optim.reset()
                 meta_optim.eval()
+            elif _config['eval_online_adapt']['reset_model_mode'] == 'FIRST_STEP':
+                meta_optim.load_state_dict(meta_optim_state_dict)
 
-                if test_loader.dataset.test_mode or test_loader.dataset.all_frames:
-                    J = [0.0]
-                else:
-                    _, _, J, _,  = eval_loader(model, test_loader, loss_func)
-                init_J_seq.extend(J)
-
-            boxes[seq_name] = [None] * len(test_loader.dataset)
-            masks[seq_name] = []
-
-            for obj_id in range(train_loader.dataset.num_object_groups):
-                train_loader.dataset.multi_object_id = obj_id
-                test_loader.dataset.multi_object_id = obj_id
-                meta_loader.dataset.multi_object_id = obj_id
-
-                train_loader.dataset.set_gt_frame_id()
-                num_objects_in_group = train_loader.dataset.num_objects_in_group
-
-                # evaluation with online adaptation
-                if _config['eval_online_adapt']['step']:
-                    eval_online_adapt_step = _config['eval_online_adapt']['step']
-                    meta_frame_iter = range(train_loader.dataset.frame_id + 1,
-                                            len(test_loader.dataset),
-                                            eval_online_adapt_step)
-                else:
-                    # one iteration with original meta frame and evaluation of entire sequence
-                    eval_online_adapt_step = len(test_loader.dataset)
-                    meta_frame_iter = [meta_loader.dataset.frame_id]
-
-                # meta_frame_id might be a str, e.g., 'middle'
-                start_eval = timeit.default_timer()
-                for eval_online_step_count, _ in enumerate(meta_frame_iter):
-                    # range [min, max[
-                    if eval_online_step_count == 0:
-                        train_frame = test_loader.dataset[train_loader.dataset.frame_id]
-                        train_frame_gt = train_frame['gt']
+                model.load_state_dict(obj['model_state_dict_first_step'], strict=not shared_backbone)
 
-                        for frame_id in range(len(test_loader.dataset)):
-                            if not obj_id:
-                                masks[seq_name].append(torch.zeros(num_objects_in_group, train_frame_gt.shape[1], train_frame_gt.shape[2]))
-                            else:
-                                masks[seq_name][frame_id] = torch.cat([
-                                    masks[seq_name][frame_id],
-                                    torch.zeros(num_objects_in_group, train_frame_gt.shape[1], train_frame_gt.shape[2])])
+                meta_optim.eval()
 
-                        masks[seq_name][train_loader.dataset.frame_id][obj_id,
-                                                                       :, :] = 2 * train_frame_gt
+            train_loss_hist = []
+            if eval_online_step_count == 0:
+                num_epochs = _config['num_epochs']['eval']
+            else:
+                num_epochs = _config['eval_online_adapt']['num_epochs']
+
+            if eval_online_step_count == 0:
+                fine_tune_budget.start_obj(obj_id, num_epochs)
+
+            fine_tune_cache_key = None
+            fine_tune_cache_entry = None
+            if eval_online_step_count == 0 and fine_tune_cache_digest is not None:
+                fine_tune_cfg = {'train_frame': test_loader.dataset.imgs[train_loader.dataset.frame_id],
+                                 'num_epochs': num_epochs,
+                                 'seed': _config['seed'],
+                                 'train_early_stopping_cfg': _config['train_early_stopping_cfg'],
+                                 'fine_tune_budget': _config['eval_fine_tune_budget'],
+                                 'resolution_schedule': _config['eval_resolution_schedule'],
+                                 'data_cfg': _config['data_cfg'],
+                                 'parent_model': _config['parent_model'],
+                                 'meta_optim_cfg': _config['meta_optim_cfg']}
+                fine_tune_cache_key = fine_tune_cache.key(
+                    seq_name, obj_id, fine_tune_cache_digest, fine_tune_cfg)
+                fine_tune_cache_entry = fine_tune_cache.load(fine_tune_cache_key, meta_optim)
+
+            if fine_tune_cache_entry is not None:
+                # the parameters of the first fine-tuning step are restored
+                num_epochs = 0
+                train_loss = fine_tune_cache_entry['train_loss']
+                train_losses = fine_tune_cache_entry['train_losses']
+
+            model.train_without_dropout()
+
+            if eval_online_step_count:
+                train_loader.dataset.transform = custom_transforms.ToTensor()
+            else:
+                train_loader.dataset.transform = random_transformation_transforms
 
-                        eval_frame_range_min = train_loader.dataset.frame_id + 1
-                        eval_frame_range_max = eval_frame_range_min # + eval_online_adapt_step // 2
-                    else:
-                        # eval_frame_range_min = (meta_frame_id - eval_online_adapt_step // 2) + 1
-                        eval_frame_range_min = eval_frame_range_max
+            stop_fine_tuning = False
+            for epoch in epoch_iter(num_epochs):
+                set_random_seeds(
+                    _config['seed'] + epoch + eval_online_step_count)
 
-                        propagate_frame_gt = masks[seq_name][eval_frame_range_min -
-                                                             1][obj_id: obj_id + 1].ge(_config['eval_online_adapt']['min_prop']).float()
+                if isinstance(model, MaskRCNN):
+                    model.transform_scale = transform_scale(_config['eval_resolution_schedule'], epoch)
 
-                        propagate_frame_gts = []
-                        for propagate_frame_id in range(1, _config['eval_online_adapt']['step']):
+                for sample_batched in timed_iter(timer, 'data', train_loader):
+                    inputs, gts = sample_batched['image'], sample_batched['gt']
 
-                            propagate_frame_gt_numpy = masks[seq_name][eval_frame_range_min -
-                                                                       propagate_frame_id][obj_id: obj_id + 1].ge(_config['eval_online_adapt']['min_prop']).float()
+                    if eval_online_step_count:
+                        inputs = inputs[:1]
+                        gts = gts[:1]
 
-                            propagate_frame_gt_numpy = np.copy(np.transpose(propagate_frame_gt_numpy.cpu().numpy(), (1, 2, 0)))
+                        num_propagte_frames = min(
+                            _config['eval_online_adapt']['step'],
+                            _config['data_cfg']['batch_sizes']['train'])
+                        start_propagate_frame = _config['eval_online_adapt']['step'] - num_propagte_frames + 1
 
-                            propagate_frame_gts.append(
-                                propagate_frame_gt_numpy)
+                        for propagate_frame_id in range(start_propagate_frame, _config['eval_online_adapt']['step']):
+                            propagate_frame_gt_numpy = propagate_frame_gts[propagate_frame_id - 1]
 
-                    eval_frame_range_max += eval_online_adapt_step
-                    # if eval_frame_range_max + (eval_online_adapt_step // 2 + 1) > len(test_loader.dataset):
-                    if eval_frame_range_max > len(test_loader.dataset):
-                        eval_frame_range_max = len(test_loader.dataset)
+                            if propagate_frame_gt_numpy is not None and (propagate_frame_gt_numpy == 1.0).astype(float).sum().item() != 0:
+                                train_loader.dataset.frame_id = eval_frame_range_min - propagate_frame_id
+                                train_loader.dataset.propagate_frame_gt = propagate_frame_gt_numpy
 
-                    # load_state_dict(model, seq_name, parent_states[dataset_key])
-                    if eval_online_step_count == 0 or _config['eval_online_adapt']['reset_model_mode'] == 'FULL':
-                        meta_optim.load_state_dict(meta_optim_state_dict)
-                        meta_optim.reset()
-                        meta_optim.eval()
-                    elif _config['eval_online_adapt']['reset_model_mode'] == 'FIRST_STEP':
-                        meta_optim.load_state_dict(meta_optim_state_dict)
+                                for sample_batched in timed_iter(timer, 'data', train_loader):
+                                    inputs_propagate, gts_propagate = sample_batched['image'], sample_batched['gt']
 
-                        model.load_state_dict(model_state_dict_first_step)
+                                inputs = torch.cat(
+                                    [inputs,
+                                    inputs_propagate[:1]])
+                                gts = torch.cat([gts,
+                                                gts_propagate[:1]])
 
-                        meta_optim.eval()
+                        train_loader.dataset.propagate_frame_gt = None
+                        train_loader.dataset.set_gt_frame_id()
 
-                    train_loss_hist = []
-                    if eval_online_step_count == 0:
-                        num_epochs = _config['num_epochs']['eval']
-                    else:
-                        num_epochs = _config['eval_online_adapt']['num_epochs']
+                    inputs, gts = inputs.to(device), gts.to(device)
 
-                    model.train_without_dropout()
-
-                    if eval_online_step_count:
-                        train_loader.dataset.transform = custom_transforms.ToTensor()
-                    else:
-                        train_loader.dataset.transform = random_transformation_transforms
+                    with stage(timer, 'fine_tune_forward'):
+                        if isinstance(model, MaskRCNN):
+                            train_loss, train_losses = model(inputs, gts)
+                        else:
+                            outputs = model(inputs)
+                            train_loss = compute_loss(loss_func, outputs[-1], gts)
 
-                    for epoch in epoch_iter(num_epochs):
-                        set_random_seeds(
-                            _config['seed'] + epoch + eval_online_step_count)
+                    train_loss_hist.append(train_loss.item())
 
-                        for _, sample_batched in enumerate(train_loader):
-                            inputs, gts = sample_batched['image'], sample_batched['gt']
+                    model.zero_grad()
 
-                            if eval_online_step_count:
-                                inputs = inputs[:1]
-                                gts = gts[:1]
+                    meta_optim.set_train_loss(train_loss)
 
-                                num_propagte_frames = min(
-                                    _config['eval_online_adapt']['step'],
-                                    _config['data_cfg']['batch_sizes']['train'])
-                                start_propagate_frame = _config['eval_online_adapt']['step'] - num_propagte_frames + 1
+                    if _config['eval_online_adapt']['reset_model_mode'] == 'FIRST_STEP':
+                        meta_optim.only_box_head = eval_online_step_count != 0
 
-                                for propagate_frame_id in range(start_propagate_frame, _config['eval_online_adapt']['step']):
-                                    propagate_frame_gt_numpy = propagate_frame_gts[propagate_frame_id - 1]
+                    # gradients are computed by the meta optimizer step
+                    with stage(timer, 'fine_tune_step'):
+                        meta_optim.step(train_loss)
 
-                                    if (propagate_frame_gt_numpy == 1.0).astype(float).sum().item() != 0:
-                                        train_loader.dataset.frame_id = eval_frame_range_min - propagate_frame_id
-                                        train_loader.dataset.propagate_frame_gt = propagate_frame_gt_numpy
+                    meta_optim.meta_model.detach_param_groups()
 
-                                        for _, sample_batched in enumerate(train_loader):
-                                            inputs_propagate, gts_propagate = sample_batched['image'], sample_batched['gt']
+                    stop_fine_tuning = early_stopping_func(train_loss_hist)
+                    if eval_online_step_count == 0:
+                        fine_tune_budget.add_epoch(train_loss_hist[-1], meta_optim.state.get('grad_norm'))
+                        stop_fine_tuning = fine_tune_budget.stop() or stop_fine_tuning
 
-                                        inputs = torch.cat(
-                                            [inputs,
-                                            inputs_propagate[:1]])
-                                        gts = torch.cat([gts,
-                                                        gts_propagate[:1]])
+                    if stop_fine_tuning:
+                        break
 
-                                train_loader.dataset.propagate_frame_gt = None
-                                train_loader.dataset.set_gt_frame_id()
+                if stop_fine_tuning:
+                    break
+            train_loss_seq.append(train_loss.item())
 
-                            inputs, gts = inputs.to(device), gts.to(device)
+            if isinstance(model, MaskRCNN):
+                model.transform_scale = 1.0
 
-                            if isinstance(model, MaskRCNN):
-                                train_loss, train_losses = model(inputs, gts)
-                            else:
-                                outputs = model(inputs)
-                                train_loss = compute_loss(loss_func, outputs[-1], gts)
+            if eval_online_step_count == 0:
+                fine_tune_budget.end_obj(cached=fine_tune_cache_entry is not None)
 
-                            train_loss_hist.append(train_loss.item())
+            if fine_tune_cache_key is not None and fine_tune_cache_entry is None:
+                fine_tune_cache.save(fine_tune_cache_key, meta_optim, train_loss,
+                                     train_losses if isinstance(model, MaskRCNN) else {})
 
-                            model.zero_grad()
+            if eval_online_step_count == 0 and (obj['num_steps'] is None or obj['num_steps'] > 1):
+                # meta_optim_state_dict_first_step = copy.deepcopy(
+                #     meta_optim.state_dict())
+                model_state_dict_first_step = model.state_dict()
+                if shared_backbone:
+                    # the frozen backbone is not stored per object
+                    model_state_dict_first_step = {k: v for k, v in model_state_dict_first_step.items()
+                                                   if not k.startswith('backbone.')}
+                obj['model_state_dict_first_step'] = copy.deepcopy(model_state_dict_first_step)
 
-                            meta_optim.set_train_loss(train_loss)
+            if _config['parent_model']['architecture'] == 'MaskRCNN':
+                train_losses_seq.append({k: v.cpu().item()
+                                        for k, v in train_losses.items()})
 
-                            if _config['eval_online_adapt']['reset_model_mode'] == 'FIRST_STEP':
-                                meta_optim.only_box_head = eval_online_step_count != 0
+            # run model on frame range
+            test_frame_ids = range(eval_frame_range_min, eval_frame_range_max)
 
-                            meta_optim.step(train_loss)
+            if eval_online_step_count == 0:
+                targets = train_frame_gt.unsqueeze(dim=0)
+            else:
+                targets = propagate_frame_gt.unsqueeze(dim=0)
+
+            # the frame range ends before the frame which triggers the next adaptation
+            stop_func = None
+            if triggered:
+                stop_func = online_adapt_trigger.stop_func(
+                    obj_id, test_frame_ids,
+                    masks.get(eval_frame_range_min - 1, obj['channel'], obj['num_objects']))
+
+            if shared_backbone:
+                # the fine-tuned heads are evaluated once all objects finished this step
+                object_heads.append({'obj_id': obj_id,
+                                     'rpn': copy.deepcopy(model.rpn),
+                                     'roi_heads': copy.deepcopy(model.roi_heads),
+                                     'frame_ids': test_frame_ids,
+                                     'start_targets': targets,
+                                     'stop_func': stop_func})
+            else:
+                test_loader.sampler.indices = test_frame_ids
+                _, _, probs_frame_range, boxes_frame_range = run_loader(model, test_loader, loss_func, return_probs=True, start_targets=targets, timer=timer, stop_func=stop_func,
+                                                                        keyframes=keyframes if keyframes.enabled else None,
+                                                                        roi_crop=roi_crop if roi_crop.enabled else None)
+                test_loader.sampler.indices = None
+
+                add_frame_range(obj, test_frame_ids, probs_frame_range, boxes_frame_range)
+                obj['eval_frame_range_max'] = test_frame_ids.start + len(probs_frame_range)
+
+        if object_heads:
+            object_outputs = run_loader_shared_backbone(model, test_loader, object_heads, timer=timer,
+                                                        keyframes=keyframes if keyframes.enabled else None,
+                                                        roi_crop=roi_crop if roi_crop.enabled else None)
+            for obj_heads, (probs_frame_range, boxes_frame_range) in zip(object_heads, object_outputs):
+                obj = objs[obj_heads['obj_id']]
+                add_frame_range(obj, obj_heads['frame_ids'], probs_frame_range, boxes_frame_range)
+                obj['eval_frame_range_max'] = obj_heads['frame_ids'].start + len(probs_frame_range)
+
+        for obj in objs:
+            if not has_next_step(obj):
+                obj.pop('model_state_dict_first_step', None)
+
+    eval_time = timeit.default_timer() - start_eval
+    num_frames = len(objs) * len(test_loader.dataset)
+
+    for frame_id in range(len(test_loader.dataset)):
+        frame_boxes = [obj['boxes'][frame_id] for obj in objs if frame_id in obj['boxes']]
+        if frame_boxes:
+            boxes[frame_id] = torch.cat(frame_boxes)
+
+    # merge all probability maps and set object predictions by argmax
+    with stage(timer, 'postprocessing'):
+        preds = masks.merge()
+    masks.close()
+
+    if test_loader.dataset.test_mode:
+        evaluation = {'J': {'mean': [0.0], 'recall': [0.0], 'decay': [0.0]},
+                      'F': {'mean': [0.0], 'recall': [0.0], 'decay': [0.0]}}
+    else:
+        # score the in-memory predictions. frames without ground truth are skipped.
+        with stage(timer, 'metrics'):
+            seq_evaluator = init_seq_evaluator(test_loader.dataset, gt_cache)
+            for frame_id, pred in enumerate(preds):
+                seq_evaluator.add_frame(test_loader.dataset.imgs[frame_id], pred[0].numpy())
+            evaluation = seq_evaluator.result()
+
+    for loader in loaders:
+        loader.dataset.stage_timer = None
+
+    return {'init_J': init_J_seq,
+            'train_loss': train_loss_seq,
+            'train_losses': train_losses_seq,
+            'evaluation': evaluation,
+            'masks': preds,
+            'boxes': boxes,
+            'eval_time': eval_time,
+            'num_frames': num_frames,
+            'feature_cache': None if feature_cache is None else feature_cache.stats(),
+            'target_cache': None if target_cache is None else target_cache.stats(),
+            'fine_tune_epochs': fine_tune_budget.records,
+            'keyframes': keyframes.summary(),
+            'roi_crop': roi_crop.summary(),
+            'online_adapt': {'num_adaptations': sum([max(0, obj['next_step'] - 1) for obj in objs]),
+                             'triggers': online_adapt_trigger.events},
+            'stage_timings': timer.summary()}
+
+
+def _eval_worker(worker_id: int, dataset_key: str, _config: dict,
+                 device: torch.device, num_threads: int, parent_pid: int,
+                 task_queue: mp.Queue, result_queue: mp.Queue):
+    mp.set_sharing_strategy('file_system')
 
-                            meta_optim.meta_model.detach_param_groups()
+    torch.backends.cudnn.fastest = False
+    torch.backends.cudnn.benchmark = False
+    torch.backends.cudnn.deterministic = True
 
-                            if early_stopping_func(train_loss_hist):
-                                break
+    # the core slice of the eval process is inherited and split among its workers
+    if device.type == 'cpu':
+        set_cpu_threads_for_process(worker_id, num_threads)
 
-                        if early_stopping_func(train_loss_hist):
-                            break
-                    train_loss_seq.append(train_loss.item())
+    gt_cache = GroundTruthCache(_config['eval_gt_cache_dir'])
+    fine_tune_cache = FineTuneCache(**_config['eval_fine_tune_cache'])
+    loaders = init_eval_loaders(dataset_key, _config)
+    random_transformation_transforms = loaders[0].dataset.transform
 
-                    if eval_online_step_count == 0:
-                        # meta_optim_state_dict_first_step = copy.deepcopy(
-                        #     meta_optim.state_dict())
-                        model_state_dict_first_step = copy.deepcopy(
-                            model.state_dict())
+    eval_round = None
+    while True:
+        try:
+            task = task_queue.get(timeout=5.0)
+        except queue.Empty:
+            # the eval process was terminated
+            if os.getppid() != parent_pid:
+                break
+            continue
+
+        if task is None:
+            break
+
+        task_eval_round, meta_optim_state_dict, seq_name = task
+        if task_eval_round != eval_round:
+            model, meta_optim = init_eval_model(
+                dataset_key, meta_optim_state_dict, _config, device)
+            fine_tune_cache_digest = fine_tune_cache_state_digest(
+                fine_tune_cache, meta_optim_state_dict, model)
+            eval_round = task_eval_round
+
+        result_queue.put((seq_name, evaluate_seq(
+            seq_name, model, meta_optim, meta_optim_state_dict, loaders,
+            random_transformation_transforms, _config, gt_cache, fine_tune_cache,
+            fine_tune_cache_digest)))
+
+
+class EvalWorkerPool:
+    """
+    Pool of worker processes which fine-tune and evaluate the sequences of a
+    dataset in parallel. Workers run on the device of their eval process.
+    On CPU they split its core slice. Every worker fetches one sequence at a
+    time, i.e., long sequences are balanced dynamically.
+    """
+
+    def __init__(self, dataset_key: str, _config: dict, device: torch.device,
+                 num_workers: int, num_threads: int = None):
+        self._dataset_key = dataset_key
+        self._config = _config
+        self._device = device
+        self._num_workers = num_workers
+        self._num_threads = num_threads
+
+        self._workers = []
+        self._task_queue = None
+        self._result_queue = None
+        self._eval_round = 0
+
+    def start(self):
+        ctx = mp.get_context('spawn')
+        self._task_queue = ctx.Queue()
+        self._result_queue = ctx.Queue()
+
+        for worker_id in range(self._num_workers):
+            worker = ctx.Process(
+                target=_eval_worker,
+                args=(worker_id, self._dataset_key, self._config, self._device,
+                      self._num_threads, os.getpid(),
+                      self._task_queue, self._result_queue),
+                daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def close(self):
+        for _ in self._workers:
+            self._task_queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout=5.0)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
+
+    def run(self, meta_optim_state_dict: dict, seq_names: list):
+        """Returns the evaluate_seq results in the order of seq_names."""
+        self._eval_round += 1
+        for seq_name in seq_names:
+            self._task_queue.put((self._eval_round, meta_optim_state_dict, seq_name))
+
+        seq_results = {}
+        while len(seq_results) < len(seq_names):
+            try:
+                seq_name, seq_result = self._result_queue.get(timeout=60.0)
+            except queue.Empty:
+                if not all(w.is_alive() for w in self._workers):
+                    raise RuntimeError('Evaluation worker died.')
+                continue
+            seq_results[seq_name] = seq_result
+
+        return [seq_results[seq_name] for seq_name in seq_names]
 
-                    if _config['parent_model']['architecture'] == 'MaskRCNN':
-                        train_losses_seq.append({k: v.cpu().item()
-                                                for k, v in train_losses.items()})
 
-                    # run model on frame range
-                    test_loader.sampler.indices = range(eval_frame_range_min, eval_frame_range_max)
+def evaluate(rank: int, dataset_key: str,
+             shared_meta_optim_state_dict: dict, shared_variables: dict,
+             _config: dict, shared_dict: dict, save_dir: str,
+             vis_win_names: dict, evaluate_only: bool, _log: logging):
+    datasets = _config['datasets']
 
-                    if eval_online_step_count == 0:
-                        targets = train_frame_gt.unsqueeze(dim=0)
-                    else:
-                        targets = propagate_frame_gt.unsqueeze(dim=0)
+    torch.backends.cudnn.fastest = False
+    torch.backends.cudnn.benchmark = False
+    torch.backends.cudnn.deterministic = True
 
-                    _, _, probs_frame_range, boxes_frame_range = run_loader(model, test_loader, loss_func, return_probs=True, start_targets=targets)
-                    probs_frame_range = probs_frame_range.cpu()
-                    boxes_frame_range = boxes_frame_range.cpu()
+    device = device_for_eval_process(rank)
+    if device.type == 'cpu':
+        set_cpu_threads_for_process(rank, _config['num_cpu_threads_per_process'])
 
-                    for frame_id, probs, box in zip(test_loader.sampler.indices, probs_frame_range, boxes_frame_range):
+    checkpoint_writer = CheckpointWriter()
 
-                        if boxes[seq_name][frame_id] is None:
-                            boxes[seq_name][frame_id] = box
-                        else:
-                            boxes[seq_name][frame_id] = torch.cat([boxes[seq_name][frame_id], box])
+    # the ground truth of the split is evaluated after every meta iteration
+    gt_cache = GroundTruthCache(_config['eval_gt_cache_dir'])
+    fine_tune_cache = FineTuneCache(**_config['eval_fine_tune_cache'])
 
-                        masks[seq_name][frame_id][-num_objects_in_group:, :, :] = probs
+    eval_worker_pool = None
+    if _config['num_eval_workers'] > 1:
+        num_worker_threads = None
+        if device.type == 'cpu':
+            num_worker_threads = max(
+                1, _config['num_cpu_threads_per_process'] // _config['num_eval_workers'])
 
-                    test_loader.sampler.indices = None
+        eval_worker_pool = EvalWorkerPool(dataset_key, _config, device,
+                                          _config['num_eval_workers'],
+                                          num_worker_threads)
+        eval_worker_pool.start()
 
-                    if eval_frame_range_max == len(test_loader.dataset):
-                        break
+    while True:
+        while shared_dict['meta_iter'] is not None:
+            time.sleep(0.25)
 
-                eval_time += (timeit.default_timer() - start_eval)
-                num_frames += len(test_loader.dataset)
+        meta_optim_state_dict = copy.deepcopy(shared_meta_optim_state_dict)
+        meta_iter = shared_variables['meta_iter']
+        meta_epoch = shared_variables['meta_epoch']
 
-            # merge all logit maps and set object predictions by argmax
-            for frame_id in range(len(test_loader.dataset)):
-                background_mask = masks[seq_name][frame_id].max(dim=0, keepdim=True)[0].lt(0.5)
-                masks[seq_name][frame_id] = masks[seq_name][frame_id].argmax(dim=0, keepdim=True).float() + 1.0
-                masks[seq_name][frame_id][background_mask] = 0.0
+        train_loader, test_loader, meta_loader = init_eval_loaders(dataset_key, _config)
 
-            # TODO: refactor
-            # assert test_loader.dataset.frame_id is None
-            test_loader_frame_id = test_loader.dataset.frame_id
-            test_loader.dataset.frame_id = None
-            for frame_id, mask_frame in enumerate(masks[seq_name]):
-                file_name = test_loader.dataset[frame_id]['file_name']
+        # save predictions in human readable format and with boxes
+        if save_dir is not None:
+            debug_preds_save_dir = os.path.join(save_dir,
+                                                'best_eval_preds_debug',
+                                                f"{datasets[dataset_key]['name']}",
+                                                f"{datasets[dataset_key]['split']}")
 
-                if test_loader.dataset.all_frames and not any([file_name in l for l in test_loader.dataset.labels]):
-                    continue
+            if not os.path.exists(debug_preds_save_dir):
+                os.makedirs(debug_preds_save_dir)
 
-                mask_frame = np.transpose(mask_frame.cpu().numpy(), (1, 2, 0)).astype(np.uint8)
+            for seq_name in train_loader.dataset.seqs_names:
+                if not os.path.exists(os.path.join(debug_preds_save_dir, seq_name)):
+                    os.makedirs(os.path.join(debug_preds_save_dir, seq_name))
 
-                pred_path = os.path.join(preds_save_dir, seq_name, os.path.basename(file_name) + '.png')
+        preds_save_dir = None
+        if save_dir is not None and _config['save_eval_preds']:
+            preds_save_dir = os.path.join(save_dir,
+                                          'best_eval_preds',
+                                          f"{datasets[dataset_key]['name']}",
+                                          f"{datasets[dataset_key]['split']}")
+            if not os.path.exists(preds_save_dir):
+                os.makedirs(preds_save_dir)
+            for seq_name in train_loader.dataset.seqs_names:
+                if not os.path.exists(os.path.join(preds_save_dir, seq_name)):
+                    os.makedirs(os.path.join(preds_save_dir, seq_name))
 
-                imageio.imsave(pred_path, mask_frame)
-            test_loader.dataset.frame_id = test_loader_frame_id
+        seq_names = train_loader.dataset.seqs_names
+        if eval_worker_pool is not None:
+            # longest sequences first for a better balance among the workers
+            sorted_seq_names = sorted(seq_names, reverse=True,
+                                      key=lambda s: len(test_loader.dataset.seqs[s]['imgs']))
+            seq_results = dict(zip(sorted_seq_names, eval_worker_pool.run(
+                meta_optim_state_dict, sorted_seq_names)))
+            seq_results = [seq_results[seq_name] for seq_name in seq_names]
+        else:
+            model, meta_optim = init_eval_model(
+                dataset_key, meta_optim_state_dict, _config, device)
+            random_transformation_transforms = train_loader.dataset.transform
+            fine_tune_cache_digest = fine_tune_cache_state_digest(
+                fine_tune_cache, meta_optim_state_dict, model)
+
+            seq_results = [evaluate_seq(seq_name, model, meta_optim, meta_optim_state_dict,
+                                        (train_loader, test_loader, meta_loader),
+                                        random_transformation_transforms, _config, gt_cache,
+                                        fine_tune_cache, fine_tune_cache_digest)
+                           for seq_name in seq_names]
 
-            if test_loader.dataset.test_mode:
-                evaluation = {'J': {'mean': [0.0], 'recall': [0.0], 'decay': [0.0]},
-                              'F': {'mean': [0.0], 'recall': [0.0], 'decay': [0.0]}}
-            else:
-                evaluation = eval_davis_seq(preds_save_dir, seq_name)
+        eval_time = 0
+        num_frames = 0
+        init_J_seq = []
+        J_seq = []
+        J_recall_seq = []
+        J_decay_seq = []
+        train_loss_seq = []
+        train_losses_seq = []
+        F_seq = []
+        F_recall_seq = []
+        F_decay_seq = []
+        masks = {}
+        boxes = {}
+        feature_cache_stats = []
+        target_cache_stats = []
+        fine_tune_epochs = []
+        num_online_adaptations = 0
+        num_online_adapt_triggers = 0
+        num_propagated_frames = 0
+        seqs_stage_timings = {}
+
+        # merge in the order of the split
+        for seq_name, seq_result in zip(seq_names, seq_results):
+            evaluation = seq_result['evaluation']
+
+            init_J_seq.extend(seq_result['init_J'])
+            train_loss_seq.extend(seq_result['train_loss'])
+            train_losses_seq.extend(seq_result['train_losses'])
+            eval_time += seq_result['eval_time']
+            num_frames += seq_result['num_frames']
+            masks[seq_name] = seq_result['masks']
+            boxes[seq_name] = seq_result['boxes']
+            if seq_result['feature_cache'] is not None:
+                feature_cache_stats.append(seq_result['feature_cache'])
+            if seq_result['target_cache'] is not None:
+                target_cache_stats.append(seq_result['target_cache'])
+            fine_tune_epochs.extend(seq_result['fine_tune_epochs'])
+            num_online_adaptations += seq_result['online_adapt']['num_adaptations']
+            num_online_adapt_triggers += len(seq_result['online_adapt']['triggers'])
+            num_propagated_frames += seq_result['keyframes']['num_propagated']
+            seqs_stage_timings[seq_name] = {
+                'num_frames': seq_result['num_frames'],
+                'eval_time': seq_result['eval_time'],
+                'frames_per_second': seq_result['num_frames'] / seq_result['eval_time'],
+                'fine_tune_epochs': seq_result['fine_tune_epochs'],
+                'online_adapt': seq_result['online_adapt'],
+                'keyframes': seq_result['keyframes'],
+                'roi_crop': seq_result['roi_crop'],
+                'stages': seq_result['stage_timings']}
 
             if evaluate_only:
                 _log.info(f"{dataset_key}: {seq_name} {evaluation['J']['mean']}")
@@ -358,29 +763,50 @@ def evaluate(rank: int, dataset_key: str,
             F_recall_seq.extend(evaluation['F']['recall'])
             F_decay_seq.extend(evaluation['F']['decay'])
 
+        mean_J = torch.tensor(J_seq).mean().item()
+
+        # stages outside of the sequence evaluations, e.g., writing predictions
+        timer = StageTimer(device, **_config['stage_timer'])
+
+        # the evaluated state and not the fine-tuned meta_optim
+        save_meta_run = {'meta_optim_state_dict': meta_optim_state_dict,
+                         'vis_win_names': vis_win_names,
+                         'meta_iter': meta_iter,
+                         'meta_epoch': meta_epoch,
+                         'mean_J': mean_J}
+
         if save_dir is not None:
             if not test_loader.dataset.test_mode:
-                save_meta_run = {'meta_optim_state_dict': meta_optim.state_dict(),
-                                'vis_win_names': vis_win_names,
-                                'meta_iter': meta_iter,
-                                'meta_epoch': meta_epoch,}
-                torch.save(save_meta_run, os.path.join(
+                checkpoint_writer.save(save_meta_run, os.path.join(
                     save_dir, f"last_{dataset_key}_meta_iter.model"))
 
-        mean_J = torch.tensor(J_seq).mean().item()
-
         if test_loader.dataset.test_mode or mean_J > shared_dict['best_mean_J']:
             shared_dict['best_mean_J'] = mean_J
 
             if save_dir is not None:
                 if not test_loader.dataset.test_mode:
-                    save_meta_run = {'meta_optim_state_dict': meta_optim.state_dict(),
-                                    'vis_win_names': vis_win_names,
-                                    'meta_iter': meta_iter,
-                                    'meta_epoch': meta_epoch,}
-                    torch.save(save_meta_run, os.path.join(
+                    checkpoint_writer.save(save_meta_run, os.path.join(
                         save_dir, f"best_{dataset_key}_meta_iter.model"))
 
+                # predictions in the davis format, e.g., for a challenge submission
+                if preds_save_dir is not None:
+                    for seq_name, masks_seq in masks.items():
+                        test_loader.dataset.set_seq(seq_name)
+
+                        for frame_id, mask_frame in enumerate(masks_seq):
+                            file_name = os.path.splitext(os.path.basename(
+                                test_loader.dataset.imgs[frame_id]))[0]
+
+                            if test_loader.dataset.all_frames and not any([file_name in l for l in test_loader.dataset.labels]):
+                                continue
+
+                            mask_frame = np.transpose(mask_frame.cpu().numpy(), (1, 2, 0)).astype(np.uint8)
+
+                            pred_path = os.path.join(preds_save_dir, seq_name, file_name + '.png')
+
+                            with stage(timer, 'png_writing'):
+                                imageio.imsave(pred_path, mask_frame)
+
                 test_loader_frame_id = test_loader.dataset.frame_id
                 test_loader.dataset.frame_id = None
                 for (seq_name, masks_seq), (_, boxes_seq) in zip(masks.items(), boxes.items()):
@@ -420,7 +846,8 @@ def evaluate(rank: int, dataset_key: str,
 
                         plt.axis('off')
                         plt.draw()
-                        plt.savefig(pred_path, dpi=100)
+                        with stage(timer, 'png_writing'):
+                            plt.savefig(pred_path, dpi=100)
                         plt.close()
                 test_loader.dataset.frame_id = test_loader_frame_id
 
@@ -434,6 +861,31 @@ def evaluate(rank: int, dataset_key: str,
         shared_dict['F_recall_seq'] = F_recall_seq
         shared_dict['F_decay_seq'] = F_decay_seq
         shared_dict['time_per_frame'] = eval_time / num_frames
+        shared_dict['feature_cache_hit_rate'] = hit_rate(feature_cache_stats)
+        shared_dict['target_cache_hit_rate'] = hit_rate(target_cache_stats)
+        shared_dict['fine_tune_epochs'] = np.mean([r['epochs'] for r in fine_tune_epochs]).item()
+        shared_dict['fine_tune_epochs_saved'] = saved_epochs(fine_tune_epochs)
+        shared_dict['num_online_adaptations'] = num_online_adaptations
+        shared_dict['num_online_adapt_triggers'] = num_online_adapt_triggers
+        shared_dict['propagated_frames'] = num_propagated_frames / num_frames
+        shared_dict['roi_crop_area'] = RoiCrop.merge_summaries(
+            [s['roi_crop'] for s in seqs_stage_timings.values()])
+
+        stage_timings = merge_summaries([s['stages'] for s in seqs_stage_timings.values()]
+                                        + [timer.summary()])
+        shared_dict['stage_timings'] = format_summary(stage_timings)
+        if save_dir is not None:
+            save_json({'meta_iter': meta_iter,
+                       'num_frames': num_frames,
+                       'eval_time': eval_time,
+                       'frames_per_second': num_frames / eval_time,
+                       'stages': stage_timings,
+                       'seqs': seqs_stage_timings},
+                      os.path.join(save_dir, f"{dataset_key}_stage_timings.json"))
+
+        # checkpoints must be on disk before the main process may terminate
+        # this process in eval modus
+        checkpoint_writer.flush()
 
         # set meta_iter here to signal main process that eval is finished
         shared_dict['meta_iter'] = meta_iter
@@ -0,0 +1,123 @@
+import timeit
+
+import torch
+
+
+class FineTuneBudget:
+    """
+    Adaptive number of epochs of the first fine-tuning of every sequence
+    object.
+
+    An object stops once its exponentially smoothed train loss decreased by
+    less than min_rel_slope per epoch over the last window epochs and, if
+    min_grad_norm is set, its gradient norm fell below min_grad_norm. The
+    objects of a sequence share seq_time_budget seconds of fine-tuning in
+    equal parts of the remaining time. Every object runs at least
+    min_epochs and at most num_epochs.eval epochs.
+    """
+
+    def __init__(self, adaptive: bool, min_epochs: int, ema_decay: float, window: int,
+                 min_rel_slope: float, min_grad_norm: float = None,
+                 seq_time_budget: float = None):
+        self.adaptive = adaptive
+        self._min_epochs = min_epochs
+        self._ema_decay = ema_decay
+        self._window = window
+        self._min_rel_slope = min_rel_slope
+        self._min_grad_norm = min_grad_norm
+        self._seq_time_budget = seq_time_budget
+
+        self._num_objs = 0
+        self._seq_time = 0.0
+        self._obj = None
+        self.records = []
+
+    @property
+    def tracks_grad_norm(self):
+        return self.adaptive and self._min_grad_norm is not None
+
+    def start_seq(self, num_objs: int):
+        self._num_objs = num_objs
+        self._seq_time = 0.0
+        self._obj = None
+        self.records = []
+
+    def start_obj(self, obj_id: int, max_epochs: int = None):
+        time_budget = None
+        if self.adaptive and self._seq_time_budget is not None:
+            num_remaining_objs = max(1, self._num_objs - len(self.records))
+            time_budget = max(0.0, self._seq_time_budget - self._seq_time) / num_remaining_objs
+
+        self._obj = {'obj_id': obj_id,
+                     'max_epochs': max_epochs,
+                     'time_budget': time_budget,
+                     'loss_ema': [],
+                     'grad_norm': None,
+                     'stop_reason': None,
+                     'start': timeit.default_timer()}
+
+    def add_epoch(self, train_loss: float, grad_norm: torch.Tensor = None):
+        obj = self._obj
+        if obj['loss_ema']:
+            loss_ema = self._ema_decay * obj['loss_ema'][-1] + (1.0 - self._ema_decay) * train_loss
+        else:
+            loss_ema = train_loss
+        obj['loss_ema'].append(loss_ema)
+        obj['grad_norm'] = grad_norm
+
+    def _stop_reason(self):
+        obj = self._obj
+        num_epochs = len(obj['loss_ema'])
+        if not self.adaptive or num_epochs < self._min_epochs:
+            return None
+
+        if obj['time_budget'] is not None:
+            if timeit.default_timer() - obj['start'] >= obj['time_budget']:
+                return 'time_budget'
+
+        if num_epochs <= self._window:
+            return None
+
+        prev_loss_ema = obj['loss_ema'][-self._window - 1]
+        rel_slope = (prev_loss_ema - obj['loss_ema'][-1]) / (self._window * max(abs(prev_loss_ema), 1e-8))
+        if rel_slope >= self._min_rel_slope:
+            return None
+
+        if self._min_grad_norm is not None:
+            if obj['grad_norm'] is None or obj['grad_norm'].item() >= self._min_grad_norm:
+                return None
+        return 'converged'
+
+    def stop(self):
+        """Whether the fine-tuning of the current object stops after this epoch."""
+        self._obj['stop_reason'] = self._stop_reason()
+        return self._obj['stop_reason'] is not None
+
+    def end_obj(self, cached: bool = False):
+        obj = self._obj
+        fine_tune_time = timeit.default_timer() - obj['start']
+        self._seq_time += fine_tune_time
+
+        stop_reason = obj['stop_reason']
+        if cached:
+            stop_reason = 'cached'
+        elif stop_reason is None:
+            if obj['max_epochs'] is not None and len(obj['loss_ema']) >= obj['max_epochs']:
+                stop_reason = 'max_epochs'
+            else:
+                stop_reason = 'early_stopping'
+
+        self.records.append({'obj_id': obj['obj_id'],
+                             'epochs': len(obj['loss_ema']),
+                             'max_epochs': obj['max_epochs'],
+                             'time': fine_tune_time,
+                             'stop_reason': stop_reason})
+        self._obj = None
+
+
+def saved_epochs(records: list):
+    """Fraction of the fixed fine-tuning epochs which were not run."""
+    records = [r for r in records if r['stop_reason'] != 'cached' and r['max_epochs']]
+    if not records:
+        return None
+    return 1.0 - sum([r['epochs'] for r in records]) / sum([r['max_epochs'] for r in records])
@@ -1,29 +1,28 @@
 import collections
+import contextlib
 import os
 import random
-import shutil
-import tempfile
-from itertools import count, product, zip_longest
+from itertools import count, zip_longest
 
-import davis
 import imageio
 import numpy as np
 import torch
 import torch.nn as nn
 from data import DAVIS, YouTube, custom_transforms
-from davis import (Annotation, DAVISLoader, Segmentation, db_eval,
-                   db_eval_sequence)
 from meta_optim.meta_optim import MetaOptimizer
 from networks.deeplabv3 import DeepLabV3
 from networks.deeplabv3plus import DeepLabV3Plus
 from networks.loss_ce import class_balanced_cross_entropy_loss
 from networks.loss_dice import dice_loss
 from networks.mask_rcnn import MaskRCNN
-from prettytable import PrettyTable
 from torch.utils.data import DataLoader
 from torch.utils.data.sampler import RandomSampler, Sampler, SequentialSampler
 from torchvision import transforms
 
+from util.keyframes import masks_to_boxes
+from util.metrics import SequenceEvaluator, SequenceGroundTruth
+from util.stage_timer import stage, timed_iter
+
 
 def compute_loss(loss_func, outputs, gts, loss_kwargs=None):
     if loss_kwargs is None:
@@ -33,7 +32,7 @@ def compute_loss(loss_func, outputs, gts, loss_kwargs=None):
         reduction = 'mean'
         if 'batch_average' in loss_kwargs and not loss_kwargs['batch_average']:
             reduction = 'none'
-        criterion = nn.BCEWithLogitsLoss(reduction=reduction).cuda()
+        criterion = nn.BCEWithLogitsLoss(reduction=reduction)
         loss = criterion(outputs, gts)
         if reduction == 'none':
             loss = loss.view(loss.shape[0], -1).mean(dim=1)
@@ -46,7 +45,7 @@ def compute_loss(loss_func, outputs, gts, loss_kwargs=None):
         reduction = 'mean'
         if 'batch_average' in loss_kwargs and not loss_kwargs['batch_average']:
             reduction = 'none'
-        criterion = nn.BCEWithLogitsLoss(reduction=reduction).cuda()
+        criterion = nn.BCEWithLogitsLoss(reduction=reduction)
         loss = criterion(outputs, gts)
         if reduction == 'none':
             loss = loss.view(loss.shape[0], -1).mean(dim=1)
@@ -56,6 +55,12 @@ def compute_loss(loss_func, outputs, gts, loss_kwargs=None):
         raise NotImplementedError
 
 
+def probs_to_labels(probs: torch.Tensor):
+    """[N, 1, H, W] object ids of the [N, C, H, W] probs. The background is 0."""
+    max_probs, labels = probs.max(dim=1, keepdim=True)
+    return (labels.float() + 1.0).masked_fill(max_probs.lt(0.5), 0.0)
+
+
 def epoch_iter(num_epochs: int):
     # one epoch corresponds to one random transformed first frame of a sequence
     if num_epochs is None:
@@ -64,8 +69,19 @@ def epoch_iter(num_epochs: int):
         return range(1, num_epochs + 1)
 
 
-def run_loader(model, loader, loss_func, img_save_dir=None, return_probs=False, start_targets=None):
+def run_loader(model, loader, loss_func, img_save_dir=None, return_probs=False, start_targets=None,
+               seq_evaluator=None, timer=None, stop_func=None, keyframes=None, roi_crop=None):
+    """
+    With a stop_func the MaskRCNN inference stops before the first frame
+    whose [C, H, W] probs make stop_func return True. With a
+    KeyframeSelector the MaskRCNN only runs on keyframes. With a RoiCrop
+    it only runs on the crop of the boxes of the previous frame.
+    """
     device = next(model.parameters()).device
+    assert (stop_func is None and keyframes is None and roi_crop is None) or loader.batch_size == 1
+
+    if keyframes is not None:
+        keyframes.start()
 
     metrics = {n: [] for n in ['loss_batches', 'acc_batches']}
 
@@ -94,10 +110,15 @@ def run_loader(model, loader, loss_func, img_save_dir=None, return_probs=False,
             else:
                 targets = start_targets.clone()
 
+    # the first crop contains the start targets
+    prev_boxes = None
+    if roi_crop is not None and start_targets is not None:
+        prev_boxes = masks_to_boxes(start_targets[0].gt(0).float())
+
     probs_all = []
     boxes_all =[]
     with torch.no_grad():
-        for sample_batched in loader:
+        for sample_batched in timed_iter(timer, 'data', loader):
             imgs, gts, file_names = sample_batched['image'], sample_batched['gt'], sample_batched['file_name']
             inputs, gts = imgs.to(device), gts.to(device)
 
@@ -106,42 +127,53 @@ def run_loader(model, loader, loss_func, img_save_dir=None, return_probs=False,
             # targets = gts
 
             if isinstance(model, MaskRCNN):
-                outputs = model(inputs, targets)
+                if keyframes is None or keyframes.is_keyframe(inputs[0], file_names[0]):
+                    with stage(timer, 'inference'):
+                        if roi_crop is None:
+                            outputs = model(inputs, targets)
+                        else:
+                            outputs = roi_crop.forward(model, inputs, targets, prev_boxes)
+                else:
+                    with stage(timer, 'propagation'):
+                        outputs = keyframes.propagate(probs_all[-1][0])
+                prev_boxes = outputs[1][0]
 
-                probs = outputs[0]
+                with stage(timer, 'postprocessing'):
+                    probs = outputs[0]
 
-                background_mask = probs.max(dim=1, keepdim=True)[0].lt(0.5)
-                preds = probs.argmax(dim=1, keepdim=True).float() + 1.0
-                preds[background_mask] = 0.0
+                    preds = probs_to_labels(probs)
 
-                if augment_target_proposals_mode is not None:
-                    # targets = probs.ge(0.5).float()
-                    background_mask = probs.max(dim=1, keepdim=True)[0].lt(0.5)
-                    targets = probs.argmax(dim=1, keepdim=True).float() + 1.0
-                    targets[background_mask] = 0.0
+                    if augment_target_proposals_mode is not None:
+                        targets = preds
 
-                    model.rpn._eval_augment_proposals_mode = augment_target_proposals_mode
-                    if targets.sum().item() == 0:
-                        model.rpn._eval_augment_proposals_mode = 'EXTEND'
-                        targets = start_targets
+                        model.rpn._eval_augment_proposals_mode = augment_target_proposals_mode
+                        if targets.sum().item() == 0:
+                            model.rpn._eval_augment_proposals_mode = 'EXTEND'
+                            targets = start_targets
+
+                if stop_func is not None and stop_func(probs[0]):
+                    break
 
                 metrics['loss_batches'].append(torch.tensor([0.0]))
 
                 boxes_all.append(outputs[1])
             else:
-                outputs = model(inputs)
-                probs = torch.sigmoid(outputs[-1])
+                with stage(timer, 'inference'):
+                    outputs = model(inputs)
 
-                loss = compute_loss(loss_func, outputs[-1], gts, {'batch_average': False})
-                metrics['loss_batches'].append(loss)
+                with stage(timer, 'postprocessing'):
+                    probs = torch.sigmoid(outputs[-1])
 
-                preds = probs.ge(0.5).float()
+                    loss = compute_loss(loss_func, outputs[-1], gts, {'batch_average': False})
+                    metrics['loss_batches'].append(loss)
+
+                    preds = probs.ge(0.5).float()
 
             probs_all.append(probs)
             # print(preds.eq(gts.bool()).view(preds.size(0), -1).sum(dim=1).float().div(preds[0].numel()).shape)
             metrics['acc_batches'].append(preds.bool().eq(gts.bool()).view(preds.size(0), -1).sum(dim=1).float().div(preds[0].numel()))
 
-            if img_save_dir is not None:
+            if img_save_dir is not None or seq_evaluator is not None:
                 # preds = 1 * preds
                 preds = np.transpose(preds.cpu().numpy(), (0, 2, 3, 1)).astype(np.uint8)
 
@@ -149,8 +181,14 @@ def run_loader(model, loader, loss_func, img_save_dir=None, return_probs=False,
                     preds = np.logical_not(preds).astype(np.uint8)
 
                 for file_name, pred in zip(file_names, preds):
-                    pred_path = os.path.join(img_save_dir, os.path.basename(file_name) + '.png')
-                    imageio.imsave(pred_path, pred)
+                    if seq_evaluator is not None:
+                        with stage(timer, 'metrics'):
+                            seq_evaluator.add_frame(file_name, pred[..., 0])
+
+                    if img_save_dir is not None:
+                        pred_path = os.path.join(img_save_dir, os.path.basename(file_name) + '.png')
+                        with stage(timer, 'png_writing'):
+                            imageio.imsave(pred_path, pred)
 
     metrics = {n: torch.cat(m).cpu() for n, m in metrics.items()}
 
@@ -159,16 +197,159 @@ def run_loader(model, loader, loss_func, img_save_dir=None, return_probs=False,
     return metrics['loss_batches'], metrics['acc_batches']
 
 
-def eval_loader(model, loader, loss_func, img_save_dir=None, return_preds=False):
+def run_loader_shared_backbone(model, loader, object_heads, timer=None, keyframes=None,
+                               roi_crop=None):
+    """
+    Inference of the fine-tuned heads of multiple objects on a shared
+    backbone. Every entry of object_heads holds the rpn and roi_heads of an
+    object, its frame_ids and start_targets. The backbone runs once per
+    frame and the heads of all objects with this frame on its features.
+    Returns the probs and boxes of every object for its frame_ids. An
+    optional stop_func of an object ends its frames like in run_loader.
+    With a KeyframeSelector the backbone and heads only run on keyframes
+    and on the first frame of every object. With a RoiCrop they only run on
+    the crop of the boxes of all objects in the previous frame.
+    """
+    assert loader.batch_size == 1
+    device = next(model.parameters()).device
+
+    augment_target_proposals_mode = model.rpn._eval_augment_proposals_mode
+
+    start_targets = []
+    targets = []
+    for obj_heads in object_heads:
+        obj_start_targets = obj_heads['start_targets']
+        obj_targets = None
+        if augment_target_proposals_mode is not None and obj_start_targets is not None:
+            if obj_start_targets.sum().item() == 0:
+                obj_start_targets = None
+                obj_heads['rpn']._eval_augment_proposals_mode = 'EXTEND'
+            else:
+                obj_targets = obj_start_targets.clone()
+        start_targets.append(obj_start_targets)
+        targets.append(obj_targets)
+
+    # the first crop of an object contains its start targets
+    prev_boxes = [None for _ in object_heads]
+    if roi_crop is not None:
+        prev_boxes = [None if obj_heads['start_targets'] is None
+                      else masks_to_boxes(obj_heads['start_targets'][0].gt(0).float())
+                      for obj_heads in object_heads]
+
+    frame_ids = sorted(set(frame_id for obj_heads in object_heads
+                           for frame_id in obj_heads['frame_ids']))
+    loader.sampler.indices = frame_ids
+
+    if keyframes is not None:
+        keyframes.start()
+
+    probs_all = [[] for _ in object_heads]
+    boxes_all = [[] for _ in object_heads]
+    stopped = [False for _ in object_heads]
+    model.eval()
+    with torch.no_grad():
+        for frame_id, sample_batched in zip(frame_ids, timed_iter(timer, 'data', loader)):
+            if not any([not stopped[i] and frame_id in obj_heads['frame_ids']
+                        for i, obj_heads in enumerate(object_heads)]):
+                if all(stopped):
+                    break
+                continue
+
+            inputs = sample_batched['image'].to(device)
+            height, width = inputs.shape[-2:]
+            frame_obj_ids = [i for i, obj_heads in enumerate(object_heads)
+                             if not stopped[i] and frame_id in obj_heads['frame_ids']]
+
+            keyframe = True
+            if keyframes is not None:
+                # objects start on a keyframe
+                starts_obj = any([frame_id == object_heads[i]['frame_ids'][0] for i in frame_obj_ids])
+                keyframe = keyframes.is_keyframe(inputs[0], sample_batched['file_name'][0],
+                                                 force=starts_obj, num_objects=len(frame_obj_ids))
+
+            # the crop of all objects falls back to the full frame if one object is lost
+            crop_box = None
+            crop_targets = targets
+            if keyframe and roi_crop is not None:
+                if all([prev_boxes[i] is not None and prev_boxes[i].abs().sum().item() for i in frame_obj_ids]):
+                    crop_box = roi_crop.crop_box(torch.cat([prev_boxes[i] for i in frame_obj_ids]),
+                                                 height, width)
+                if crop_box is not None:
+                    crop_targets = [roi_crop.crop_targets(t, crop_box) for t in targets]
+                    if any([targets[i] is not None and crop_targets[i] is None for i in frame_obj_ids]):
+                        crop_box = None
+                        crop_targets = targets
+                roi_crop.record(crop_box, height, width)
+
+            crop_transform = contextlib.nullcontext()
+            crop_inputs = inputs
+            if crop_box is not None:
+                x0, y0, x1, y1 = crop_box
+                crop_transform = model.crop_transform((height, width), (y1 - y0, x1 - x0))
+                crop_inputs = inputs[..., y0:y1, x0:x1]
+
+            with crop_transform:
+                if keyframe:
+                    with stage(timer, 'inference'):
+                        images, features, original_image_sizes = model.forward_features(crop_inputs)
+
+                frame_outputs = {}
+                for i in frame_obj_ids:
+                    obj_heads = object_heads[i]
+                    if keyframe:
+                        with stage(timer, 'inference'):
+                            probs, boxes = model.forward_heads(
+                                crop_inputs, images, features, original_image_sizes, crop_targets[i],
+                                obj_heads['rpn'], obj_heads['roi_heads'])
+                        if crop_box is not None:
+                            probs, boxes = roi_crop.paste(probs, boxes, crop_box, height, width)
+                    else:
+                        with stage(timer, 'propagation'):
+                            probs, boxes = keyframes.propagate(probs_all[i][-1][0])
+                    frame_outputs[i] = (probs, boxes)
+
+            for i, (probs, boxes) in frame_outputs.items():
+                obj_heads = object_heads[i]
+                prev_boxes[i] = boxes[0]
+
+                if augment_target_proposals_mode is not None:
+                    with stage(timer, 'postprocessing'):
+                        targets[i] = probs_to_labels(probs)
+
+                        obj_heads['rpn']._eval_augment_proposals_mode = augment_target_proposals_mode
+                        if targets[i].sum().item() == 0:
+                            obj_heads['rpn']._eval_augment_proposals_mode = 'EXTEND'
+                            targets[i] = start_targets[i]
+
+                if obj_heads.get('stop_func') is not None and obj_heads['stop_func'](probs[0]):
+                    stopped[i] = True
+                    continue
+
+                probs_all[i].append(probs)
+                boxes_all[i].append(boxes)
+
+    loader.sampler.indices = None
+
+    return [(torch.cat(probs), torch.cat(boxes))
+            for probs, boxes in zip(probs_all, boxes_all)]
+
+
+def eval_loader(model, loader, loss_func, img_save_dir=None, return_preds=False,
+                gt_cache=None, timer=None):
     seq_name = loader.dataset.seq_key
 
-    if img_save_dir is None:
-        img_save_dir = tempfile.mkdtemp()
-        os.makedirs(os.path.join(img_save_dir, seq_name))
+    # predictions are only written to disk on request
+    if img_save_dir is not None:
+        img_save_dir = os.path.join(img_save_dir, seq_name)
+        if not os.path.exists(img_save_dir):
+            os.makedirs(img_save_dir)
 
-    loss_batches, acc_batches, preds, _ = run_loader(model, loader, loss_func, os.path.join(img_save_dir, seq_name), True)
+    seq_evaluator = init_seq_evaluator(loader.dataset, gt_cache)
+    loss_batches, acc_batches, preds, _ = run_loader(
+        model, loader, loss_func, img_save_dir, True, seq_evaluator=seq_evaluator, timer=timer)
 
-    evaluation = eval_davis_seq(img_save_dir, seq_name)
+    with stage(timer, 'metrics'):
+        evaluation = seq_evaluator.result()
 
     eval_J_mean = evaluation['J']['mean']
     if not eval_J_mean:
@@ -178,8 +359,6 @@ def eval_loader(model, loader, loss_func, img_save_dir=None, return_preds=False)
     if not eval_F_mean:
         eval_F_mean = [0.0]
 
-    if '/tmp/' in img_save_dir:
-        shutil.rmtree(img_save_dir)
     if return_preds:
         return loss_batches, acc_batches, eval_J_mean, eval_F_mean, preds
     return loss_batches, acc_batches, eval_J_mean, eval_F_mean
@@ -247,10 +426,7 @@ def train_val(model, train_loader, val_loader, optim, num_epochs,
     return metrics['train_loss'], metrics['val_loss'], metrics['val_acc'], metrics['val_J'], metrics['val_F']
 
 
-def data_loaders(dataset, random_train_transform, batch_sizes, shuffles,
-                 frame_ids, num_workers, crop_sizes, multi_object, pin_memory,
-                 normalize, full_resolution=False):
-    # train
+def init_train_transforms(random_train_transform):
     train_transforms = []
     if random_train_transform:
         train_transforms.extend([
@@ -260,7 +436,14 @@ def data_loaders(dataset, random_train_transform, batch_sizes, shuffles,
                                                                       scales=(.75, 1.25))
                                 ])
     train_transforms.append(custom_transforms.ToTensor())
-    composed_transforms = transforms.Compose(train_transforms)
+    return transforms.Compose(train_transforms)
+
+
+def data_loaders(dataset, random_train_transform, batch_sizes, shuffles,
+                 frame_ids, num_workers, crop_sizes, multi_object, pin_memory,
+                 normalize, full_resolution=False):
+    # train
+    composed_transforms = init_train_transforms(random_train_transform)
 
     if dataset['name'] == 'DAVIS-2016':
         vos_dataset = DAVIS
@@ -271,6 +454,10 @@ def data_loaders(dataset, random_train_transform, batch_sizes, shuffles,
     elif dataset['name'] == 'YouTube-VOS':
         vos_dataset = YouTube
         root_dir = 'data/YouTube-VOS'
+    elif dataset['name'] == 'Synthetic-DAVIS-2017':
+        # generated by generate_synthetic_davis.py
+        vos_dataset = DAVIS
+        root_dir = 'data/Synthetic-DAVIS-2017'
     else:
         raise NotImplementedError
 
@@ -339,7 +526,9 @@ def data_loaders(dataset, random_train_transform, batch_sizes, shuffles,
 def init_parent_model(architecture, encoder, train_encoder, decoder_norm_layer,
                       replace_batch_with_group_norms, batch_norm,
                       roi_pool_output_sizes, eval_augment_rpn_proposals_mode,
-                      box_nms_thresh, maskrcnn_loss, **datasets):
+                      box_nms_thresh, maskrcnn_loss, feature_cache_size=0,
+                      transform_sizes=None, eval_augment_rpn_proposals_num=None,
+                      target_cache_size=0, **datasets):
     if architecture == 'DeepLabV3':
         model = DeepLabV3(encoder, num_classes=1, batch_norm=batch_norm, train_encoder=train_encoder)
     elif architecture == 'DeepLabV3Plus':
@@ -351,8 +540,11 @@ def init_parent_model(architecture, encoder, train_encoder, decoder_norm_layer,
             encoder, num_classes=2, batch_norm=batch_norm, train_encoder=train_encoder,
             roi_pool_output_sizes=roi_pool_output_sizes,
             eval_augment_rpn_proposals_mode=eval_augment_rpn_proposals_mode,
+            eval_augment_rpn_proposals_num=eval_augment_rpn_proposals_num,
             replace_batch_with_group_norms=replace_batch_with_group_norms,
-            box_nms_thresh=box_nms_thresh, maskrcnn_loss=maskrcnn_loss)
+            box_nms_thresh=box_nms_thresh, maskrcnn_loss=maskrcnn_loss,
+            feature_cache_size=feature_cache_size, transform_sizes=transform_sizes,
+            target_cache_size=target_cache_size)
     else:
         raise NotImplementedError
 
@@ -385,6 +577,18 @@ def init_parent_model(architecture, encoder, train_encoder, decoder_norm_layer,
     return model, parent_states
 
 
+def transform_scale(resolution_schedule, epoch: int):
+    """
+    Scale of the transform sizes in a fine-tuning epoch starting at 1.
+    resolution_schedule lists the [scale, num_epochs] of the first epochs.
+    """
+    for scale, num_epochs in resolution_schedule:
+        if epoch <= num_epochs:
+            return scale
+        epoch -= num_epochs
+    return 1.0
+
+
 def early_stopping(loss_hist, patience, min_loss_improv):
     if patience is None or len(loss_hist) <= patience:
         return False
@@ -412,50 +616,15 @@ def update_dict(d, u):
     return d
 
 
-def eval_davis(results_dir, seq_name):
-    metrics = ['J', 'F']
-    statistics = ['mean', 'recall', 'decay']
-
-    if seq_name == 'train_seqs':
-        phase = davis.phase['TRAIN']
-    elif seq_name == 'test_seqs':
-        phase = davis.phase['VAL']
-
-    db = DAVISLoader('2016', phase, True)
-
-    # Load segmentations
-    segmentations = [Segmentation(os.path.join(results_dir, s), True)
-                     for s in db.iternames()]
-
-    # Evaluate results
-    evaluation = db_eval(db, segmentations, metrics)
-
-    # Print results
-    table = PrettyTable(['Method']+[p[0]+'_'+p[1] for p in
-                                    product(metrics, statistics)])
-
-    table.add_row([os.path.basename(results_dir)] + ["%.3f" % np.round(
-        evaluation['dataset'][metric][statistic], 3) for metric, statistic
-        in product(metrics, statistics)])
-
-    return evaluation, table
-
-
-def eval_davis_seq(results_dir, seq_name):
-    # TODO: refactor
-    from davis import cfg as eval_cfg
-    segmentations = Segmentation(os.path.join(
-        results_dir, seq_name), not eval_cfg.MULTIOBJECT)
-    annotations = Annotation(seq_name, not eval_cfg.MULTIOBJECT)
-
-    if 'NUM_OBJECTS' in eval_cfg:
-        segmentations.n_objects = eval_cfg.NUM_OBJECTS
-        annotations.n_objects = eval_cfg.NUM_OBJECTS
-
-    evaluation = {}
-    for m in ['J', 'F']:
-        evaluation[m] = db_eval_sequence(segmentations, annotations, measure=m)
-    return evaluation
+def init_seq_evaluator(dataset, gt_cache=None):
+    """In-memory J and F evaluation of the current sequence of a dataset."""
+    if gt_cache is None:
+        ground_truth = SequenceGroundTruth.from_label_paths(
+            dataset.labels, dataset.eval_multi_object, dataset.eval_num_objects)
+    else:
+        ground_truth = gt_cache.get(
+            dataset.labels, dataset.eval_multi_object, dataset.eval_num_objects)
+    return SequenceEvaluator(ground_truth)
 
 
 class SequentialSubsetSampler(Sampler):
@@ -500,6 +669,9 @@ def device_for_process(rank: int,
                        eval_datasets: bool,
                        num_meta_processes_per_gpu: int,
                        num_eval_gpus: int):
+    if not torch.cuda.is_available():
+        return torch.device('cpu'), torch.device('cpu')
+
     if eval_datasets:
         gpu_rank = (rank // num_meta_processes_per_gpu)
         gpu_rank += num_eval_gpus
@@ -512,6 +684,66 @@ def device_for_process(rank: int,
     return device, meta_device
 
 
+def eval_dataset_keys(datasets: dict, eval_datasets: bool):
+    """Datasets with an eval process. Every process evaluates one dataset."""
+    if not eval_datasets:
+        return []
+    return [k for k, v in datasets.items() if v['eval'] and v['split'] is not None]
+
+
+def device_for_eval_process(rank: int):
+    if not torch.cuda.is_available():
+        return torch.device('cpu')
+    return torch.device(f'cuda:{rank}')
+
+
+def cpu_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def cpu_process_layout(num_eval_processes: int, meta_batch_size: int,
+                       num_threads_per_process: int = None):
+    """
+    Splits the available CPU cores into equal slices for eval and meta
+    processes. Returns the number of threads per process and the number of
+    meta processes. The latter is the largest divisor of meta_batch_size
+    that fits into the remaining cores.
+    """
+    num_cores = len(cpu_cores())
+
+    if num_threads_per_process is None:
+        num_threads_per_process = max(
+            1, num_cores // (num_eval_processes + meta_batch_size))
+
+    num_meta_processes = max(
+        1, num_cores // num_threads_per_process - num_eval_processes)
+    num_meta_processes = min(num_meta_processes, meta_batch_size)
+    while meta_batch_size % num_meta_processes:
+        num_meta_processes -= 1
+
+    return num_threads_per_process, num_meta_processes
+
+
+def set_cpu_threads_for_process(process_id: int, num_threads: int):
+    """
+    Pins the calling process to its slice of CPU cores and limits the torch
+    intra-op threads to the same number. Processes with consecutive ids get
+    disjoint slices as long as there are enough cores.
+    """
+    cores = cpu_cores()
+    num_threads = min(num_threads, len(cores))
+    start = (process_id * num_threads) % len(cores)
+    process_cores = [cores[(start + i) % len(cores)] for i in range(num_threads)]
+
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, process_cores)
+    torch.set_num_threads(num_threads)
+
+    return process_cores
+
+
 def set_random_seeds(seed):
     random.seed(seed)
     np.random.seed(seed)
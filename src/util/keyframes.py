@@ -0,0 +1,119 @@
+import os
+
+import cv2
+import numpy as np
+import torch
+
+from networks.mask_rcnn import masks_to_boxes as binary_masks_to_boxes
+
+
+def masks_to_boxes(probs: torch.Tensor, min_prop: float = 0.5):
+    """[C, 4] boxes of the [C, H, W] probs. Empty masks have zero boxes."""
+    return binary_masks_to_boxes(probs.ge(min_prop))
+
+
+class KeyframeSelector:
+    """
+    Selects the frames of a frame range on which the fine-tuned model runs.
+    The masks of all other frames are propagated from the previous frame.
+
+    INTERVAL: every interval-th frame is a keyframe.
+    DIFFERENCE: frames whose mean absolute difference to the last keyframe
+    exceeds max_frame_diff are keyframes, at least every interval-th frame.
+
+    FLOW propagation warps the probabilities with the dense optical flow
+    (Farneback) to the previous frame. COPY repeats them.
+    """
+
+    MODES = [None, 'INTERVAL', 'DIFFERENCE']
+    PROPAGATIONS = ['FLOW', 'COPY']
+
+    def __init__(self, mode: str = None, interval: int = 1, max_frame_diff: float = 0.05,
+                 propagation: str = 'FLOW'):
+        if mode not in self.MODES or propagation not in self.PROPAGATIONS:
+            raise NotImplementedError
+        assert interval >= 1
+
+        self.mode = mode
+        self._interval = interval
+        self._max_frame_diff = max_frame_diff
+        self._propagation = propagation
+
+        # mode of every selected frame, i.e., full inference or propagated
+        self.records = []
+        self.start()
+
+    @property
+    def enabled(self):
+        return self.mode is not None
+
+    def start(self):
+        """Starts a frame range. Its first frame is a keyframe."""
+        self._keyframe_image = None
+        self._num_frames = 0
+        self._gray = None
+        self._prev_gray = None
+        self._flow = None
+
+    def is_keyframe(self, image: torch.Tensor, file_name: str, force: bool = False,
+                    num_objects: int = 1):
+        """
+        Whether the model runs on the [3, H, W] image of the num_objects
+        objects of a frame. Call once per frame.
+        """
+        image = image.detach().float().cpu()
+
+        keyframe = force or self._keyframe_image is None
+        if not keyframe:
+            if self.mode == 'DIFFERENCE':
+                frame_diff = (image - self._keyframe_image).abs().mean().item()
+                keyframe = frame_diff > self._max_frame_diff
+            keyframe = keyframe or self._num_frames >= self._interval
+
+        if keyframe:
+            self._keyframe_image = image
+            self._num_frames = 0
+        self._num_frames += 1
+
+        if self._propagation == 'FLOW':
+            self._prev_gray = self._gray
+            gray = image.mean(dim=0).numpy()
+            # images are scaled to [0, 1] and might be mean subtracted
+            gray = (gray - gray.min()) / max(gray.max() - gray.min(), 1e-8)
+            self._gray = (gray * 255).astype(np.uint8)
+            self._flow = None
+
+        self.records.append({'frame': os.path.basename(file_name),
+                             'mode': 'full' if keyframe else 'propagated',
+                             'num_objects': num_objects})
+        return keyframe
+
+    def propagate(self, probs: torch.Tensor):
+        """
+        [C, H, W] probs of the previous frame propagated to the current frame.
+        Returns the [1, C, H, W] probs and [1, C, 4] boxes like the model.
+        """
+        if self._propagation == 'FLOW':
+            if self._flow is None:
+                # backward flow for every pixel of the current frame
+                flow = cv2.calcOpticalFlowFarneback(self._gray, self._prev_gray, None,
+                                                    0.5, 3, 15, 3, 5, 1.2, 0)
+                height, width = flow.shape[:2]
+                grid_x, grid_y = np.meshgrid(np.arange(width, dtype=np.float32),
+                                             np.arange(height, dtype=np.float32))
+                self._flow = (grid_x + flow[..., 0], grid_y + flow[..., 1])
+
+            probs_numpy = probs.detach().float().cpu().numpy()
+            probs = torch.from_numpy(np.stack([
+                cv2.remap(p, self._flow[0], self._flow[1], cv2.INTER_LINEAR,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+                for p in probs_numpy])).to(probs.device)
+
+        return probs.unsqueeze(dim=0), masks_to_boxes(probs).unsqueeze(dim=0)
+
+    def summary(self):
+        """Number of object frames with full inference and propagation."""
+        num_propagated = sum([r['num_objects'] for r in self.records if r['mode'] == 'propagated'])
+        return {'num_full': sum([r['num_objects'] for r in self.records]) - num_propagated,
+                'num_propagated': num_propagated,
+                'frames': self.records}
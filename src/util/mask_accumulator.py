@@ -0,0 +1,76 @@
+import tempfile
+
+import numpy as np
+import torch
+
+
+class MaskAccumulator:
+    """
+    Preallocated [T, K, H, W] buffer of the foreground probabilities of all
+    objects of a sequence.
+
+    uint8 stores probabilities in steps of 1/127. This keeps the value 2 of
+    the ground truth frame representable and the 0.5 threshold exact.
+    float16 keeps the full probability range at half the float32 memory.
+    With memmap_dir the buffer is a temporary memory-mapped file in this
+    directory.
+    """
+
+    SCALES = {'uint8': 127.0, 'float16': 1.0}
+
+    def __init__(self, num_frames: int, num_channels: int, height: int,
+                 width: int, dtype: str = 'uint8', memmap_dir: str = None):
+        if dtype not in self.SCALES:
+            raise NotImplementedError
+
+        self._scale = self.SCALES[dtype]
+        self._file = None
+
+        shape = (num_frames, num_channels, height, width)
+        if memmap_dir is None:
+            self._buffer = np.zeros(shape, dtype=dtype)
+        else:
+            self._file = tempfile.NamedTemporaryFile(dir=memmap_dir, suffix='.masks')
+            self._buffer = np.memmap(self._file, dtype=dtype, mode='w+', shape=shape)
+
+    def __len__(self):
+        return self._buffer.shape[0]
+
+    @property
+    def nbytes(self):
+        return self._buffer.nbytes
+
+    def set(self, frame_id: int, channel: int, probs: torch.Tensor):
+        """Stores [C, H, W] probabilities starting at channel."""
+        probs = probs.detach().float().cpu().numpy() * self._scale
+        if self._buffer.dtype == np.uint8:
+            probs = np.clip(np.rint(probs), 0, 255)
+        self._buffer[frame_id, channel:channel + probs.shape[0]] = probs
+
+    def get(self, frame_id: int, channel: int, num_channels: int = 1):
+        """Returns [num_channels, H, W] float32 probabilities."""
+        probs = self._buffer[frame_id, channel:channel + num_channels]
+        return torch.from_numpy(probs.astype(np.float32) / self._scale)
+
+    def merge(self, chunk_size: int = 16):
+        """
+        Label maps [T, 1, H, W] of the objects with the highest probability.
+        Pixels without any object probability above 0.5 are background.
+        """
+        num_frames, _, height, width = self._buffer.shape
+        labels = np.empty((num_frames, 1, height, width), dtype=np.uint8)
+
+        # chunks bound the memory of memory-mapped buffers
+        for start in range(0, num_frames, chunk_size):
+            chunk = np.asarray(self._buffer[start:start + chunk_size])
+            chunk_labels = chunk.argmax(axis=1).astype(np.uint8) + 1
+            chunk_labels[chunk.max(axis=1) < 0.5 * self._scale] = 0
+            labels[start:start + chunk_size, 0] = chunk_labels
+
+        return torch.from_numpy(labels)
+
+    def close(self):
+        self._buffer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
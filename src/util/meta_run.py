@@ -1,43 +1,20 @@
 import time
 
 import torch
+from meta_optim.meta_task_pool import MetaTaskPool
 from meta_optim.meta_tasksets import MetaTaskset
-from torch.utils.data import ConcatDataset, DataLoader, Dataset
+from torch.utils.data import ConcatDataset, Dataset
 
 from meta_optim.meta_optim import MetaOptimizer
 from .helper_func import (compute_loss, data_loaders, device_for_process,
-                          early_stopping, epoch_iter, grouper,
+                          early_stopping, epoch_iter, eval_dataset_keys, grouper,
                           init_parent_model, load_state_dict, train_val,
-                          set_random_seeds)
+                          set_cpu_threads_for_process, set_random_seeds)
+from .radam import RAdam
+from .stage_timer import StageTimer, stage
 
 
-def meta_run(rank: int, init_model_state_dict: dict,
-             shared_meta_optim_state_dict: dict,
-             global_rng_state: torch.ByteTensor, _config: dict, dataset: str,
-             shared_dict: dict, shared_variables: dict,
-             shared_meta_optim_grads: dict, save_dir: str,
-             num_meta_processes: int):
-
-    device, meta_device = device_for_process(rank,
-                                             _config['eval_datasets'],
-                                             _config['num_meta_processes_per_gpu'],
-                                             _config['num_eval_gpus'])
-
-    torch.backends.cudnn.fastest = False
-    torch.backends.cudnn.benchmark = False
-    torch.backends.cudnn.deterministic = True
-
-    set_random_seeds(_config['seed'] + rank)
-
-    model, _ = init_parent_model(**_config['parent_model'])
-    model.load_state_dict(init_model_state_dict)
-
-    meta_optim = MetaOptimizer(model, **_config['meta_optim_cfg'])
-
-    num_epochs = _config['num_epochs']['train']
-
-    sub_meta_batch_size = _config['meta_batch_size'] // num_meta_processes
-
+def init_meta_task_set(_config: dict):
     meta_task_set_config = (
         _config['random_frame_transform_per_task'],
         _config['random_flip_label'],
@@ -62,34 +39,110 @@ def meta_run(rank: int, init_model_state_dict: dict,
 
             meta_task_sets.append(meta_task_set)
 
-        meta_task_set = ConcatDataset(meta_task_sets)
-    else:
-        train_loader, test_loader, meta_loader = data_loaders(
-                _config['datasets']['train'], **_config['data_cfg'])
+        return ConcatDataset(meta_task_sets)
+
+    train_loader, test_loader, meta_loader = data_loaders(
+            _config['datasets']['train'], **_config['data_cfg'])
+
+    return MetaTaskset(
+        train_loader, test_loader, meta_loader, *meta_task_set_config)
+
+
+def init_meta_optim_optim(meta_optim: MetaOptimizer, meta_optim_optim_cfg: dict):
+    """RAdam with the learning rates and weight decay of every meta parameter."""
+    meta_optim_params = []
+    for n, p in meta_optim.named_parameters():
+        weight_decay = 0.0
+        if 'model_init' in n:
+            lr = meta_optim_optim_cfg['model_init_lr']
+            weight_decay = meta_optim_optim_cfg['model_init_weight_decay']
+        elif 'log_init_lr' in n:
+            lr = meta_optim_optim_cfg['log_init_lr_lr']
+        else:
+            lr = meta_optim_optim_cfg['lr']
+
+        if meta_optim_optim_cfg['freeze_encoder'] and ('backbone' in n or 'rpn' in n):
+            lr = 0.0
 
-        meta_task_set = MetaTaskset(
-            train_loader, test_loader, meta_loader, *meta_task_set_config)
+        meta_optim_params.append({'params': [p], 'lr': lr, 'weight_decay': weight_decay})
 
-    def collate_fn(batch):
-        return batch
+    return RAdam(meta_optim_params, lr=meta_optim_optim_cfg['lr'])
 
-    meta_task_loader = DataLoader(
-        meta_task_set,
-        shuffle=True,
-        batch_size=sub_meta_batch_size,
-        num_workers=0,
-        collate_fn=collate_fn)
+
+def meta_task_keys(meta_task_set: Dataset):
+    """Sequence name of every task. Used as key for the task cost estimates."""
+    if isinstance(meta_task_set, ConcatDataset):
+        return [k for d in meta_task_set.datasets for k in meta_task_keys(d)]
+    return [seq_name for seq_name, _ in meta_task_set.object_groups]
+
+
+def meta_run(rank: int, init_model_state_dict: dict,
+             shared_meta_optim_state_dict: dict,
+             global_rng_state: torch.ByteTensor, _config: dict, dataset: str,
+             shared_dict: dict, shared_variables: dict,
+             shared_meta_optim_grads: dict, save_dir: str,
+             num_meta_processes: int):
+
+    device, meta_device = device_for_process(rank,
+                                             _config['eval_datasets'],
+                                             _config['num_meta_processes_per_gpu'],
+                                             _config['num_eval_gpus'])
+
+    if device.type == 'cpu':
+        # eval processes occupy the first core slices
+        num_eval_processes = len(eval_dataset_keys(_config['datasets'], _config['eval_datasets']))
+        set_cpu_threads_for_process(rank + num_eval_processes,
+                                    _config['num_cpu_threads_per_process'])
+
+    torch.backends.cudnn.fastest = False
+    torch.backends.cudnn.benchmark = False
+    torch.backends.cudnn.deterministic = True
+
+    # unique over the meta processes of all nodes
+    seed_rank = _config['distributed']['rank'] * num_meta_processes + rank
+
+    set_random_seeds(_config['seed'] + seed_rank)
+
+    model, _ = init_parent_model(**_config['parent_model'])
+    model.load_state_dict(init_model_state_dict)
+
+    meta_optim = MetaOptimizer(model, **_config['meta_optim_cfg'])
+
+    feature_cache = getattr(model, 'feature_cache', None)
+    target_cache = getattr(model, 'target_cache', None)
+
+    timer = StageTimer(device, **_config['stage_timer'])
+
+    num_epochs = _config['num_epochs']['train']
+
+    meta_task_set = init_meta_task_set(_config)
+
+    meta_task_pool = MetaTaskPool(meta_task_set, _config['seed'] + seed_rank,
+                                  **_config['meta_task_pool'])
+    meta_task_pool.start()
 
     while True:
+        # main process plans the tasks of each meta epoch for all meta processes
+        while shared_dict['epoch_plan'] is None:
+            if shared_dict.get('stop', False):
+                meta_task_pool.close()
+                return
+            time.sleep(0.25)
+        epoch_plan = shared_dict['epoch_plan']
+        shared_dict['epoch_plan'] = None
+
+        meta_task_pool.extend([task_id for task_ids in epoch_plan for task_id in task_ids])
 
-        for meta_mini_batch in meta_task_loader:
+        for plan_iter, task_ids in enumerate(epoch_plan):
 
             # main process sets iter_done=False after shared_meta_optim is updated
             while shared_dict['sub_iter_done']:
                 time.sleep(0.25)
 
-            # filter None values from grouper
-            meta_mini_batch = [s for s in meta_mini_batch if s is not None]
+            wait_time = meta_task_pool.wait_time
+            with stage(timer, 'data'):
+                meta_mini_batch = [meta_task_pool.get() for _ in task_ids]
+            task_wait_time = meta_task_pool.wait_time - wait_time
 
             # model.load_state_dict(model_state_dict)
             meta_optim.load_state_dict(shared_meta_optim_state_dict)
@@ -106,10 +159,11 @@ def meta_run(rank: int, init_model_state_dict: dict,
                             for m in seqs_metrics}
             vis_data_seqs = {s['seq_name']: [] for s in meta_mini_batch}
 
+            task_timings = []
             for sample in meta_mini_batch:
                 seq_name = sample['seq_name']
-                train_loader = sample['train_loader']
-                meta_loader = sample['meta_loader']
+                flip_label = sample['flip_label']
+                start_task = time.time()
 
                 bptt_loss = torch.zeros(1).to(meta_device)
                 stop_train = False
@@ -123,21 +177,26 @@ def meta_run(rank: int, init_model_state_dict: dict,
 
                 for epoch in epoch_iter(num_epochs):
                     if _config['increase_seed_per_meta_run']:
-                        set_random_seeds(_config['seed'] + rank + epoch + shared_variables['meta_iter'])
+                        set_random_seeds(_config['seed'] + seed_rank + epoch + shared_variables['meta_iter'])
                     else:
-                        set_random_seeds(_config['seed'] + rank + epoch)
+                        set_random_seeds(_config['seed'] + seed_rank + epoch)
 
                     model.train_without_dropout()
 
-                    # only single iteration
-                    for train_batch in train_loader:
-                        train_inputs, train_gts = train_batch['image'], train_batch['gt']
-                        train_inputs, train_gts = train_inputs.to(device), train_gts.to(device)
+                    # task batches are prepared once by the task pool
+                    train_batch = sample['train_batch']
+                    if train_batch is None:
+                        # random train transforms draw a new batch every epoch
+                        with stage(timer, 'data'):
+                            train_batch = next(iter(sample['train_loader']))
+                    train_inputs, train_gts = train_batch['image'], train_batch['gt']
+                    train_inputs, train_gts = train_inputs.to(device), train_gts.to(device)
 
+                    with stage(timer, 'fine_tune_forward'):
                         if _config['parent_model']['architecture'] == 'MaskRCNN':
                             train_loss, train_losses = model(
                                 train_inputs, train_gts, sample['box_coord_perm'],
-                                train_loader.dataset.flip_label)
+                                flip_label)
 
                             train_losses_hist.append({k: v.cpu().item()
                                                     for k, v in train_losses.items()})
@@ -147,29 +206,31 @@ def meta_run(rank: int, init_model_state_dict: dict,
                                                     train_outputs[-1],
                                                     train_gts)
 
-                        train_loss_hist.append(train_loss.item())
+                    train_loss_hist.append(train_loss.item())
 
                     meta_optim.set_train_loss(train_loss)
-                    meta_optim.step(train_loss)
+                    with stage(timer, 'fine_tune_step'):
+                        meta_optim.step(train_loss)
 
                     if _config['multi_step_bptt_loss']:
                         assert num_epochs == len(_config['multi_step_bptt_loss'])
 
                         bptt_iter_loss = 0.0
-                        for meta_batch in meta_loader:
+                        for meta_batch in sample['meta_batches']:
                             meta_inputs, meta_gts = meta_batch['image'], meta_batch['gt']
                             meta_inputs, meta_gts = meta_inputs.to(
                                 meta_device), meta_gts.to(meta_device)
 
-                            if _config['parent_model']['architecture'] == 'MaskRCNN':
-                                meta_loss, meta_losses = model(
-                                    meta_inputs, meta_gts, sample['box_coord_perm'],
-                                    meta_loader.dataset.flip_label)
-                            else:
-                                meta_outputs = model(meta_inputs)
-                                meta_loss = compute_loss(_config['loss_func'],
-                                                         meta_outputs[-1],
-                                                         meta_gts)
+                            with stage(timer, 'meta_forward'):
+                                if _config['parent_model']['architecture'] == 'MaskRCNN':
+                                    meta_loss, meta_losses = model(
+                                        meta_inputs, meta_gts, sample['box_coord_perm'],
+                                        flip_label)
+                                else:
+                                    meta_outputs = model(meta_inputs)
+                                    meta_loss = compute_loss(_config['loss_func'],
+                                                             meta_outputs[-1],
+                                                             meta_gts)
 
                             bptt_iter_loss += meta_loss
 
@@ -189,20 +250,21 @@ def meta_run(rank: int, init_model_state_dict: dict,
                     if not epoch % _config['bptt_epochs'] or stop_train:
 
                         if not _config['multi_step_bptt_loss']:
-                            for meta_batch in meta_loader:
+                            for meta_batch in sample['meta_batches']:
                                 meta_inputs, meta_gts = meta_batch['image'], meta_batch['gt']
                                 meta_inputs, meta_gts = meta_inputs.to(
                                     meta_device), meta_gts.to(meta_device)
 
-                                if _config['parent_model']['architecture'] == 'MaskRCNN':
-                                    meta_loss, meta_losses = model(
-                                        meta_inputs, meta_gts, sample['box_coord_perm'],
-                                        meta_loader.dataset.flip_label)
-                                else:
-                                    meta_outputs = model(meta_inputs)
-                                    meta_loss = compute_loss(_config['loss_func'],
-                                                            meta_outputs[-1],
-                                                            meta_gts)
+                                with stage(timer, 'meta_forward'):
+                                    if _config['parent_model']['architecture'] == 'MaskRCNN':
+                                        meta_loss, meta_losses = model(
+                                            meta_inputs, meta_gts, sample['box_coord_perm'],
+                                            flip_label)
+                                    else:
+                                        meta_outputs = model(meta_inputs)
+                                        meta_loss = compute_loss(_config['loss_func'],
+                                                                meta_outputs[-1],
+                                                                meta_gts)
 
                                 bptt_loss += meta_loss
 
@@ -211,7 +273,8 @@ def meta_run(rank: int, init_model_state_dict: dict,
                             stop_train = True
 
                         # meta_optim.zero_grad()
-                        bptt_loss.backward()
+                        with stage(timer, 'meta_backward'):
+                            bptt_loss.backward()
 
                         if not stop_train:
                             meta_optim.reset(keep_state=True)
@@ -237,7 +300,24 @@ def meta_run(rank: int, init_model_state_dict: dict,
                     for name, param in meta_optim.named_parameters():
                         shared_meta_optim_grads[name] += param.grad.cpu()
 
+                task_timings.append((seq_name, time.time() - start_task))
+
+                if feature_cache is not None:
+                    # the next task fine-tunes on other frames
+                    feature_cache.clear()
+                if target_cache is not None:
+                    target_cache.clear()
+
             shared_dict['seqs_metrics'] = seqs_metrics
             shared_dict['vis_data_seqs'] = vis_data_seqs
             shared_dict['global_rng_state'] = global_rng_state
+            shared_dict['task_wait_time'] = task_wait_time
+            shared_dict['task_timings'] = task_timings
+            if feature_cache is not None:
+                shared_dict['feature_cache_stats'] = feature_cache.stats()
+                feature_cache.reset_stats()
+            shared_dict['stage_timings'] = timer.summary()
+            timer.reset()
+            if plan_iter == len(epoch_plan) - 1:
+                shared_dict['meta_epoch_done'] = True
             shared_dict['sub_iter_done'] = True
@@ -0,0 +1,455 @@
+"""
+Region similarity J and contour accuracy F of the DAVIS benchmark computed on
+in-memory masks. Follows the davis evaluation package, i.e., first and last
+frames are not evaluated and the statistics are mean, recall and decay per object.
+"""
+import hashlib
+import os
+import warnings
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+from util.checkpoint import atomic_save
+
+
+def db_eval_iou(gt, pred):
+    gt = gt.astype(bool)
+    pred = pred.astype(bool)
+
+    if not gt.any() and not pred.any():
+        return 1.0
+    return np.sum(gt & pred) / np.sum(gt | pred, dtype=np.float32)
+
+
+def seg2bmap(seg):
+    """One pixel wide boundary map of a binary segmentation."""
+    seg = seg.astype(bool)
+
+    e = np.zeros_like(seg)
+    s = np.zeros_like(seg)
+    se = np.zeros_like(seg)
+
+    e[:, :-1] = seg[:, 1:]
+    s[:-1, :] = seg[1:, :]
+    se[:-1, :-1] = seg[1:, 1:]
+
+    b = seg ^ e | seg ^ s | seg ^ se
+    b[-1, :] = seg[-1, :] ^ e[-1, :]
+    b[:, -1] = seg[:, -1] ^ s[:, -1]
+    b[-1, -1] = 0
+    return b
+
+
+def disk(radius):
+    x, y = np.meshgrid(np.arange(-radius, radius + 1), np.arange(-radius, radius + 1))
+    return ((x ** 2 + y ** 2) <= radius ** 2).astype(np.uint8)
+
+
+def boundary_tolerance(shape, bound_th=0.008):
+    """Matching tolerance in pixels relative to the image diagonal."""
+    if bound_th >= 1:
+        return int(bound_th)
+    return int(np.ceil(bound_th * np.linalg.norm(shape)))
+
+
+def db_eval_boundary(gt, pred, bound_th=0.008):
+    bound_pix = boundary_tolerance(gt.shape, bound_th)
+    kernel = disk(bound_pix)
+
+    gt_boundary = seg2bmap(gt)
+    pred_boundary = seg2bmap(pred)
+
+    gt_dil = cv2.dilate(gt_boundary.astype(np.uint8), kernel).astype(bool)
+    pred_dil = cv2.dilate(pred_boundary.astype(np.uint8), kernel).astype(bool)
+
+    n_gt = gt_boundary.sum()
+    n_pred = pred_boundary.sum()
+
+    if n_pred == 0 and n_gt > 0:
+        precision, recall = 1.0, 0.0
+    elif n_pred > 0 and n_gt == 0:
+        precision, recall = 0.0, 1.0
+    elif n_pred == 0 and n_gt == 0:
+        precision, recall = 1.0, 1.0
+    else:
+        precision = np.sum(pred_boundary & gt_dil) / float(n_pred)
+        recall = np.sum(gt_boundary & pred_dil) / float(n_gt)
+
+    if precision + recall == 0:
+        return 0.0
+    return 2 * precision * recall / (precision + recall)
+
+
+def label_boundaries(labels, num_objects):
+    """
+    Boundary pixels of all objects of [T, H, W] label maps, i.e., seg2bmap of
+    the implicit [T, K, H, W] object mask stack without materializing it.
+
+    A pixel is on the boundary of object k if its membership to k differs
+    from its east, south or south-east neighbour. Replicate padding
+    reproduces the border handling of seg2bmap. Returns the frame, row and
+    column of all candidate pixels and a [P, K] boundary indicator.
+    """
+    padded = torch.cat([labels, labels[:, -1:]], 1)
+    padded = torch.cat([padded, padded[:, :, -1:]], 2)
+
+    center = padded[:, :-1, :-1]
+    neighbours = [padded[:, :-1, 1:], padded[:, 1:, :-1], padded[:, 1:, 1:]]
+
+    candidates = center != neighbours[0]
+    for neighbour in neighbours[1:]:
+        candidates |= center != neighbour
+    t, y, x = candidates.nonzero().unbind(1)
+
+    obj_ids = torch.arange(1, num_objects + 1, device=labels.device).view(1, -1)
+    center_obj = center[t, y, x].long().unsqueeze(1) == obj_ids
+
+    is_boundary = torch.zeros_like(center_obj)
+    for neighbour in neighbours:
+        is_boundary |= center_obj != (neighbour[t, y, x].long().unsqueeze(1) == obj_ids)
+
+    return t, y, x, is_boundary
+
+
+def dilate_boundary(points, bound_pix, shape):
+    """
+    Dilation of the boundary with the [P, 2] integer points by disk(bound_pix),
+    i.e., binary_dilation(boundary, disk(bound_pix)) of db_eval_boundary.
+
+    Only the crop of the frame within bound_pix of the points is dilated.
+    Returns the dilated crop and its top left corner.
+    """
+    y0, x0 = np.maximum(points.min(0) - bound_pix, 0)
+    y1, x1 = np.minimum(points.max(0) + bound_pix + 1, shape)
+
+    boundary = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    boundary[points[:, 0] - y0, points[:, 1] - x0] = 1
+    return cv2.dilate(boundary, disk(bound_pix)).astype(bool), (int(y0), int(x0))
+
+
+def boundary_matches(points, dilated):
+    """Number of [P, 2] integer points within a dilate_boundary crop."""
+    crop, (y0, x0) = dilated
+    y = points[:, 0] - y0
+    x = points[:, 1] - x0
+    inside = (y >= 0) & (y < crop.shape[0]) & (x >= 0) & (x < crop.shape[1])
+    return int(crop[y[inside], x[inside]].sum())
+
+
+def frame_boundaries(labels, num_objects):
+    """label_boundaries split per frame and object into [P, 2] integer coordinates."""
+    t, y, x, is_boundary = label_boundaries(labels, num_objects)
+    points = torch.stack([y, x], 1).cpu().numpy()
+    is_boundary = is_boundary.cpu().numpy()
+
+    # nonzero is ordered by frame
+    splits = np.cumsum(np.bincount(t.cpu().numpy(), minlength=labels.shape[0]))[:-1]
+    return [[frame_points[frame_is_boundary[:, k]] for k in range(num_objects)]
+            for frame_points, frame_is_boundary in zip(np.split(points, splits),
+                                                       np.split(is_boundary, splits))]
+
+
+def boundary_f(gt_boundaries, pred_boundaries, bound_pix, shape):
+    """
+    db_eval_boundary of all objects of a frame from the frame_boundaries of
+    the predictions and the points and dilate_boundary of the ground truth.
+    """
+    f = []
+    for (gt_points, gt_dilated), pred_points in zip(gt_boundaries, pred_boundaries):
+        n_gt = gt_points.shape[0]
+        n_pred = pred_points.shape[0]
+
+        if n_pred == 0 and n_gt > 0:
+            precision, recall = 1.0, 0.0
+        elif n_pred > 0 and n_gt == 0:
+            precision, recall = 0.0, 1.0
+        elif n_pred == 0 and n_gt == 0:
+            precision, recall = 1.0, 1.0
+        else:
+            pred_dilated = dilate_boundary(pred_points, bound_pix, shape)
+            precision = boundary_matches(pred_points, gt_dilated) / float(n_pred)
+            recall = boundary_matches(gt_points, pred_dilated) / float(n_gt)
+
+        if precision + recall == 0:
+            f.append(0.0)
+        else:
+            f.append(2 * precision * recall / (precision + recall))
+    return f
+
+
+def mean(x):
+    return np.nanmean(x)
+
+
+def recall(x, threshold=0.5):
+    return np.mean(x > threshold)
+
+
+def decay(x, n_bins=4):
+    ids = np.round(np.linspace(1, len(x), n_bins + 1) + 1e-10) - 1
+    ids = ids.astype(np.int64)
+
+    bins = [x[ids[i]:ids[i + 1] + 1] for i in range(0, n_bins)]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.nanmean(bins[0]) - np.nanmean(bins[-1])
+
+
+MEASURES = {'J': db_eval_iou, 'F': db_eval_boundary}
+STATISTICS = {'mean': mean, 'recall': recall, 'decay': decay}
+
+
+def load_label(path):
+    return np.atleast_3d(Image.open(path))[..., 0]
+
+
+class SequenceGroundTruth:
+    """
+    Evaluation ground truth of a sequence with everything that does not
+    depend on the predictions precomputed, i.e., the per object areas,
+    boundaries and dilated boundaries. Label maps are stored cropped to the
+    bounding box of all objects of a frame.
+
+    Labels above num_objects are not evaluated and merged into a single
+    label. Without multi_object all objects are merged into the foreground.
+    """
+
+    # version of the state_dict format of persisted ground truth
+    VERSION = 2
+
+    def __init__(self, frame_names: list, labels, multi_object: bool,
+                 num_objects: int = None, bound_th: float = 0.008):
+        labels = torch.as_tensor(labels)
+
+        if not multi_object:
+            labels = (labels != 0).to(torch.uint8)
+            num_objects = 1
+        elif num_objects is None:
+            num_objects = int(torch.unique(labels[0]).gt(0).sum().item())
+
+        self.frame_names = list(frame_names)
+        self.multi_object = multi_object
+        self.num_objects = num_objects
+        self.shape = tuple(labels.shape[-2:])
+        self.bound_pix = boundary_tolerance(self.shape, bound_th)
+
+        labels = labels.clamp(max=num_objects + 1)
+
+        # boundaries depend on the frame border and are computed before cropping
+        self.boundaries = []
+        for frame_points in frame_boundaries(labels, num_objects):
+            frame_boundary = []
+            for points in frame_points:
+                dilated = None
+                if points.shape[0]:
+                    crop, corner = dilate_boundary(points, self.bound_pix, self.shape)
+                    dilated = (torch.from_numpy(crop), corner)
+                frame_boundary.append((torch.from_numpy(points), dilated))
+            self.boundaries.append(frame_boundary)
+        self.areas = []
+        self.boxes = []
+        self.crops = []
+        for frame_labels in labels:
+            self.areas.append(torch.bincount(frame_labels.long().flatten(),
+                                             minlength=num_objects + 2)[1:num_objects + 1])
+
+            fg = frame_labels.nonzero()
+            if fg.shape[0]:
+                y0, x0 = fg.min(0)[0].tolist()
+                y1, x1 = (fg.max(0)[0] + 1).tolist()
+            else:
+                y0, y1, x0, x1 = 0, 0, 0, 0
+            self.boxes.append((y0, y1, x0, x1))
+            self.crops.append(frame_labels[y0:y1, x0:x1].clone())
+
+        self._frame_ids = {n: i for i, n in enumerate(self.frame_names)}
+
+    @classmethod
+    def from_label_paths(cls, gt_label_paths: list, multi_object: bool,
+                         num_objects: int = None):
+        gt_label_paths = {os.path.splitext(os.path.basename(p))[0]: p
+                          for p in gt_label_paths}
+        frame_names = sorted(gt_label_paths.keys())
+        labels = np.stack([load_label(gt_label_paths[n]) for n in frame_names])
+        return cls(frame_names, torch.from_numpy(labels), multi_object, num_objects)
+
+    def __len__(self):
+        return len(self.frame_names)
+
+    def frame_boundaries(self, frame_id):
+        """Boundary points and dilate_boundary of all objects of a frame."""
+        return [(points.numpy(), None if dilated is None else (dilated[0].numpy(), dilated[1]))
+                for points, dilated in self.boundaries[frame_id]]
+
+    def frame_id(self, file_name):
+        return self._frame_ids.get(os.path.splitext(os.path.basename(file_name))[0])
+
+    def eval_frames(self, frame_ids: list, preds, measures=('J', 'F')):
+        """Scores [T, H, W] predicted label maps of the given frames. Returns a [T, K] array per measure."""
+        num_objects = self.num_objects
+
+        preds = torch.as_tensor(preds).reshape(len(frame_ids), *self.shape)
+        if not self.multi_object:
+            preds = preds != 0
+        preds = preds.to(torch.uint8).clamp(max=num_objects + 1)
+
+        evaluation = {}
+        if 'J' in measures:
+            j = torch.zeros(len(frame_ids), num_objects, dtype=torch.float64)
+            for t, (frame_id, pred) in enumerate(zip(frame_ids, preds)):
+                y0, y1, x0, x1 = self.boxes[frame_id]
+                gt_crop = self.crops[frame_id]
+                pred_crop = pred[y0:y1, x0:x1]
+
+                pred_area = torch.bincount(pred.long().flatten(), minlength=num_objects + 2)[1:num_objects + 1]
+                intersection = torch.bincount(gt_crop[gt_crop == pred_crop].long(),
+                                              minlength=num_objects + 2)[1:num_objects + 1]
+                union = (self.areas[frame_id] + pred_area - intersection).double()
+
+                j[t] = intersection.double() / union.clamp(min=1)
+                j[t][union == 0] = 1.0
+            evaluation['J'] = j.numpy()
+
+        if 'F' in measures:
+            pred_boundaries = frame_boundaries(preds, num_objects)
+            evaluation['F'] = np.array(
+                [boundary_f(self.frame_boundaries(frame_id), pred_boundaries[t],
+                            self.bound_pix, self.shape)
+                 for t, frame_id in enumerate(frame_ids)],
+                dtype=np.float64).reshape(len(frame_ids), num_objects)
+
+        return evaluation
+
+    def state_dict(self):
+        return {k: v for k, v in self.__dict__.items() if k != '_frame_ids'}
+
+    @classmethod
+    def from_state_dict(cls, state_dict):
+        ground_truth = cls.__new__(cls)
+        ground_truth.__dict__.update(state_dict)
+        ground_truth._frame_ids = {n: i for i, n in enumerate(ground_truth.frame_names)}
+        return ground_truth
+
+
+def eval_label_maps(gt, pred, num_objects, measures=('J', 'F')):
+    """
+    Scores the objects 1 to num_objects of [T, H, W] label maps of a sequence
+    at once. Returns a [T, K] array per measure.
+    """
+    gt = torch.as_tensor(gt)
+    ground_truth = SequenceGroundTruth(range(gt.shape[0]), gt, True, num_objects)
+    return ground_truth.eval_frames(list(range(gt.shape[0])), pred, measures)
+
+
+class GroundTruthCache:
+    """
+    Ground truth of all evaluated sequences of a process. Every sequence is
+    loaded and preprocessed once. With a cache_dir the preprocessed ground
+    truth is persisted and shared between processes and runs. Cache files
+    are keyed by the annotation files and their modification times.
+    """
+
+    def __init__(self, cache_dir: str = None):
+        self._cache_dir = cache_dir
+        self._ground_truths = {}
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _key(self, gt_label_paths, multi_object, num_objects):
+        gt_label_paths = sorted(set(gt_label_paths))
+        seq_name = os.path.basename(os.path.dirname(gt_label_paths[0]))
+
+        key = [(os.path.abspath(p), os.path.getmtime(p)) for p in gt_label_paths]
+        key = hashlib.md5(repr((key, multi_object, num_objects,
+                                SequenceGroundTruth.VERSION)).encode()).hexdigest()
+        return f"{seq_name}_{key}"
+
+    def get(self, gt_label_paths: list, multi_object: bool, num_objects: int = None):
+        key = self._key(gt_label_paths, multi_object, num_objects)
+
+        if key not in self._ground_truths:
+            cache_path = None
+            if self._cache_dir is not None:
+                cache_path = os.path.join(self._cache_dir, f"{key}.pt")
+
+            if cache_path is not None and os.path.exists(cache_path):
+                ground_truth = SequenceGroundTruth.from_state_dict(torch.load(cache_path))
+            else:
+                ground_truth = SequenceGroundTruth.from_label_paths(
+                    gt_label_paths, multi_object, num_objects)
+                if cache_path is not None:
+                    atomic_save(ground_truth.state_dict(), cache_path)
+
+            self._ground_truths[key] = ground_truth
+        return self._ground_truths[key]
+
+
+class SequenceEvaluator:
+    """
+    Streaming J and F evaluation of a single sequence.
+
+    Predicted label maps are added frame by frame with add_frame() and scored
+    against the ground truth frame with the same file name. Predictions of
+    frames without ground truth are ignored. Frames are scored in chunks of
+    chunk_size frames. result() returns the davis db_eval_sequence format,
+    i.e., a list with one value per object for each measure and statistic.
+    """
+
+    def __init__(self, ground_truth: SequenceGroundTruth, measures=('J', 'F'),
+                 chunk_size: int = 8):
+        self._ground_truth = ground_truth
+        self._measures = measures
+        self._chunk_size = chunk_size
+
+        self.num_objects = ground_truth.num_objects
+
+        # frame id -> {measure: per object values}
+        self._frame_results = {}
+        self._chunk = []
+
+    def add_frame(self, file_name, pred):
+        """pred is a [H, W] label map, i.e., 0 for background and object ids starting at 1."""
+        frame_id = self._ground_truth.frame_id(file_name)
+        if frame_id is None:
+            return
+
+        self._chunk.append((frame_id, torch.tensor(np.asarray(pred, dtype=np.uint8))))
+        if len(self._chunk) == self._chunk_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._chunk:
+            return
+
+        frame_ids, preds = zip(*self._chunk)
+        raw = self._ground_truth.eval_frames(
+            list(frame_ids), torch.stack([p.reshape(self._ground_truth.shape) for p in preds]),
+            self._measures)
+
+        for t, frame_id in enumerate(frame_ids):
+            self._frame_results[frame_id] = {
+                m: raw[m][t].tolist() for m in self._measures}
+        self._chunk = []
+
+    def result(self):
+        self._flush()
+
+        assert len(self._frame_results) == len(self._ground_truth), \
+            f"Predictions for {len(self._ground_truth) - len(self._frame_results)} frames missing."
+
+        # first and last frames are not evaluated
+        frame_ids = sorted(self._frame_results.keys())[1:-1]
+
+        evaluation = {}
+        for m in self._measures:
+            raw = np.array([self._frame_results[f][m] for f in frame_ids],
+                           dtype=np.float64).reshape(len(frame_ids), self.num_objects)
+            evaluation[m] = {s: [float(stat_func(raw[:, obj_id]))
+                                 for obj_id in range(self.num_objects)]
+                             for s, stat_func in STATISTICS.items()}
+        return evaluation
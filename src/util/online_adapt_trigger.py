@@ -0,0 +1,97 @@
+import torch
+
+
+class OnlineAdaptTrigger:
+    """
+    Triggers the online adaptation of an object before the first frame on
+    which its predicted masks drift. The signals compare the [C, H, W]
+    object probabilities of a frame with the previous frame:
+
+    CONFIDENCE: mean probability of the mask pixels below min_confidence.
+    AREA: relative change of the mask area above max_area_change.
+    IOU: IoU of the masks below min_iou.
+
+    Masks are the pixels with a probability of at least min_prop. The first
+    min_interval frames after an adaptation never trigger.
+    """
+
+    SIGNALS = ['CONFIDENCE', 'AREA', 'IOU']
+
+    def __init__(self, signals: list, min_interval: int, min_confidence: float,
+                 max_area_change: float, min_iou: float, min_prop: float):
+        if any([s not in self.SIGNALS for s in signals]):
+            raise NotImplementedError
+        assert min_interval >= 1
+
+        self._signals = signals
+        self._min_interval = min_interval
+        self._min_confidence = min_confidence
+        self._max_area_change = max_area_change
+        self._min_iou = min_iou
+        self._min_prop = min_prop
+
+        self.events = []
+
+    @property
+    def enabled(self):
+        return bool(self._signals)
+
+    def _signal(self, probs, prev_probs):
+        """Name and value of the first triggered signal or None."""
+        masks = probs.ge(self._min_prop).flatten(1)
+        prev_masks = prev_probs.ge(self._min_prop).flatten(1)
+        area = masks.sum(dim=1).float()
+        prev_area = prev_masks.sum(dim=1).float()
+
+        for signal in self._signals:
+            if signal == 'CONFIDENCE':
+                visible = area.gt(0)
+                if not visible.any():
+                    continue
+                # the probabilities of ground truth frames are 2
+                confidence = (probs.clamp(max=1.0).flatten(1) * masks.float()).sum(dim=1) / area.clamp(min=1.0)
+                value = confidence[visible].min().item()
+                if value < self._min_confidence:
+                    return signal, value
+            elif signal == 'AREA':
+                visible = prev_area.gt(0)
+                if not visible.any():
+                    continue
+                value = ((area - prev_area).abs() / prev_area.clamp(min=1.0))[visible].max().item()
+                if value > self._max_area_change:
+                    return signal, value
+            elif signal == 'IOU':
+                union = (masks | prev_masks).sum(dim=1).float()
+                visible = union.gt(0)
+                if not visible.any():
+                    continue
+                intersection = (masks & prev_masks).sum(dim=1).float()
+                value = (intersection / union.clamp(min=1.0))[visible].min().item()
+                if value < self._min_iou:
+                    return signal, value
+        return None
+
+    def stop_func(self, obj_id: int, frame_ids: range, prev_probs: torch.Tensor):
+        """
+        Stop function of run_loader for the frame_ids after an adaptation.
+        Returns True for the first frame which triggers the next adaptation.
+        """
+        state = {'prev_probs': prev_probs, 'num_frames': 0}
+
+        def stop(probs):
+            frame_id = frame_ids[state['num_frames']]
+            state['num_frames'] += 1
+
+            if state['num_frames'] > self._min_interval:
+                signal = self._signal(probs, state['prev_probs'].to(probs.device))
+                if signal is not None:
+                    self.events.append({'obj_id': obj_id,
+                                        'frame_id': frame_id,
+                                        'signal': signal[0],
+                                        'value': signal[1]})
+                    return True
+
+            state['prev_probs'] = probs
+            return False
+
+        return stop
@@ -0,0 +1,111 @@
+import math
+
+import torch
+
+
+class RoiCrop:
+    """
+    Crops frames to the union of the predicted boxes of the previous frame,
+    enlarged by margin times their size on every side. The crop is processed
+    at the resolution of the full frame and its masks and boxes are pasted
+    back into the frame. Frames without previous boxes, i.e., with lost
+    objects, or whose crop exceeds max_crop_area of the frame are processed
+    in full.
+    """
+
+    def __init__(self, enabled: bool = False, margin: float = 0.5, min_crop_size: int = 64,
+                 max_crop_area: float = 0.6):
+        self.enabled = enabled
+        self._margin = margin
+        self._min_crop_size = min_crop_size
+        self._max_crop_area = max_crop_area
+
+        # crop area of every processed frame relative to the full frame
+        self.crop_areas = []
+
+    def crop_box(self, boxes: torch.Tensor, height: int, width: int):
+        """[x0, y0, x1, y1] crop of the [K, 4] boxes or None for the full frame."""
+        if not self.enabled or boxes is None:
+            return None
+
+        boxes = boxes[boxes.abs().sum(dim=1).gt(0)]
+        if not len(boxes):
+            return None
+
+        x0, y0 = boxes[:, 0].min().item(), boxes[:, 1].min().item()
+        x1, y1 = boxes[:, 2].max().item(), boxes[:, 3].max().item()
+
+        crop_box = []
+        for start, end, size in [(x0, x1, width), (y0, y1, height)]:
+            margin = max(self._margin * (end - start), (self._min_crop_size - (end - start)) / 2)
+            crop_box.append((max(0, int(math.floor(start - margin))),
+                             min(size, int(math.ceil(end + margin)))))
+        (x0, x1), (y0, y1) = crop_box
+
+        if (x1 - x0) * (y1 - y0) > self._max_crop_area * height * width:
+            return None
+        return x0, y0, x1, y1
+
+    def crop_targets(self, targets: torch.Tensor, crop_box: tuple):
+        """Cropped targets or None if the crop lost their foreground."""
+        if targets is None:
+            return None
+        x0, y0, x1, y1 = crop_box
+        targets = targets[..., y0:y1, x0:x1]
+        if not targets.sum().item():
+            return None
+        return targets
+
+    def record(self, crop_box: tuple, height: int, width: int):
+        if crop_box is None:
+            self.crop_areas.append(1.0)
+        else:
+            x0, y0, x1, y1 = crop_box
+            self.crop_areas.append((x1 - x0) * (y1 - y0) / (height * width))
+
+    @staticmethod
+    def paste(probs: torch.Tensor, boxes: torch.Tensor, crop_box: tuple, height: int, width: int):
+        """[N, C, h, w] probs and [N, C, 4] boxes of a crop in the full frame."""
+        x0, y0, x1, y1 = crop_box
+
+        full_probs = probs.new_zeros(probs.shape[:2] + (height, width))
+        full_probs[..., y0:y1, x0:x1] = probs
+
+        # zero boxes mark missing detections
+        detected = boxes.abs().sum(dim=-1, keepdim=True).gt(0).to(boxes.dtype)
+        boxes = boxes + detected * torch.tensor([x0, y0, x0, y0], dtype=boxes.dtype, device=boxes.device)
+        return full_probs, boxes
+
+    def forward(self, model, inputs: torch.Tensor, targets: torch.Tensor, boxes: torch.Tensor):
+        """MaskRCNN inference on the crop of the previous [K, 4] boxes."""
+        height, width = inputs.shape[-2:]
+
+        crop_box = self.crop_box(boxes, height, width)
+        if crop_box is not None and targets is not None:
+            crop_targets = self.crop_targets(targets, crop_box)
+            if crop_targets is None:
+                crop_box = None
+        self.record(crop_box, height, width)
+
+        if crop_box is None:
+            return model(inputs, targets)
+
+        x0, y0, x1, y1 = crop_box
+        with model.crop_transform((height, width), (y1 - y0, x1 - x0)):
+            probs, crop_boxes = model(inputs[..., y0:y1, x0:x1],
+                                      None if targets is None else crop_targets)
+        return self.paste(probs, crop_boxes, crop_box, height, width)
+
+    @staticmethod
+    def merge_summaries(summaries: list):
+        """Mean crop area of all frames of multiple summaries."""
+        num_frames = sum([s['num_crops'] + s['num_full'] for s in summaries])
+        if not num_frames:
+            return 1.0
+        return sum([s['mean_crop_area'] * (s['num_crops'] + s['num_full']) for s in summaries]) / num_frames
+
+    def summary(self):
+        num_crops = len([a for a in self.crop_areas if a < 1.0])
+        return {'num_crops': num_crops,
+                'num_full': len(self.crop_areas) - num_crops,
+                'mean_crop_area': sum(self.crop_areas) / len(self.crop_areas) if self.crop_areas else 1.0}
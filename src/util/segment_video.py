@@ -0,0 +1,275 @@
+"""
+Streaming segmentation of a single video without datasets, split files or
+an eval process.
+
+_config = load_config(['cfgs/meta.yaml', 'cfgs/meta_davis-2017.yaml',
+                       'cfgs/eval_e-osvos-OnA.yaml'])
+meta_optim_state_dict = torch.load(model_file)['meta_optim_state_dict']
+model, meta_optim = init_eval_model('val', meta_optim_state_dict, _config, device)
+
+for frame_id, label_map in segment_video(model, meta_optim, meta_optim_state_dict,
+                                         frames, first_frame_mask, _config):
+    ...
+"""
+import collections
+
+import numpy as np
+import torch
+import yaml
+from data import DAVIS, custom_transforms
+from networks.mask_rcnn import MaskRCNN
+
+from util.fine_tune_budget import FineTuneBudget
+from util.keyframes import KeyframeSelector
+from util.helper_func import (early_stopping, epoch_iter, init_train_transforms,
+                              probs_to_labels, set_random_seeds, transform_scale)
+
+
+def load_config(config_files: list, updates: dict = None):
+    """Merges yaml configs in order like Sacred named configs."""
+    def merge(config, update):
+        for k, v in update.items():
+            if isinstance(v, dict) and isinstance(config.get(k), dict):
+                merge(config[k], v)
+            else:
+                config[k] = v
+
+    _config = {}
+    for config_file in config_files:
+        with open(config_file) as f:
+            merge(_config, yaml.safe_load(f))
+    if updates is not None:
+        merge(_config, updates)
+    return _config
+
+
+def _frame_to_image(frame: np.ndarray, normalize: bool):
+    # same preprocessing as VOSDataset.make_img_label_pair
+    img = np.array(frame, dtype=np.float32)
+    if normalize:
+        img = np.subtract(img, np.array(DAVIS.mean_val, dtype=np.float32))
+    return img / 255.0
+
+
+def _param_groups(meta_optim):
+    return {f"{n_m}.{n_p}": p for n_m, _, n_p, p in meta_optim.meta_model.param_groups()}
+
+
+def _fine_tune(model, meta_optim, batch_func, num_epochs: int, seed: int,
+               only_box_head: bool, early_stopping_cfg: dict, fine_tune_budget=None,
+               resolution_schedule=()):
+    device = next(model.parameters()).device
+
+    train_loss_hist = []
+    model.train_without_dropout()
+    for epoch in epoch_iter(num_epochs):
+        set_random_seeds(seed + epoch)
+        model.transform_scale = transform_scale(resolution_schedule, epoch)
+
+        inputs, gts = batch_func()
+        inputs, gts = inputs.to(device), gts.to(device)
+
+        train_loss, _ = model(inputs, gts)
+        train_loss_hist.append(train_loss.item())
+
+        model.zero_grad()
+
+        meta_optim.set_train_loss(train_loss)
+        meta_optim.only_box_head = only_box_head
+        meta_optim.step(train_loss)
+
+        meta_optim.meta_model.detach_param_groups()
+
+        stop_fine_tuning = early_stopping(train_loss_hist, **early_stopping_cfg)
+        if fine_tune_budget is not None:
+            fine_tune_budget.add_epoch(train_loss_hist[-1], meta_optim.state.get('grad_norm'))
+            stop_fine_tuning = fine_tune_budget.stop() or stop_fine_tuning
+
+        if stop_fine_tuning:
+            break
+    model.transform_scale = 1.0
+
+
+def _reset_targets(obj: dict, start_targets: torch.Tensor, augment_mode: str):
+    # see run_loader
+    obj['start_targets'] = start_targets
+    obj['targets'] = None
+    obj['augment_mode'] = augment_mode
+    if augment_mode is not None and start_targets is not None:
+        if start_targets.sum().item() == 0:
+            obj['start_targets'] = None
+            obj['augment_mode'] = 'EXTEND'
+        else:
+            obj['targets'] = start_targets.clone()
+
+
+def _update_targets(obj: dict, probs: torch.Tensor, augment_mode: str):
+    if augment_mode is None:
+        return
+
+    obj['targets'] = probs_to_labels(probs)
+
+    obj['augment_mode'] = augment_mode
+    if obj['targets'].sum().item() == 0:
+        obj['augment_mode'] = 'EXTEND'
+        obj['targets'] = obj['start_targets']
+
+
+def segment_video(model, meta_optim, meta_optim_state_dict: dict, frames,
+                  first_frame_mask: np.ndarray, _config: dict):
+    """
+    Segments the objects of first_frame_mask in a stream of frames.
+
+    frames yields RGB uint8 [H, W, 3] frames starting with the frame of
+    first_frame_mask, an [H, W] label map with one id per object. Every
+    object is fine-tuned on the first frame as in evaluate() and, with
+    eval_online_adapt.step, fine-tuned again every step frames on its
+    propagated predictions. Yields the frame id and an [H, W] uint8 label
+    map for every frame.
+
+    Only the fine-tuned parameters of each object and the previous
+    eval_online_adapt.step frames are kept in memory.
+    """
+    if not isinstance(model, MaskRCNN):
+        raise NotImplementedError
+
+    online_adapt_cfg = _config['eval_online_adapt']
+    reset_model_mode = online_adapt_cfg['reset_model_mode']
+    if online_adapt_cfg['step'] and reset_model_mode not in ['FIRST_STEP', 'FULL']:
+        raise NotImplementedError
+    # triggered adaptations re-predict frames which were already yielded
+    if online_adapt_cfg['step'] and online_adapt_cfg['trigger']['signals']:
+        raise NotImplementedError
+
+    device = next(model.parameters()).device
+    normalize = _config['data_cfg']['normalize']
+    batch_size = _config['data_cfg']['batch_sizes']['train']
+    early_stopping_cfg = _config['train_early_stopping_cfg']
+    random_transformation_transforms = init_train_transforms(
+        _config['data_cfg']['random_train_transform'])
+    augment_mode = model.rpn._eval_augment_proposals_mode
+
+    frames = iter(frames)
+    first_image = _frame_to_image(next(frames), normalize)
+    first_frame_mask = np.asarray(first_frame_mask)
+    obj_ids = [obj_id for obj_id in np.unique(first_frame_mask) if obj_id != 0]
+
+    def first_frame_batch(first_frame_gt, transform, num_samples):
+        samples = [transform({'image': first_image.copy(),
+                              'gt': first_frame_gt.copy(),
+                              'file_name': 'first_frame'})
+                   for _ in range(num_samples)]
+        return (torch.stack([s['image'] for s in samples]),
+                torch.stack([s['gt'] for s in samples]))
+
+    fine_tune_budget = FineTuneBudget(**_config['eval_fine_tune_budget'])
+    fine_tune_budget.start_seq(len(obj_ids))
+    meta_optim.track_grad_norm = fine_tune_budget.tracks_grad_norm
+
+    objs = []
+    for obj_id in obj_ids:
+        first_frame_gt = (first_frame_mask == obj_id).astype(np.float32)
+
+        meta_optim.load_state_dict(meta_optim_state_dict)
+        meta_optim.reset()
+        meta_optim.eval()
+
+        fine_tune_budget.start_obj(obj_id, _config['num_epochs']['eval'])
+        _fine_tune(model, meta_optim,
+                   lambda: first_frame_batch(first_frame_gt, random_transformation_transforms, batch_size),
+                   _config['num_epochs']['eval'], _config['seed'], False, early_stopping_cfg,
+                   fine_tune_budget, _config['eval_resolution_schedule'])
+        fine_tune_budget.end_obj()
+
+        obj = {'obj_id': obj_id,
+               'first_frame_gt': first_frame_gt,
+               'params': _param_groups(meta_optim)}
+        obj['first_step_params'] = obj['params']
+        _reset_targets(obj, torch.from_numpy(first_frame_gt)[None, None], augment_mode)
+        objs.append(obj)
+
+    yield 0, first_frame_mask.astype(np.uint8)
+
+    # the first frame after every adaptation is a keyframe
+    keyframes = KeyframeSelector(**_config['eval_keyframes'])
+
+    # previous frames and the binary object masks for the online adaptation
+    window = collections.deque(maxlen=max(online_adapt_cfg['step'] - 1, 1))
+    to_tensor = custom_transforms.ToTensor()
+
+    for frame_id, frame in enumerate(frames, start=1):
+        step = online_adapt_cfg['step']
+        if step and frame_id > 1 and not (frame_id - 1) % step:
+            eval_online_step_count = (frame_id - 1) // step
+            keyframes.start()
+
+            for obj_index, obj in enumerate(objs):
+                meta_optim.load_state_dict(meta_optim_state_dict)
+                if reset_model_mode == 'FULL':
+                    meta_optim.reset()
+                else:
+                    meta_optim.meta_model.init_param_groups(obj['first_step_params'])
+                meta_optim.eval()
+
+                def online_adapt_batch():
+                    inputs, gts = first_frame_batch(obj['first_frame_gt'], to_tensor, 1)
+
+                    num_propagate_frames = min(step, batch_size)
+                    for propagate_frame_id in range(step - num_propagate_frames + 1, step):
+                        if propagate_frame_id > len(window):
+                            continue
+                        image, masks = window[-propagate_frame_id]
+                        if masks[obj_index].any():
+                            sample = to_tensor({'image': image,
+                                                'gt': masks[obj_index].astype(np.float32)})
+                            inputs = torch.cat([inputs, sample['image'][None]])
+                            gts = torch.cat([gts, sample['gt'][None]])
+                    return inputs, gts
+
+                _fine_tune(model, meta_optim, online_adapt_batch,
+                           online_adapt_cfg['num_epochs'],
+                           _config['seed'] + eval_online_step_count,
+                           reset_model_mode == 'FIRST_STEP', early_stopping_cfg,
+                           resolution_schedule=_config['eval_resolution_schedule'])
+
+                obj['params'] = _param_groups(meta_optim)
+
+                propagate_frame_gt = torch.from_numpy(window[-1][1][obj_index].astype(np.float32))
+                _reset_targets(obj, propagate_frame_gt[None, None], augment_mode)
+
+        image = _frame_to_image(frame, normalize)
+        inputs = to_tensor({'image': image})['image'][None].to(device)
+
+        keyframe = True
+        if keyframes.enabled:
+            keyframe = keyframes.is_keyframe(inputs[0], str(frame_id), num_objects=len(objs))
+
+        probs_objs = []
+        model.eval()
+        with torch.no_grad():
+            for obj in objs:
+                if keyframe:
+                    meta_optim.meta_model.init_param_groups(obj['params'])
+                    model.rpn._eval_augment_proposals_mode = obj['augment_mode']
+
+                    probs, _ = model(inputs, obj['targets'])
+                else:
+                    probs, _ = keyframes.propagate(obj['probs'][0])
+                obj['probs'] = probs
+                _update_targets(obj, probs, augment_mode)
+
+                probs_objs.append(probs[0, 0].cpu())
+        model.rpn._eval_augment_proposals_mode = augment_mode
+
+        if probs_objs:
+            probs_objs = torch.stack(probs_objs)
+            label_map = torch.tensor(obj_ids, dtype=torch.uint8)[probs_objs.argmax(dim=0)]
+            label_map[probs_objs.max(dim=0)[0].lt(0.5)] = 0
+            label_map = label_map.numpy()
+        else:
+            label_map = np.zeros(image.shape[:2], dtype=np.uint8)
+
+        if online_adapt_cfg['step']:
+            window.append((image, [p.ge(online_adapt_cfg['min_prop']).numpy() for p in probs_objs]))
+
+        yield frame_id, label_map
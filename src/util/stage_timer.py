@@ -0,0 +1,109 @@
+import contextlib
+import json
+import os
+import resource
+import timeit
+
+import torch
+
+
+class StageTimer:
+    """
+    Accumulated wall time, number of calls and peak memory of named stages.
+
+    Stages may be nested, e.g., data decoding within data loading. The peak
+    memory of a stage is the allocated CUDA memory on GPU devices and the
+    maximum resident set size of the process on CPU. Without synchronize,
+    asynchronous CUDA kernels are timed at the next synchronizing stage.
+    """
+
+    def __init__(self, device: torch.device = None, synchronize: bool = False):
+        self._cuda = device is not None and torch.device(device).type == 'cuda'
+        self._device = device
+        self._synchronize = synchronize and self._cuda
+        # running peak memory of the open stages
+        self._open_peaks = []
+        self._stages = {}
+
+    def _peak_mem(self):
+        if self._cuda:
+            return torch.cuda.max_memory_allocated(self._device) / 1024 ** 2
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        if self._cuda:
+            if self._open_peaks:
+                self._open_peaks[-1] = max(self._open_peaks[-1], self._peak_mem())
+            torch.cuda.reset_max_memory_allocated(self._device)
+        if self._synchronize:
+            torch.cuda.synchronize(self._device)
+
+        self._open_peaks.append(0.0)
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            if self._synchronize:
+                torch.cuda.synchronize(self._device)
+            stage_time = timeit.default_timer() - start
+            peak_mem = max(self._open_peaks.pop(), self._peak_mem())
+
+            if self._open_peaks:
+                self._open_peaks[-1] = max(self._open_peaks[-1], peak_mem)
+
+            stats = self._stages.setdefault(name, {'time': 0.0, 'calls': 0, 'peak_mem_mb': 0.0})
+            stats['time'] += stage_time
+            stats['calls'] += 1
+            stats['peak_mem_mb'] = max(stats['peak_mem_mb'], peak_mem)
+
+    def summary(self):
+        return merge_summaries([self._stages])
+
+    def reset(self):
+        self._stages = {}
+
+
+def stage(timer: StageTimer, name: str):
+    """Stage context of timer or a no-op without a timer."""
+    if timer is None:
+        return contextlib.nullcontext()
+    return timer.stage(name)
+
+
+def timed_iter(timer: StageTimer, name: str, iterable):
+    """Times the fetching of every item, e.g., the batches of a loader."""
+    iterator = iter(iterable)
+    while True:
+        with stage(timer, name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def merge_summaries(summaries: list):
+    merged = {}
+    for summary in summaries:
+        for name, stats in summary.items():
+            merged_stats = merged.setdefault(name, {'time': 0.0, 'calls': 0, 'peak_mem_mb': 0.0})
+            merged_stats['time'] += stats['time']
+            merged_stats['calls'] += stats['calls']
+            merged_stats['peak_mem_mb'] = max(merged_stats['peak_mem_mb'], stats['peak_mem_mb'])
+
+    for stats in merged.values():
+        stats['mean_time'] = stats['time'] / stats['calls'] if stats['calls'] else 0.0
+    return merged
+
+
+def format_summary(summary: dict):
+    return ", ".join([f"{name} {stats['time']:.2f}s"
+                      for name, stats in sorted(summary.items(), key=lambda s: -s[1]['time'])])
+
+
+def save_json(obj, path: str):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=4)
+    os.replace(tmp_path, path)
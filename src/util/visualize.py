@@ -39,7 +39,8 @@ def init_vis(run_name: str, env_suffix: str, _config: dict, _run: sacred.run.Run
         'STD seq META loss',
         'MAX seq META loss',
         'MIN seq META loss',
-        'RUN TIME per ITER [min]']
+        'RUN TIME per ITER [min]',
+        'TASK QUEUE WAIT per ITER [s]']
     opts = dict(
         title=f"TRAIN METRICS (RUN: {_run._id})",
         xlabel='META ITERS',
@@ -0,0 +1,106 @@
+import hashlib
+import os
+
+import torch
+
+from util.checkpoint import atomic_save
+
+
+def _update_digest(digest, obj):
+    if torch.is_tensor(obj):
+        obj = obj.detach().cpu().contiguous()
+        digest.update(repr((str(obj.dtype), tuple(obj.shape))).encode())
+        digest.update(obj.numpy().tobytes())
+    elif isinstance(obj, dict):
+        for k in sorted(obj.keys(), key=repr):
+            digest.update(repr(k).encode())
+            _update_digest(digest, obj[k])
+    elif isinstance(obj, (list, tuple)):
+        digest.update(repr(len(obj)).encode())
+        for v in obj:
+            _update_digest(digest, v)
+    else:
+        digest.update(repr(obj).encode())
+
+
+class FineTuneCache:
+    """
+    Persisted parameters of the first fine-tuning step of every sequence
+    object.
+
+    Entries are keyed by a digest of the meta optimizer state, the model
+    state before the fine-tuning, the training frame, the object and the
+    fine-tuning config. Only the deltas of the fine-tuned parameters to the
+    model initialization are stored in dtype [float16, float32].
+    """
+
+    def __init__(self, cache_dir: str = None, dtype: str = 'float16'):
+        if dtype not in ['float16', 'float32']:
+            raise NotImplementedError
+
+        self._cache_dir = cache_dir
+        self._dtype = getattr(torch, dtype)
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self._cache_dir is not None
+
+    @staticmethod
+    def state_digest(meta_optim_state_dict: dict, model_state_dict: dict):
+        """
+        Digest of the meta optimizer and model state. Both are fixed for an
+        evaluation round, i.e., compute it once per round and pass it to key().
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        for obj in [meta_optim_state_dict, model_state_dict]:
+            _update_digest(digest, obj)
+        return digest.hexdigest()
+
+    def key(self, seq_name: str, obj_id: int, state_digest: str, fine_tune_cfg: dict):
+        digest = hashlib.blake2b(digest_size=16)
+        for obj in [state_digest, fine_tune_cfg]:
+            _update_digest(digest, obj)
+        return f"{seq_name}_{obj_id}_{digest.hexdigest()}"
+
+    def _path(self, key):
+        return os.path.join(self._cache_dir, f"{key}.pt")
+
+    def save(self, key: str, meta_optim, train_loss: torch.Tensor, train_losses: dict):
+        model_init = meta_optim._model_init
+
+        deltas = {}
+        for n_m, _, n_p, p in meta_optim.meta_model.param_groups():
+            name = f"{n_m}.{n_p}"
+            delta = p.detach() - model_init[name].detach()
+            if delta.ne(0.0).any():
+                deltas[name] = delta.to(self._dtype).cpu()
+
+        model = meta_optim.meta_model.model
+        atomic_save({'deltas': deltas,
+                     'buffers': {n: b.detach().cpu() for n, b in model.named_buffers()},
+                     'train_loss': train_loss.detach().cpu(),
+                     'train_losses': {k: v.detach().cpu() for k, v in train_losses.items()}},
+                    self._path(key))
+
+    def load(self, key: str, meta_optim):
+        """
+        Applies the cached parameters to the reset model of meta_optim.
+        Returns the cached entry or None.
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+
+        entry = torch.load(path, map_location=lambda storage, loc: storage)
+
+        params = {}
+        for name, delta in entry['deltas'].items():
+            init = meta_optim._model_init[name].detach()
+            params[name] = (init + delta.to(init.device, init.dtype)).requires_grad_()
+        meta_optim.meta_model.init_param_groups(params)
+
+        meta_optim.meta_model.model.load_state_dict(entry['buffers'], strict=False)
+        return entry